@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+''' Stand-in for tomcat and the api, for the benchmarks
+
+    POST /print/create.json           writes a PDF of about --pdf-size bytes
+                                      in the print temp dir after --latency
+                                      seconds, answers with its getURL
+    GET  /rest/.../releases           returns --releases timestamps
+    GET  /shorten.json                returns a short link
+    GET  /stats                       requests served, peak of concurrent
+                                      print requests
+'''
+
+import os
+import json
+import time
+import random
+import argparse
+import threading
+from urllib.parse import urlsplit
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+from pypdf import PdfWriter
+from pypdf.generic import DecodedStreamObject, DictionaryObject, NameObject
+
+
+def write_pdf(filename, text, size, logo):
+    ''' Writes a one page PDF: a text, a logo shared by all the pages and a
+        page specific stream filling up to size bytes '''
+    writer = PdfWriter()
+    page = writer.add_blank_page(595, 842)
+    content = DecodedStreamObject()
+    padding = max(0, size - len(logo) - 1000)
+    content.set_data(
+        ('BT /F1 12 Tf 10 10 Td (%s) Tj ET\n%% ' % text).encode() +
+        os.urandom(padding // 2).hex().encode()[:padding])
+    page[NameObject('/Contents')] = writer._add_object(content)
+    image = DecodedStreamObject()
+    image.set_data(logo)
+    image.update({NameObject('/Type'): NameObject('/XObject'),
+                  NameObject('/Subtype'): NameObject('/Image')})
+    page[NameObject('/Resources')] = DictionaryObject({
+        NameObject('/XObject'): DictionaryObject(
+            {NameObject('/Logo'): writer._add_object(image)})})
+    writer.write(filename)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        path = urlsplit(self.path).path
+        if path.endswith('/releases'):
+            self._send_json({'results': server.releases})
+        elif path == '/shorten.json':
+            with server.lock:
+                server.shortened += 1
+            self._send_json(
+                {'shorturl': 'https://s.geo.admin.ch/%x' % server.shortened})
+        elif path == '/stats':
+            with server.lock:
+                self._send_json({
+                    'printed': server.printed,
+                    'shortened': server.shortened,
+                    'peak_inflight': server.peak_inflight})
+        else:
+            self._send_json({}, status=404)
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get('Content-Length', 0))
+        spec = json.loads(self.rfile.read(length))
+        with server.lock:
+            server.inflight += 1
+            server.peak_inflight = max(server.peak_inflight, server.inflight)
+            server.printed += 1
+            name = '%d%06d.pdf.printout' % (os.getpid(), server.printed)
+        try:
+            time.sleep(server.latency * random.uniform(0.5, 1.5))
+            if random.random() < server.error_rate:
+                self._send_json({}, status=500)
+                return
+            times = [layer.get('params', {}).get('TIME', '')
+                     for layer in spec.get('layers', [])]
+            write_pdf(os.path.join(server.print_temp_dir, 'mapfish-print' + name),
+                      ' '.join(times), server.pdf_size, server.logo)
+            self._send_json(
+                {'getURL': 'http://%s/print/%s' % (self.headers['Host'], name)})
+        finally:
+            with server.lock:
+                server.inflight -= 1
+
+
+def serve(port, print_temp_dir, latency=0.2, pdf_size=100000, releases=10,
+          error_rate=0.0, ready=None):
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.print_temp_dir = print_temp_dir
+    server.latency = latency
+    server.pdf_size = pdf_size
+    server.error_rate = error_rate
+    server.releases = ['%d1231' % (1900 + i) for i in range(releases)]
+    server.logo = os.urandom(min(pdf_size // 2, 20000))
+    server.lock = threading.Lock()
+    server.inflight = 0
+    server.peak_inflight = 0
+    server.printed = 0
+    server.shortened = 0
+    if ready is not None:
+        ready.put(server.server_port)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--port', type=int, default=8011)
+    parser.add_argument('--print-temp-dir', default='/var/local/print')
+    parser.add_argument('--latency', type=float, default=0.2)
+    parser.add_argument('--pdf-size', type=int, default=100000)
+    parser.add_argument('--releases', type=int, default=10)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+    serve(args.port, args.print_temp_dir, args.latency, args.pdf_size,
+          args.releases, args.error_rate)
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+
+''' Load test of the multipages print
+
+    Starts the fake tomcat/api of fake_backend.py in a separate process,
+    then sends --jobs concurrent movie prints of --pages pages each to
+    /printmulti/create.json, and follows them on /printprogress until they
+    are done. Reports the job latencies, the throughput, the peak memory
+    and file descriptors of the print process and the file I/O it did.
+
+    Results are printed as JSON. They can be saved as a baseline
+    (--save-baseline) and compared to one (--baseline): the exit code is
+    1 if a metric is worse than the baseline by more than --tolerance.
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import multiprocessing
+
+from benchmarks.fake_backend import serve
+
+
+# Metric: True if higher is better
+COMPARED_METRICS = {
+    'latency_p50': False,
+    'latency_p95': False,
+    'latency_p99': False,
+    'pages_per_s': True,
+    'peak_rss_mb': False,
+    'peak_fds': False,
+    'write_mb': False,
+    'write_calls': False,
+    'read_calls': False
+}
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    k = max(0, int(round(p / 100.0 * len(values))) - 1)
+    return values[min(k, len(values) - 1)]
+
+
+def proc_io():
+    ''' File I/O done by this process so far, if the kernel tells '''
+    io = {}
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                key, value = line.split(':')
+                io[key] = int(value)
+    except IOError:
+        pass
+    return io
+
+
+def rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024.
+    except IOError:
+        pass
+    return 0.
+
+
+def fd_count():
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return 0
+
+
+class Sampler(threading.Thread):
+
+    def __init__(self, interval=0.05):
+        super(Sampler, self).__init__()
+        self.daemon = True
+        self.interval = interval
+        self.peak_rss_mb = rss_mb()
+        self.peak_fds = fd_count()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.peak_rss_mb = max(self.peak_rss_mb, rss_mb())
+            self.peak_fds = max(self.peak_fds, fd_count())
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def movie_spec(features):
+    coords = [[2600000 + i, 1200000 + i] for i in range(features)]
+    return {
+        'movie': True,
+        'layout': '1 A4 landscape',
+        'qrcodeurl': 'https://map.geo.admin.ch/qrcodegenerator?url=' +
+                     'https%3A%2F%2Fmap.geo.admin.ch%2F%3Flayers%3D' +
+                     'ch.swisstopo.zeitreihen%26layers_timestamp%3D18641231',
+        'layers': [
+            {'layer': 'ch.swisstopo.zeitreihen', 'type': 'WMS',
+             'baseURL': 'https://wms.geo.admin.ch/', 'params': {}},
+            {'type': 'Vector', 'geoJson': {
+                'type': 'FeatureCollection',
+                'features': [{'type': 'Feature', 'properties': {},
+                              'geometry': {'type': 'LineString',
+                                           'coordinates': coords}}]}}],
+        'pages': [{'center': [2600000, 1200000],
+                   'bbox': [2590000, 1190000, 2610000, 1210000],
+                   'display': [802, 530], 'scale': 50000}]
+    }
+
+
+def run(args):
+    print_temp_dir = tempfile.mkdtemp(prefix='print-benchmark')
+    ready = multiprocessing.Queue()
+    backend = multiprocessing.Process(
+        target=serve,
+        args=(0, print_temp_dir, args.latency, args.pdf_size, args.pages,
+              args.error_rate, ready))
+    backend.daemon = True
+    backend.start()
+    port = ready.get(timeout=10)
+    backend_url = '//127.0.0.1:%d' % port
+
+    os.environ.update({
+        'PRINT_TEMP_DIR': print_temp_dir,
+        'API_URL': backend_url,
+        'TOMCAT_SERVER_URL': backend_url,
+        'PRINT_SERVER_HOST': '127.0.0.1:%d' % port,
+        'PRINT_SHORTEN_API_URL': 'http:' + backend_url,
+        'PRINT_MAX_CONCURRENT_JOBS': str(args.concurrent_jobs),
+        'PRINT_MAX_BACKEND_CALLS': str(args.backend_calls),
+        # All the jobs print the same pages, measure tomcat, not the cache
+        'PRINT_PDF_CACHE_SIZE': '0',
+        # All the jobs come from the same client, and are all admitted
+        'PRINT_MAX_CLIENT_JOBS': '0',
+        'PRINT_MAX_ADMITTED_JOBS': str(args.jobs),
+        'PRINT_MAX_PENDING_PAGES': str(args.jobs * args.pages),
+        'PRINT_LOGLEVEL': os.environ.get('PRINT_LOGLEVEL', '40')
+    })
+    from print3.main import app
+    import requests
+
+    client = app.test_client()
+    body = json.dumps(movie_spec(args.features))
+    latencies = []
+    failures = []
+
+    def job():
+        start = time.time()
+        resp = client.post('/printmulti/create.json', data=body,
+                           content_type='application/json')
+        if resp.status_code != 200:
+            failures.append(resp.status_code)
+            return
+        jobid = resp.get_json()['idToCheck']
+        status = None
+        while time.time() - start < args.timeout:
+            resp = client.get('/printprogress?id=' + jobid)
+            if resp.status_code == 200:
+                status = resp.get_json().get('status')
+                if status in ('done', 'failed'):
+                    break
+            time.sleep(args.poll_interval)
+        if status == 'done':
+            latencies.append(time.time() - start)
+        else:
+            failures.append(jobid)
+
+    io_before = proc_io()
+    sampler = Sampler()
+    sampler.start()
+    start = time.time()
+    threads = [threading.Thread(target=job) for i in range(args.jobs)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    sampler.stop()
+    io_after = proc_io()
+
+    stats = requests.get('http:%s/stats' % backend_url).json()
+    backend.terminate()
+    shutil.rmtree(print_temp_dir, ignore_errors=True)
+
+    def io_delta(key):
+        return io_after.get(key, 0) - io_before.get(key, 0)
+
+    return {
+        'params': {
+            'jobs': args.jobs,
+            'pages': args.pages,
+            'latency': args.latency,
+            'pdf_size': args.pdf_size,
+            'features': args.features,
+            'error_rate': args.error_rate,
+            'concurrent_jobs': args.concurrent_jobs,
+            'backend_calls': args.backend_calls
+        },
+        'failed_jobs': len(failures),
+        'elapsed': elapsed,
+        'latency_p50': percentile(latencies, 50),
+        'latency_p95': percentile(latencies, 95),
+        'latency_p99': percentile(latencies, 99),
+        'pages_per_s': len(latencies) * args.pages / elapsed,
+        'peak_rss_mb': sampler.peak_rss_mb,
+        'peak_fds': sampler.peak_fds,
+        'write_mb': io_delta('wchar') / 1024. / 1024.,
+        'write_calls': io_delta('syscw'),
+        'read_calls': io_delta('syscr'),
+        'backend_requests': stats['printed'],
+        'backend_peak_inflight': stats['peak_inflight'],
+        'shortened': stats['shortened']
+    }
+
+
+def compare(results, baseline, tolerance):
+    ''' Returns the metrics worse than the baseline by more than tolerance '''
+    regressions = []
+    for metric, higher_is_better in sorted(COMPARED_METRICS.items()):
+        value = results.get(metric)
+        reference = baseline.get(metric)
+        if value is None or not reference:
+            continue
+        ratio = value / float(reference)
+        if (higher_is_better and ratio < 1 - tolerance) or \
+                (not higher_is_better and ratio > 1 + tolerance):
+            regressions.append((metric, reference, value))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--jobs', type=int, default=4,
+                        help='concurrent movie prints')
+    parser.add_argument('--pages', type=int, default=20,
+                        help='pages (timestamps) per print')
+    parser.add_argument('--latency', type=float, default=0.2,
+                        help='mean time tomcat takes to print a page')
+    parser.add_argument('--pdf-size', type=int, default=100000,
+                        help='size of the pages returned by tomcat')
+    parser.add_argument('--features', type=int, default=10000,
+                        help='coordinates of the vector layer of the spec')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='part of the page requests failing with a 500')
+    parser.add_argument('--concurrent-jobs', type=int, default=4,
+                        help='jobs processed at the same time by the runner')
+    parser.add_argument('--backend-calls', type=int, default=8,
+                        help='concurrent page requests of the runner')
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--poll-interval', type=float, default=0.05)
+    parser.add_argument('--baseline', help='compare to this baseline')
+    parser.add_argument('--save-baseline', help='save results as baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    if results['failed_jobs']:
+        return 1
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('params') != results['params']:
+            sys.stderr.write('Baseline was run with other parameters\n')
+            return 2
+        regressions = compare(results, baseline, args.tolerance)
+        for metric, reference, value in regressions:
+            sys.stderr.write('Regression of {}: {} (baseline {})\n'.format(
+                metric, value, reference))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
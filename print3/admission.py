@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+''' Admission of the multipages jobs
+
+    Every worker admits at most MAX_ADMITTED_JOBS jobs not over yet, at most
+    MAX_CLIENT_JOBS of them from the same client, and no job while more than
+    MAX_PENDING_PAGES pages are waiting for tomcat. Refused jobs are
+    answered 429, to be posted again after ADMISSION_RETRY_AFTER.
+
+    Admitted jobs are forgotten once their progress is final, or gone,
+    whichever the process running them.'''
+
+import threading
+
+from print3.config import MAX_ADMITTED_JOBS, MAX_CLIENT_JOBS, \
+    MAX_PENDING_PAGES
+from print3.progress import get_progress_store, FINAL_STATUSES
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class Admission(object):
+
+    def __init__(self, store, max_jobs=MAX_ADMITTED_JOBS,
+                 max_client_jobs=MAX_CLIENT_JOBS,
+                 max_pages=MAX_PENDING_PAGES):
+        self.store = store
+        self.max_jobs = max_jobs
+        self.max_client_jobs = max_client_jobs
+        self.max_pages = max_pages
+        self.rejected = 0
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def _prune(self):
+        for jobid in list(self._jobs):
+            data = self.store.read(jobid)
+            if data is None or data.get('status') in FINAL_STATUSES:
+                del self._jobs[jobid]
+
+    def _refusal(self, client, pending_pages):
+        if len(self._jobs) >= self.max_jobs:
+            return '{} jobs running'.format(len(self._jobs))
+        if pending_pages > self.max_pages:
+            return '{} pages waiting'.format(pending_pages)
+        if self.max_client_jobs and list(
+                self._jobs.values()).count(client) >= self.max_client_jobs:
+            return 'quota of {} reached'.format(client)
+        return None
+
+    def admit(self, jobid, client, pending_pages=0):
+        ''' Returns True if the job of client may run. The job must be
+            published to the store already. '''
+        with self._lock:
+            self._prune()
+            refusal = self._refusal(client, pending_pages)
+            if refusal is not None:
+                self.rejected += 1
+                log.info('[Admission] Job {} refused: {}'.format(
+                    jobid, refusal))
+                return False
+            self._jobs[jobid] = client
+            return True
+
+    def stats(self):
+        with self._lock:
+            return {'admitted_jobs': len(self._jobs),
+                    'rejected_jobs': self.rejected}
+
+
+_admissions = {}
+_admissions_lock = threading.Lock()
+
+
+def get_admission(print_temp_dir):
+    with _admissions_lock:
+        if print_temp_dir not in _admissions:
+            _admissions[print_temp_dir] = Admission(
+                get_progress_store(print_temp_dir))
+        return _admissions[print_temp_dir]
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+''' Small caches for the upstream lookups done before printing '''
+
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class TTLCache(object):
+    ''' LRU cache whose entries expire after ttl seconds
+
+        If a directory is given, entries are also written there (one JSON
+        file per key), so that they are shared by all the processes using
+        the same directory. Expired files are removed when read, the others
+        by the sweep of the janitor.
+
+        Hits and misses are also counted by the hits_metric and
+        misses_metric counters, if given.'''
+
+    def __init__(self, maxsize=1024, ttl=3600, directory=None,
+                 hits_metric=None, misses_metric=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self.hits_metric = hits_metric
+        self.misses_metric = misses_metric
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+
+    def _filename(self, key):
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest + '.json')
+
+    def _read_file(self, key):
+        filename = self._filename(key)
+        try:
+            expires = os.path.getmtime(filename) + self.ttl
+            if expires < time.time():
+                os.remove(filename)
+                return None
+            with open(filename, 'r') as infile:
+                data = json.load(infile)
+            if data.get('key') != key:
+                return None
+            return (expires, data['value'])
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+    def _write_file(self, key, value):
+        filename = self._filename(key)
+        tmpname = '{}.{}.{}.tmp'.format(
+            filename, os.getpid(), threading.get_ident())
+        try:
+            with open(tmpname, 'w') as outfile:
+                json.dump({'key': key, 'value': value}, outfile)
+            os.replace(tmpname, filename)
+        except (IOError, OSError) as e:
+            log.warning('[TTLCache] Cannot write {}: {}'.format(filename, e))
+
+    def _store(self, key, expires, value):
+        self._data[key] = (expires, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] < now:
+                del self._data[key]
+                entry = None
+            if entry is not None:
+                self._data.move_to_end(key)
+                self._count_hit()
+                return entry[1]
+        if self.directory is not None:
+            entry = self._read_file(key)
+            if entry is not None:
+                with self._lock:
+                    self._store(key, entry[0], entry[1])
+                    self._count_hit()
+                return entry[1]
+        with self._lock:
+            self.misses += 1
+        if self.misses_metric is not None:
+            self.misses_metric.inc()
+        return default
+
+    def _count_hit(self):
+        self.hits += 1
+        if self.hits_metric is not None:
+            self.hits_metric.inc()
+
+    def set(self, key, value):
+        with self._lock:
+            self._store(key, time.time() + self.ttl, value)
+        if self.directory is not None:
+            self._write_file(key, value)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'hits': self.hits,
+                'misses': self.misses
+            }
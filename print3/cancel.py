@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+''' Cancellation of the running print jobs
+
+    Every running job has a JobControl. Cancelling it drops the pages and
+    lookups not started yet, and shuts down the connections to tomcat of
+    the pages being printed, so that their requests fail at once.
+
+    /printcancel cancels the jobs of its own process in memory. The jobs
+    running in other processes see the cancel file it also writes: every
+    runner looks for the cancel files of its running jobs, and only them,
+    every CANCEL_POLL_INTERVAL, less often for the jobs with no page
+    pending. Jobs of the shared job queue are also marked cancelled in the
+    queue directory, which their runner lists once for all its jobs.'''
+
+import socket
+import threading
+from contextlib import contextmanager
+
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+import logging
+log = logging.getLogger(__name__)
+
+
+_local = threading.local()
+
+
+def _shutdown(connection):
+    sock = getattr(connection, 'sock', None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class JobControl(object):
+
+    def __init__(self, jobid, cancelfile=None, lease=None):
+        self.jobid = jobid
+        self.cancelfile = cancelfile
+        # JobLease of jobs claimed from the shared queue
+        self.lease = lease
+        # Stopped by the exit of its worker, not by the user
+        self.abandoned = False
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._futures = set()
+        self._connections = set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    @property
+    def idle(self):
+        ''' The job has no page or lookup pending, nor request in flight '''
+        with self._lock:
+            return not self._futures and not self._connections
+
+    @property
+    def lost(self):
+        ''' The job was claimed again by another runner '''
+        return self.lease is not None and self.lease.lost
+
+    def add_future(self, future):
+        ''' Future of the job, cancelled with it '''
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._discard_future)
+        if self.cancelled:
+            future.cancel()
+        return future
+
+    def _discard_future(self, future):
+        with self._lock:
+            self._futures.discard(future)
+
+    def _add_connection(self, connection):
+        with self._lock:
+            self._connections.add(connection)
+        if self.cancelled:
+            _shutdown(connection)
+
+    @contextmanager
+    def attached(self):
+        ''' Connections used by the current thread within the block belong
+            to the job, and are shut down if it is cancelled '''
+        _local.control = self
+        _local.connections = []
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._connections.difference_update(_local.connections)
+            _local.control = None
+            _local.connections = []
+
+    def cancel(self):
+        ''' Returns False if the job was already cancelled '''
+        if self._event.is_set():
+            return False
+        self._event.set()
+        with self._lock:
+            futures = list(self._futures)
+            connections = list(self._connections)
+        for future in futures:
+            future.cancel()
+        for connection in connections:
+            _shutdown(connection)
+        log.info('[Job {}] Cancelled, {} pending calls dropped, {} '
+                 'requests aborted'.format(
+                     self.jobid, len(futures), len(connections)))
+        return True
+
+    def abandon(self):
+        ''' Cancels a job whose worker is exiting '''
+        self.abandoned = True
+        return self.cancel()
+
+
+def _attach(connection):
+    control = getattr(_local, 'control', None)
+    if control is not None:
+        _local.connections.append(connection)
+        control._add_connection(connection)
+
+
+def _cancellable_pool(pool_class):
+    base = pool_class.ConnectionCls
+
+    class Connection(base):
+
+        def connect(self):
+            super(Connection, self).connect()
+            _attach(self)
+
+        def request(self, *args, **kwargs):
+            _attach(self)
+            return super(Connection, self).request(*args, **kwargs)
+
+    return type(pool_class.__name__, (pool_class,),
+                {'ConnectionCls': Connection})
+
+
+_POOL_CLASSES = {
+    'http': _cancellable_pool(HTTPConnectionPool),
+    'https': _cancellable_pool(HTTPSConnectionPool)
+}
+
+
+def cancellable(session):
+    ''' Makes the requests of session abortable by JobControl.cancel '''
+    for adapter in session.adapters.values():
+        adapter.poolmanager.pool_classes_by_scheme = _POOL_CLASSES
+    return session
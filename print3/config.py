@@ -1,3 +1,5 @@
+import os
+import multiprocessing
 
 MAPFISH_FILE_PREFIX = 'mapfish-print'
 MAPFISH_MULTI_FILE_PREFIX = MAPFISH_FILE_PREFIX + '-multi'
@@ -6,3 +8,149 @@ VERIFY_SSL = False
 LOG_SPEC_FILES = False
 REFERER_URL = 'https://map.geo.admin.ch'
 USE_LV95_SERVICES = False
+# gunicorn worker class: 'gthread', 'gevent' (cooperative, the standard
+# library is monkey patched before the app is loaded) or 'sync'. The jobs
+# run in the workers: with gevent, merges, spec scans and PDF copies block
+# the other requests of the worker while they run
+WORKER_CLASS = os.environ.get('PRINT_WORKER_CLASS', 'gthread')
+# Concurrent requests served by each gevent worker
+WORKER_CONNECTIONS = int(os.environ.get('PRINT_WORKER_CONNECTIONS', 1000))
+# Threads of each gthread worker
+WORKER_THREADS = int(os.environ.get('PRINT_WORKER_THREADS', 16))
+# Long-lived requests (progress long-polls and event streams, downloads of
+# running jobs) served at the same time by each worker, so that they do not
+# hold all the threads of a gthread worker. Beyond, long-polls and event
+# streams answer at once and are asked to come back after
+# LONG_REQUEST_RETRY_AFTER (seconds), downloads are refused (503).
+MAX_LONG_REQUESTS = int(os.environ.get(
+    'PRINT_MAX_LONG_REQUESTS',
+    {'gthread': WORKER_THREADS // 2,
+     'gevent': WORKER_CONNECTIONS // 2}.get(WORKER_CLASS, 0)))
+LONG_REQUEST_RETRY_AFTER = 5
+# Multipages jobs processed at the same time by each worker
+MAX_CONCURRENT_JOBS = int(os.environ.get('PRINT_MAX_CONCURRENT_JOBS', 2))
+# Page requests sent at the same time to tomcat by each worker
+MAX_BACKEND_CALLS = int(os.environ.get(
+    'PRINT_MAX_BACKEND_CALLS', multiprocessing.cpu_count()))
+# Jobs admitted by each worker and not over yet, jobs of a same client
+# (0: no quota), and pages waiting for tomcat above which new jobs are
+# refused (429), to be posted again after ADMISSION_RETRY_AFTER (seconds)
+MAX_ADMITTED_JOBS = int(os.environ.get(
+    'PRINT_MAX_ADMITTED_JOBS', 4 * MAX_CONCURRENT_JOBS))
+MAX_CLIENT_JOBS = int(os.environ.get('PRINT_MAX_CLIENT_JOBS', 2))
+MAX_PENDING_PAGES = int(os.environ.get(
+    'PRINT_MAX_PENDING_PAGES', 50 * MAX_BACKEND_CALLS))
+ADMISSION_RETRY_AFTER = 10
+# Clients of the quotas: 'address' (client address) or 'referer' (host of
+# the referer)
+QUOTA_BY = os.environ.get('PRINT_QUOTA_BY', 'address')
+# Networks of the proxies in front of the app (nginx, load balancer). The
+# client address is the last X-Forwarded-For address not in them.
+TRUSTED_PROXIES = os.environ.get(
+    'PRINT_TRUSTED_PROXIES', '127.0.0.0/8,10.220.0.0/21').split(',')
+# Concurrent calls to the api (e.g. url shortening) by each worker
+MAX_LOOKUP_CALLS = int(os.environ.get('PRINT_MAX_LOOKUP_CALLS', 8))
+# Jobs cancelled by another process are stopped within (seconds), or
+# within CANCEL_MAX_POLL_INTERVAL while they have no page pending
+CANCEL_POLL_INTERVAL = float(os.environ.get('PRINT_CANCEL_POLL_INTERVAL', 1))
+CANCEL_MAX_POLL_INTERVAL = float(
+    os.environ.get('PRINT_CANCEL_MAX_POLL_INTERVAL', 8))
+# Connect and read timeouts (seconds) of a single page request to tomcat
+BACKEND_TIMEOUT = (
+    float(os.environ.get('PRINT_BACKEND_CONNECT_TIMEOUT', 5)),
+    float(os.environ.get('PRINT_BACKEND_READ_TIMEOUT', 300)))
+# Specs larger than (bytes) are spooled to a temporary file, in
+# SPEC_SPOOL_DIR (default: the system temp dir), instead of being parsed in
+# memory. Their values larger than SPEC_INLINE_SIZE stay in the file.
+SPEC_SPOOL_SIZE = int(os.environ.get('PRINT_SPEC_SPOOL_SIZE', 1024 * 1024))
+SPEC_SPOOL_DIR = os.environ.get('PRINT_SPEC_SPOOL_DIR')
+SPEC_INLINE_SIZE = 64 * 1024
+# Printed pages are cached in this sub directory of the print temp dir, up
+# to (bytes) per process before the least recently used are removed. 0
+# disables the cache.
+PDF_CACHE_DIR = 'pdfcache'
+PDF_CACHE_SIZE = int(os.environ.get('PRINT_PDF_CACHE_SIZE', 1024 ** 3))
+# Cached pages are printed again once older than (seconds): they hold the
+# date of their print and the data of the layers at that time
+PDF_CACHE_MAX_AGE = int(os.environ.get('PRINT_PDF_CACHE_MAX_AGE', 3600))
+# Where the multipages jobs are queued: 'local' (in the memory of the
+# process receiving them) or 'file' (in the JOB_QUEUE_DIR sub directory of
+# the print temp dir, shared by all the containers, see FileJobQueue)
+JOB_QUEUE = os.environ.get('PRINT_JOB_QUEUE', 'local')
+JOB_QUEUE_DIR = 'jobs'
+# Runners look for queued jobs every (seconds), twice less often every
+# time they found none, down to every JOB_QUEUE_MAX_POLL_INTERVAL
+JOB_QUEUE_POLL_INTERVAL = 1
+JOB_QUEUE_MAX_POLL_INTERVAL = 8
+# Running jobs renew their lease every JOB_LEASE_HEARTBEAT (seconds), jobs
+# whose lease is older than JOB_LEASE_TTL are claimed again
+JOB_LEASE_HEARTBEAT = 10
+JOB_LEASE_TTL = int(os.environ.get('PRINT_JOB_LEASE_TTL', 60))
+JOB_MAX_ATTEMPTS = 3
+# Exiting workers wait for their running jobs up to JOB_DRAIN_TIMEOUT
+# (seconds, below the timeout of gunicorn), then stop them and wait
+# JOB_DRAIN_GRACE more for them to publish their state
+JOB_DRAIN_TIMEOUT = float(os.environ.get('PRINT_JOB_DRAIN_TIMEOUT', 20))
+JOB_DRAIN_GRACE = 2
+# Merged PDFs are copied to this local directory before being served, up to
+# (bytes) per process before the least recently served are removed. None
+# serves them from the print temp dir.
+DOWNLOAD_STAGING_DIR = os.environ.get('PRINT_DOWNLOAD_STAGING_DIR')
+DOWNLOAD_STAGING_SIZE = int(os.environ.get(
+    'PRINT_DOWNLOAD_STAGING_SIZE', 10 * 1024 ** 3))
+# PDFs of running jobs are sent by chunks of up to (bytes)
+STREAM_CHUNK_SIZE = 64 * 1024
+# A PDF shorter than the size published by its job is opened again up to
+# (times), before the response is aborted
+STREAM_REOPEN_RETRIES = 5
+# Internal nginx location of DOWNLOAD_STAGING_DIR. If set, staged PDFs are
+# sent by nginx (X-Accel-Redirect) rather than by the app.
+DOWNLOAD_ACCEL_PREFIX = os.environ.get('PRINT_DOWNLOAD_ACCEL_PREFIX')
+# Page requests taking longer (seconds) reduce the page requests in flight
+BACKEND_LATENCY_TARGET = float(
+    os.environ.get('PRINT_BACKEND_LATENCY_TARGET', 30))
+# Failed pages are printed again up to PAGE_RETRIES times, after a random
+# delay up to RETRY_BACKOFF * 2^attempt (at most RETRY_BACKOFF_MAX) seconds
+PAGE_RETRIES = int(os.environ.get('PRINT_PAGE_RETRIES', 2))
+RETRY_BACKOFF = 1
+RETRY_BACKOFF_MAX = 30
+# Write the fonts, images shared by the pages only once in merged documents
+DEDUPLICATE_PDF_RESOURCES = True
+# Where the progress of the jobs is published: 'file' (info file in the
+# print temp dir) or 'memory' (single process only)
+PROGRESS_BACKEND = os.environ.get('PRINT_PROGRESS_BACKEND', 'file')
+# Progress of jobs running in other processes is read again every (seconds)
+PROGRESS_POLL_INTERVAL = 0.5
+# Long-poll requests wait at most (seconds) for a change
+PROGRESS_LONGPOLL_TIMEOUT = 25
+# Comment sent on idle progress event streams, every (seconds)
+PROGRESS_HEARTBEAT = 15
+# Progress event streams are closed after (seconds), clients connect again
+# with the id of the last event they got
+PROGRESS_STREAM_MAX_TIME = 300
+# Every process writes a snapshot of its metrics to this sub directory of
+# the print temp dir, every METRICS_INTERVAL (seconds). The gauges of the
+# processes silent for METRICS_STALE are ignored, their snapshots are
+# removed after METRICS_TTL.
+METRICS_DIR = 'metrics'
+METRICS_INTERVAL = 5
+METRICS_STALE = 3 * METRICS_INTERVAL
+METRICS_TTL = 24 * 3600
+# Releases of ch.swisstopo.zeitreihen per extent, cached for (seconds)
+RELEASES_CACHE_TTL = int(os.environ.get('PRINT_RELEASES_CACHE_TTL', 3600))
+RELEASES_CACHE_SIZE = 1024
+# Directory to share the cached releases between the processes, if any
+RELEASES_CACHE_DIR = os.environ.get('PRINT_RELEASES_CACHE_DIR')
+# Short links never change, cached for (seconds)
+SHORTEN_CACHE_TTL = 24 * 3600
+SHORTEN_CACHE_SIZE = 4096
+SHORTEN_TIMEOUT = float(os.environ.get('PRINT_SHORTEN_TIMEOUT', 5))
+SHORTEN_API_URL = os.environ.get(
+    'PRINT_SHORTEN_API_URL', 'http://api3.geo.admin.ch')
+# Files of the jobs are deleted after (seconds)
+FILES_TTL = 3600
+# The janitor deletes at most JANITOR_BATCH files every JANITOR_INTERVAL
+JANITOR_INTERVAL = 10
+JANITOR_BATCH = 100
+# Leftovers of dead processes are looked for every (seconds)
+JANITOR_SWEEP_INTERVAL = 3600
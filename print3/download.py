@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+''' Staging of the merged PDFs to the local disk, before they are served
+
+    Merged PDFs are written to the print temp dir, on the EFS. Downloads,
+    and the retries and byte ranges of resumed downloads, are served from a
+    copy on the local disk (and in the page cache), made on first download.
+    Copies keep the modification time of their source, so that their
+    Last-Modified and ETag are the same on every container.
+
+    The access time of copies is set when they are served. Once the copies
+    of a process exceed max_size, the least recently served ones are
+    removed, until they take 90% of max_size.'''
+
+import os
+import time
+import shutil
+import threading
+
+from print3.config import DOWNLOAD_STAGING_DIR, DOWNLOAD_STAGING_SIZE
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class DownloadStage(object):
+
+    def __init__(self, directory, max_size=DOWNLOAD_STAGING_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self._size = None
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def stage(self, source):
+        ''' Returns the path of the local copy of source '''
+        path = os.path.join(self.directory, os.path.basename(source))
+        stat = os.stat(source)
+        try:
+            local = os.stat(path)
+            if local.st_size == stat.st_size and \
+                    local.st_mtime_ns == stat.st_mtime_ns:
+                # Access time of the copy is its last use, see evict
+                os.utime(path, ns=(time.time_ns(), stat.st_mtime_ns))
+                return path
+        except OSError:
+            pass
+        tmpname = '{}.{}.{}.tmp'.format(
+            path, os.getpid(), threading.get_ident())
+        try:
+            # copy_file_range/sendfile, no copy through user space
+            shutil.copyfile(source, tmpname)
+            os.utime(tmpname, ns=(time.time_ns(), stat.st_mtime_ns))
+            os.replace(tmpname, path)
+        except OSError:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+            raise
+        log.debug('[DownloadStage] {} staged to {}'.format(source, path))
+        with self._lock:
+            if self._size is not None:
+                self._size += stat.st_size
+            full = self._size is None or self._size > self.max_size
+        if full:
+            self.evict()
+        return path
+
+    def evict(self):
+        ''' Removes the least recently served copies, if over max_size '''
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.tmp'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_atime, stat.st_size, entry.path))
+        size = sum(e[1] for e in entries)
+        if size > self.max_size:
+            entries.sort()
+            for atime, entry_size, path in entries:
+                if size <= self.max_size * 0.9:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                size -= entry_size
+        with self._lock:
+            self._size = size
+
+
+_stage = None
+_stage_lock = threading.Lock()
+
+
+def get_download_stage():
+    ''' Returns the download stage, None if PDFs are served from the
+        print temp dir '''
+    global _stage
+    if not DOWNLOAD_STAGING_DIR:
+        return None
+    with _stage_lock:
+        if _stage is None:
+            _stage = DownloadStage(DOWNLOAD_STAGING_DIR)
+        return _stage
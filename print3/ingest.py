@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+
+''' Loading of large print specs without holding them in memory
+
+    Bodies larger than SPEC_SPOOL_SIZE are copied block by block to a
+    temporary file. Only the structure of the spec is parsed: the values
+    larger than SPEC_INLINE_SIZE (the features of the vector layers) are
+    validated by the C scanner of the json module, a window of the body at
+    a time, and left in the file as RawJSON values.
+    Page requests read them back block by block while they are sent.'''
+
+import os
+import re
+import json
+import mmap
+import codecs
+import tempfile
+from json.scanner import make_scanner
+
+from print3.config import SPEC_INLINE_SIZE, SPEC_SPOOL_DIR
+
+BLOCK_SIZE = 64 * 1024
+# Part of the body decoded at a time for the scanner (bytes)
+WINDOW_SIZE = 64 * 1024
+# Pages of the mapped body dropped from memory once scanned, by (bytes)
+RELEASE_SIZE = 4 * 1024 * 1024
+
+_WS = re.compile(br'[ \t\n\r]*')
+_STRING = re.compile(
+    br'"(?:[^"\\\x00-\x1f]+|\\["\\/bfnrt]|\\u[0-9a-fA-F]{4})*"')
+_KEY = re.compile(_STRING.pattern + br'[ \t\n\r]*:[ \t\n\r]*')
+_NEXT = re.compile(br'[ \t\n\r]*(?:,[ \t\n\r]*|(?P<close>[\]}]))')
+_SCALAR_RE = (br'-?(?:0|[1-9][0-9]*)(?:[.][0-9]+)?(?:[eE][-+]?[0-9]+)?|'
+              br'true|false|null')
+_SCALAR = re.compile(_SCALAR_RE)
+# Runs of arrays of scalars (coordinates) with the comma following them,
+# checked at once. Runs are bounded, the regex engine keeps a state per
+# repetition.
+_FLAT_ARRAYS = re.compile(
+    br'(?:\[[ \t\n\r]*(?:(?:' + _SCALAR_RE + br')[ \t\n\r]*'
+    br'(?:,[ \t\n\r]*(?:' + _SCALAR_RE + br')[ \t\n\r]*)*)?\]'
+    br'[ \t\n\r]*,[ \t\n\r]*){1,256}')
+# Accepts what json.loads accepts, the values it builds are dropped
+_scan_once = make_scanner(json.JSONDecoder())
+
+
+class RawJSON(object):
+    ''' JSON value left in the spooled body '''
+
+    def __init__(self, source, start, end):
+        self.source = source
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __iter__(self):
+        for offset in range(self.start, self.end, BLOCK_SIZE):
+            yield self.source.read(offset, min(BLOCK_SIZE, self.end - offset))
+
+    def __repr__(self):
+        return '<RawJSON {} bytes>'.format(len(self))
+
+    def load(self):
+        return json.loads(self.source.read(self.start, len(self)))
+
+
+def _skip_ws(buf, pos):
+    return _WS.match(buf, pos).end()
+
+
+def _release(buf, upto):
+    if isinstance(buf, mmap.mmap):
+        buf.madvise(mmap.MADV_DONTNEED, 0, upto - upto % mmap.PAGESIZE)
+
+
+class _Scanner(object):
+    ''' Finds the end of the JSON values of a buffer, checking them with the
+        C scanner of the json module
+
+        The buffer is decoded a window at a time, byte for byte (latin-1),
+        so offsets in the window are offsets in the buffer. Containers
+        larger than a window are checked item by item. '''
+
+    def __init__(self, buf, window_size=WINDOW_SIZE):
+        self.buf = buf
+        self.size = len(buf)
+        self.window_size = window_size
+        self.start = self.end = self.released = 0
+        self.window = ''
+
+    def _fill(self, pos):
+        self.start = pos
+        self.end = min(pos + self.window_size, self.size)
+        self.window = self.buf[pos:self.end].decode('latin-1')
+        if pos - self.released > RELEASE_SIZE:
+            _release(self.buf, pos)
+            self.released = pos
+
+    def _scan(self, pos):
+        ''' Returns the end of the value at pos, None if it may not be in
+            the window '''
+        try:
+            end = _scan_once(self.window, pos - self.start)[1] + self.start
+        except (StopIteration, ValueError, RecursionError):
+            end = None
+        if self.end < self.size and (end is None or end == self.end):
+            # A number may go on after the window
+            return None
+        if end is None:
+            raise ValueError('Invalid JSON value at {}'.format(pos))
+        return end
+
+    def value_end(self, pos):
+        ''' Returns the end of the JSON value starting at pos '''
+        if pos < self.start or (self.end < self.size and
+                                self.end - pos < self.window_size // 2):
+            self._fill(pos)
+        end = self._scan(pos)
+        if end is None and pos != self.start:
+            self._fill(pos)
+            end = self._scan(pos)
+        if end is not None:
+            return end
+        c = self.buf[pos:pos + 1]
+        if c in (b'{', b'['):
+            return self._container_end(pos)
+        m = (_STRING if c == b'"' else _SCALAR).match(self.buf, pos)
+        if m is None:
+            raise ValueError('Invalid JSON value at {}'.format(pos))
+        return m.end()
+
+    def _container_end(self, pos):
+        ''' Returns the end of the container at pos, larger than the window '''
+        buf = self.buf
+        is_object = buf[pos:pos + 1] == b'{'
+        closing = b'}' if is_object else b']'
+        pos = _skip_ws(buf, pos + 1)
+        if buf[pos:pos + 1] == closing:
+            return pos + 1
+        # Items of arrays are alike, runs of coordinates are looked for as
+        # long as there are some
+        flat = not is_object
+        while True:
+            if is_object:
+                m = _KEY.match(buf, pos)
+                if m is None:
+                    raise ValueError('Invalid JSON key at {}'.format(pos))
+                pos = m.end()
+            elif flat:
+                m = _FLAT_ARRAYS.match(buf, pos)
+                if m is not None:
+                    pos = m.end()
+                    continue
+                flat = False
+            end = self.value_end(pos)
+            m = _NEXT.match(buf, end)
+            if m is None:
+                raise ValueError('Expected "," at {}'.format(end))
+            if m.lastgroup is not None:
+                if m.group('close') != closing:
+                    raise ValueError('Unexpected {} at {}'.format(
+                        m.group('close'), m.start('close')))
+                return m.end()
+            pos = m.end()
+
+
+def _load(source, scanner, pos, depth, inline_size):
+    ''' Returns the JSON value at pos and its end. Containers are parsed
+        down to depth levels, the deeper values larger than inline_size are
+        left in source. '''
+    buf = scanner.buf
+    c = buf[pos:pos + 1]
+    if depth == 0 or c not in (b'{', b'['):
+        end = scanner.value_end(pos)
+        if end - pos > inline_size:
+            return (RawJSON(source, pos, end), end)
+        return (json.loads(buf[pos:end]), end)
+
+    is_object = c == b'{'
+    closing = b'}' if is_object else b']'
+    value = {} if is_object else []
+    pos = _skip_ws(buf, pos + 1)
+    if buf[pos:pos + 1] == closing:
+        return (value, pos + 1)
+    while True:
+        if is_object:
+            m = _STRING.match(buf, pos)
+            if m is None:
+                raise ValueError('Invalid JSON key at {}'.format(pos))
+            key = json.loads(buf[m.start():m.end()])
+            pos = _skip_ws(buf, m.end())
+            if buf[pos:pos + 1] != b':':
+                raise ValueError('Expected ":" at {}'.format(pos))
+            pos = _skip_ws(buf, pos + 1)
+        item, end = _load(source, scanner, pos, depth - 1, inline_size)
+        if is_object:
+            value[key] = item
+        else:
+            value.append(item)
+        pos = _skip_ws(buf, end)
+        c = buf[pos:pos + 1]
+        if c == closing:
+            return (value, pos + 1)
+        if c != b',':
+            raise ValueError('Expected "," at {}'.format(pos))
+        pos = _skip_ws(buf, pos + 1)
+
+
+class SpooledSpec(object):
+    ''' Body of a print request, copied to a temporary file '''
+
+    def __init__(self, stream, directory=SPEC_SPOOL_DIR):
+        self._file = tempfile.TemporaryFile(dir=directory)
+        # The scanner reads the body byte for byte, its encoding is checked
+        # while it is copied
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        self.utf8 = True
+        while True:
+            block = stream.read(BLOCK_SIZE)
+            if self.utf8:
+                try:
+                    decoder.decode(block, final=not block)
+                except UnicodeDecodeError:
+                    self.utf8 = False
+            if not block:
+                break
+            self._file.write(block)
+        self._file.flush()
+        self.size = self._file.tell()
+
+    def read(self, offset, size):
+        return os.pread(self._file.fileno(), size, offset)
+
+    def load(self, inline_size=SPEC_INLINE_SIZE):
+        ''' Returns the spec. Its layers and their members are parsed, the
+            members larger than inline_size are left in the file. '''
+        if self.size == 0:
+            raise ValueError('Empty spec')
+        if not self.utf8:
+            raise ValueError('Spec is not UTF-8')
+        with mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            start = _skip_ws(buf, 0)
+            if buf[start:start + 1] != b'{':
+                raise ValueError('Spec is not a JSON object')
+            try:
+                spec, end = _load(self, _Scanner(buf, WINDOW_SIZE), start, 3,
+                                  inline_size)
+            except RecursionError:
+                raise ValueError('Spec nested too deeply')
+            if _skip_ws(buf, end) != self.size:
+                raise ValueError('Extra data after the spec')
+            return spec
+
+    def save(self, filename):
+        ''' Copies the body to filename '''
+        with open(filename, 'wb') as outfile:
+            for offset in range(0, self.size, BLOCK_SIZE):
+                outfile.write(self.read(offset, BLOCK_SIZE))
+
+    def close(self):
+        self._file.close()
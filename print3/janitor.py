@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+''' Removal of the files of the print jobs, off the request path
+
+    Every job registers its files (info, merged PDF, cancel file, partial
+    pages) with the janitor of its process, together with their expiry.
+    A background thread deletes the expired files by bounded batches.
+
+    Files of jobs that died with their process are found by a sweep of the
+    print temp dir, done by one process at a time, at most once per sweep
+    interval, and also in bounded batches. The sweep also removes the
+    expired entries of the caches shared on disk.'''
+
+import os
+import re
+import time
+import heapq
+import threading
+
+from print3.config import MAPFISH_FILE_PREFIX, FILES_TTL, JANITOR_BATCH, \
+    JANITOR_INTERVAL, JANITOR_SWEEP_INTERVAL, RELEASES_CACHE_DIR, \
+    RELEASES_CACHE_TTL
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# Files of the multipages jobs and links to their cached pages. The partial
+# pages written by tomcat are named like its single page prints, they are
+# left to the cleanup of tomcat outputs if their job died.
+PRINT_FILES = re.compile(
+    r'^' + re.escape(MAPFISH_FILE_PREFIX) +
+    r'(-multi\d+[.]|\d+[.]\d+[.]cached[.]pdf$)')
+SWEEP_LOCK = MAPFISH_FILE_PREFIX + '-janitor.lock'
+# Directories of the caches shared on disk, with the ttl of their entries
+SHARED_CACHES = ((RELEASES_CACHE_DIR, RELEASES_CACHE_TTL),)
+
+
+class Janitor(object):
+
+    def __init__(self, print_temp_dir, ttl=FILES_TTL, batch=JANITOR_BATCH,
+                 interval=JANITOR_INTERVAL,
+                 sweep_interval=JANITOR_SWEEP_INTERVAL, caches=SHARED_CACHES):
+        self.print_temp_dir = print_temp_dir
+        self.ttl = ttl
+        self.caches = [(directory, cache_ttl) for directory, cache_ttl
+                       in caches if directory]
+        self.batch = batch
+        self.interval = interval
+        self.sweep_interval = sweep_interval
+        self.deleted = 0
+        self._expiries = []
+        self._lock = threading.Lock()
+        self._sweep = None
+        self._thread = None
+
+    def register(self, paths, ttl=None):
+        ''' Files to delete in ttl seconds (default FILES_TTL) '''
+        expiry = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            for path in paths:
+                heapq.heappush(self._expiries, (expiry, path))
+
+    def pending(self):
+        with self._lock:
+            return len(self._expiries)
+
+    def _delete(self, path):
+        try:
+            os.remove(path)
+            self.deleted += 1
+        except OSError:
+            pass
+
+    def delete_expired(self):
+        ''' Deletes at most batch expired files, returns their number '''
+        now = time.time()
+        expired = []
+        with self._lock:
+            while self._expiries and len(expired) < self.batch and \
+                    self._expiries[0][0] <= now:
+                expired.append(heapq.heappop(self._expiries)[1])
+        for path in expired:
+            self._delete(path)
+        return len(expired)
+
+    def _start_sweep(self):
+        ''' Returns True if this process should sweep the print temp dir '''
+        lockfile = os.path.join(self.print_temp_dir, SWEEP_LOCK)
+        try:
+            if time.time() - os.path.getmtime(lockfile) < self.sweep_interval:
+                return False
+        except OSError:
+            pass
+        try:
+            with open(lockfile, 'a'):
+                os.utime(lockfile, None)
+        except OSError:
+            return False
+        return True
+
+    def _sweep_dir(self, directory, ttl, pattern=None):
+        cutoff = time.time() - ttl
+        for entry in os.scandir(directory):
+            if pattern is None or pattern.match(entry.name):
+                try:
+                    if entry.is_file() and entry.stat().st_mtime < cutoff:
+                        self._delete(entry.path)
+                except OSError:
+                    pass
+            yield
+
+    def _sweeper(self):
+        yield from self._sweep_dir(self.print_temp_dir, self.ttl, PRINT_FILES)
+        for directory, ttl in self.caches:
+            try:
+                yield from self._sweep_dir(directory, ttl)
+            except OSError as e:
+                log.warning('[Janitor] Cannot sweep {}: {}'.format(
+                    directory, e))
+
+    def sweep(self):
+        ''' Looks at most at batch files of the print temp dir for leftovers
+            older than ttl. Returns False once the sweep is over. '''
+        if self._sweep is None:
+            if not self._start_sweep():
+                return False
+            self._sweep = self._sweeper()
+        for i in range(self.batch):
+            try:
+                next(self._sweep)
+            except (StopIteration, OSError):
+                self._sweep = None
+                return False
+        return True
+
+    def run_once(self):
+        self.delete_expired()
+        self.sweep()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.run_once()
+            except Exception as e:
+                log.error('[Janitor] Error while deleting files: {}'.format(e))
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run,
+                                            name='print-janitor')
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+
+_janitors = {}
+_janitors_lock = threading.Lock()
+
+
+def get_janitor(print_temp_dir):
+    ''' Returns the running janitor of print_temp_dir for this process '''
+    with _janitors_lock:
+        key = (os.getpid(), print_temp_dir)
+        if key not in _janitors:
+            _janitors[key] = Janitor(print_temp_dir).start()
+        return _janitors[key]
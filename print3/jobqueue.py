@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+
+''' Durable queue of the multipages jobs, shared by all the containers
+
+    Jobs are files in a sub directory of the (shared) print temp dir, so
+    that they outlive the process which received them. Every runner claims
+    queued jobs whenever one of its job threads is free, so jobs go to the
+    containers with spare capacity.
+
+    A runner holds a job by a lease, a file whose modification time is
+    renewed every JOB_LEASE_HEARTBEAT while the job runs. Leases are
+    numbered: claiming a job creates the lease following the current one,
+    exclusively, so only one runner gets it. A job whose lease was not
+    renewed for JOB_LEASE_TTL is orphaned (its container went away), and is
+    claimed again, at most JOB_MAX_ATTEMPTS times.
+
+    The queue is shared by every worker of every container, so claiming
+    lists its directory once, and looks at the age of the leases at most
+    every JOB_LEASE_HEARTBEAT.
+
+    Cancelled jobs are marked by a file next to their lease. The runners
+    list the directory once to find the cancelled ones among their jobs.'''
+
+import os
+import json
+import time
+import threading
+
+from print3.config import JOB_QUEUE, JOB_QUEUE_DIR, JOB_LEASE_TTL, \
+    JOB_LEASE_HEARTBEAT
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class JobLease(object):
+    ''' Claim of a queued job by the current process '''
+
+    def __init__(self, queue, jobid, attempt, payload):
+        self.queue = queue
+        self.jobid = jobid
+        self.attempt = attempt
+        self.payload = payload
+        self.lost = False
+        self.renewed = time.time()
+
+    @property
+    def path(self):
+        return self.queue._lease_path(self.jobid, self.attempt)
+
+    @property
+    def spec_file(self):
+        return self.queue._path(self.jobid, 'spec')
+
+    def renew(self):
+        ''' Heartbeat of the running job. Returns False if the lease was
+            lost, i.e. the job was claimed again by another runner. '''
+        if self.lost:
+            return False
+        # Claiming the job again creates the next lease
+        if os.path.exists(self.queue._lease_path(self.jobid, self.attempt + 1)):
+            self.lost = True
+            return False
+        try:
+            os.utime(self.path, None)
+        except OSError:
+            self.lost = True
+            return False
+        self.renewed = time.time()
+        return True
+
+    def release(self):
+        ''' The job is over, removes it from the queue '''
+        if self.renew():
+            self.queue._remove(self.jobid)
+
+
+class FileJobQueue(object):
+
+    def __init__(self, print_temp_dir, lease_ttl=JOB_LEASE_TTL,
+                 lease_check_interval=JOB_LEASE_HEARTBEAT):
+        self.directory = os.path.join(print_temp_dir, JOB_QUEUE_DIR)
+        self.lease_ttl = lease_ttl
+        self.lease_check_interval = lease_check_interval
+        self._leases_checked = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, jobid, kind):
+        return os.path.join(self.directory, '{}.{}'.format(jobid, kind))
+
+    def _lease_path(self, jobid, attempt):
+        return self._path(jobid, 'lease.{}'.format(attempt))
+
+    def _leases(self, jobid):
+        prefix = jobid + '.lease.'
+        leases = []
+        for name in os.listdir(self.directory):
+            if name.startswith(prefix) and name[len(prefix):].isdigit():
+                leases.append(int(name[len(prefix):]))
+        return leases
+
+    def _scan(self):
+        ''' Returns (jobid, number of its current lease, 0 if never
+            claimed) of the jobs queued or running, oldest first '''
+        jobs = set()
+        leases = {}
+        for name in os.listdir(self.directory):
+            if name.endswith('.job'):
+                jobs.add(name[:-len('.job')])
+                continue
+            jobid, sep, attempt = name.partition('.lease.')
+            if sep and attempt.isdigit():
+                leases[jobid] = max(leases.get(jobid, 0), int(attempt))
+        return [(jobid, leases.get(jobid, 0)) for jobid in sorted(jobs)]
+
+    def put(self, jobid, payload, spooled=None):
+        ''' Queues a job. The body of spooled specs is saved aside. '''
+        if spooled is not None:
+            spooled.save(self._path(jobid, 'spec'))
+        filename = self._path(jobid, 'job')
+        tmpname = '{}.{}.{}.tmp'.format(
+            filename, os.getpid(), threading.get_ident())
+        with open(tmpname, 'w') as outfile:
+            json.dump(payload, outfile)
+        os.replace(tmpname, filename)
+
+    def pending(self):
+        ''' Jobs queued or running '''
+        return [jobid for jobid, attempt in self._scan()]
+
+    def cancel(self, jobid):
+        ''' Marks a job cancelled, for the runner holding its lease.
+            Returns False if the job is not in the queue. '''
+        if not os.path.exists(self._path(jobid, 'job')):
+            return False
+        path = self._path(jobid, 'cancel')
+        with open(path, 'a'):
+            pass
+        if not os.path.exists(self._path(jobid, 'job')):
+            # Done in the meantime, its files were removed
+            os.remove(path)
+            return False
+        return True
+
+    def cancelled(self):
+        ''' Returns the ids of the jobs marked cancelled '''
+        return set(name[:-len('.cancel')]
+                   for name in os.listdir(self.directory)
+                   if name.endswith('.cancel'))
+
+    def claim(self):
+        ''' Returns the lease of the oldest job not running, None if
+            there is none '''
+        now = time.time()
+        check_leases = now - self._leases_checked >= self.lease_check_interval
+        if check_leases:
+            self._leases_checked = now
+        for jobid, attempt in self._scan():
+            if attempt:
+                if not check_leases:
+                    continue
+                try:
+                    age = time.time() - os.path.getmtime(
+                        self._lease_path(jobid, attempt))
+                except OSError:
+                    continue
+                if age < self.lease_ttl:
+                    continue
+            path = self._lease_path(jobid, attempt + 1)
+            try:
+                os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            except OSError:
+                # Claimed by another runner in the meantime
+                continue
+            try:
+                with open(self._path(jobid, 'job')) as infile:
+                    payload = json.load(infile)
+            except (IOError, ValueError):
+                # Done in the meantime
+                self._remove(jobid)
+                continue
+            if attempt:
+                log.warning('[FileJobQueue] Job {} orphaned, claimed again '
+                            '(attempt {})'.format(jobid, attempt + 1))
+            return JobLease(self, jobid, attempt + 1, payload)
+        return None
+
+    def _remove(self, jobid):
+        paths = [self._path(jobid, 'job'), self._path(jobid, 'spec'),
+                 self._path(jobid, 'cancel')]
+        paths.extend(self._lease_path(jobid, attempt)
+                     for attempt in self._leases(jobid))
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+def get_job_queue(print_temp_dir, backend=JOB_QUEUE):
+    ''' Returns the shared job queue, None if jobs are run by the process
+        receiving them (the default) '''
+    if backend != 'file':
+        return None
+    with _queues_lock:
+        if print_temp_dir not in _queues:
+            _queues[print_temp_dir] = FileJobQueue(print_temp_dir)
+        return _queues[print_temp_dir]
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+''' Adaptive bound of the page requests sent to tomcat
+
+    The number of requests in flight is adjusted AIMD style. The limit
+    grows by one once a whole limit of requests succeeded in time (additive
+    increase), and is halved when a request fails with a server error or a
+    timeout, or takes longer than latency_target (multiplicative decrease).
+    The requests sent before a decrease see the load of before it, so the
+    limit is decreased at most once per latency_target.'''
+
+import time
+import random
+import threading
+
+from print3.config import BACKEND_LATENCY_TARGET, RETRY_BACKOFF, \
+    RETRY_BACKOFF_MAX
+
+
+def backoff(attempt, base=RETRY_BACKOFF, cap=RETRY_BACKOFF_MAX):
+    ''' Delay before the retry attempt (1, 2...), exponential with full
+        jitter, so that failed pages are not retried all at once '''
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class AdaptiveLimiter(object):
+
+    def __init__(self, maximum, minimum=1, latency_target=BACKEND_LATENCY_TARGET):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.latency_target = latency_target
+        self.limit = float(maximum)
+        self._inflight = 0
+        self._last_decrease = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        ''' Waits until a request may be sent '''
+        with self._cond:
+            while self._inflight >= int(self.limit):
+                self._cond.wait()
+            self._inflight += 1
+
+    def release(self, latency=None, ok=True):
+        ''' A request is over. It took latency seconds, ok is False for
+            server errors and timeouts. latency is None for requests which
+            say nothing about the load of tomcat (e.g. cancelled). '''
+        with self._cond:
+            self._inflight -= 1
+            if latency is not None:
+                now = time.time()
+                if not ok or latency > self.latency_target:
+                    if now - self._last_decrease > self.latency_target:
+                        self.limit = max(self.minimum, self.limit / 2)
+                        self._last_decrease = now
+                else:
+                    self.limit = min(self.maximum,
+                                     self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {'limit': int(self.limit), 'inflight': self._inflight}
+
+
+class RequestSlots(object):
+    ''' Bound of the requests served at the same time, which are not waited
+        for: requests finding no free slot are answered another way '''
+
+    def __init__(self, maximum):
+        self.maximum = maximum
+        self._used = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        ''' Takes a slot, False if there is none free '''
+        with self._lock:
+            if self._used >= self.maximum:
+                return False
+            self._used += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self._used -= 1
+
+    def stats(self):
+        with self._lock:
+            return {'used': self._used, 'maximum': self.maximum}
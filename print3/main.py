@@ -6,34 +6,55 @@ import traceback
 import sys
 import urllib
 import json
-import copy
 import datetime
 import time
 import multiprocessing
 import random
-import subprocess
+import functools
+import threading
+import queue
+import ipaddress
+from concurrent.futures import Future
 from urllib.parse import urlsplit
 from urllib.parse import urlencode
-from retrying import retry
 
 
 import requests
-from flask import Flask, abort, Response, request
+from flask import Flask, abort, Response, request, send_file
 from requests.exceptions import Timeout, ConnectionError, SSLError
 
 from print3.utils import (
     _get_timestamps,
-    delete_old_files,
     _qrcodeurlparse,
     _qrcodeurlunparse,
     _shorten,
     create_pdf_path,
     create_info_file,
-    create_cancel_file,
-    _increment_info)
+    create_cancel_file)
+from print3.ingest import SpooledSpec
+from print3.admission import get_admission
+from print3.download import get_download_stage
+from print3.janitor import get_janitor
+from print3.jobqueue import get_job_queue
+from print3.limiter import backoff, RequestSlots
+from print3.merge import StreamingPdfMerger
+from print3.metrics import get_exporter, SPEC_PARSE_SECONDS, \
+    TIMESTAMPS_SECONDS, SHORTEN_SECONDS, PAGE_SECONDS, MERGE_SECONDS, JOBS, \
+    JOBS_FAILED, JOBS_CANCELLED, JOBS_REJECTED, PAGES, PAGES_CACHED, PAGES_FAILED, \
+    PAGE_RETRIES as PAGE_RETRIES_TOTAL, BACKEND_CALLS
+from print3.pdfcache import get_pdf_cache
+from print3.progress import get_progress_store, JobProgress, \
+    FINAL_STATUSES, progress_etag, wait_for_change
+from print3.runner import get_runner
+from print3.spec import PageSpecBuilder
 
 from print3.config import MAPFISH_FILE_PREFIX, MAPFISH_MULTI_FILE_PREFIX, \
-    USE_MULTIPROCESS, VERIFY_SSL, LOG_SPEC_FILES, REFERER_URL
+    USE_MULTIPROCESS, VERIFY_SSL, LOG_SPEC_FILES, REFERER_URL, \
+    BACKEND_TIMEOUT, PAGE_RETRIES, PROGRESS_LONGPOLL_TIMEOUT, PROGRESS_HEARTBEAT, \
+    SPEC_SPOOL_SIZE, JOB_MAX_ATTEMPTS, ADMISSION_RETRY_AFTER, QUOTA_BY, \
+    DOWNLOAD_ACCEL_PREFIX, STREAM_CHUNK_SIZE, STREAM_REOPEN_RETRIES, \
+    PROGRESS_POLL_INTERVAL, TRUSTED_PROXIES, JOB_DRAIN_TIMEOUT, \
+    MAX_LONG_REQUESTS, LONG_REQUEST_RETRY_AFTER, PROGRESS_STREAM_MAX_TIME
 
 import logging
 
@@ -45,7 +66,10 @@ API_URL = os.environ.get('API_URL', 'https://api3.geo.admin.ch')
 TOMCAT_SERVER_URL = '%s' % os.environ.get('TOMCAT_SERVER_URL')
 TOMCAT_LOCAL_SERVER_URL = '//localhost:%s' % os.environ.get('TOMCAT_PORT')
 PRINT_SERVER_HOST = os.environ.get('PRINT_SERVER_HOST')
-NUMBER_POOL_PROCESSES = multiprocessing.cpu_count()
+_TRUSTED_NETWORKS = [ipaddress.ip_network(network.strip())
+                     for network in TRUSTED_PROXIES if network.strip()]
+# Long-polls, event streams and downloads of running jobs of this worker
+_long_requests = RequestSlots(MAX_LONG_REQUESTS)
 
 
 app = Flask(__name__)
@@ -55,10 +79,35 @@ multi_logger = multiprocessing.log_to_stderr()
 multi_logger.setLevel(LOGLEVEL)
 
 
+@app.before_request
+def export_metrics():
+    ''' Every worker writes its metrics, whether it runs jobs or not '''
+    try:
+        get_exporter(PRINT_TEMP_DIR)
+    except OSError as e:
+        logger.error('Cannot export the metrics: {}'.format(e))
+
+
+@app.before_request
+def serve_job_queue():
+    ''' With a shared job queue, every worker claims jobs from it. Under
+        gunicorn, workers start claiming when they start, see wsgi.py. '''
+    queue = get_job_queue(PRINT_TEMP_DIR)
+    if queue is not None:
+        get_runner().serve(queue, run_queued_job)
+
+
 @app.route('/checker')
 def checker():
     return 'OK'
 
+
+@app.route('/metrics')
+def metrics():
+    ''' Metrics of the processes of the host, in the Prometheus text format '''
+    return Response(get_exporter(PRINT_TEMP_DIR).render(),
+                    mimetype='text/plain; version=0.0.4')
+
 ''' Print proxy to the MapFish Print Server to deal with time series
     If at least a layer has an attribute 'timestamps' holding an array
     of timestamps to print, one page per timestamp will be generated and
@@ -98,70 +147,229 @@ def print_cancel():
     if not os.path.isfile(cancelfile):
         abort(500, 'Could not create cancel file with id' % fileid)
 
+    # Jobs of the other processes are stopped by the cancel file, or by
+    # the mark of the job queue
+    if not get_runner().cancel(fileid) and fileid.isdigit():
+        queue = get_job_queue(PRINT_TEMP_DIR)
+        if queue is not None:
+            queue.cancel(fileid)
+
     return Response(status=200)
 
 # TODO we should inform user of problem
 
 
-def print_failed(fileid):
-    filename = create_info_file(PRINT_TEMP_DIR, fileid)
-    pdffile = create_pdf_path(PRINT_TEMP_DIR, fileid)
-
-    for fname in (filename, pdffile):
-        if os.path.isfile(fname):
-            os.remove(fname)
-
-
-@retry(
-    wait_exponential_multiplier=200,
-    wait_exponential_max=1000,
-    stop_max_delay=5000)
-def _retry_read(filename, is_json=False):
-    data = None
-    try:
-        with open(filename, 'r') as data_file:
-            raw_data = data_file.read()
-            if is_json:
-                data = json.loads(raw_data)
-            else:
-                data = raw_data
-    except IOError:
-        raise Exception('Cannot read file {}'.format(filename))
-    except ValueError:
-        raise Exception(
-            'Cannot decode file: {} with content: {}'.format(
-                filename, raw_data))
-    except:
-        raise Exception('Unexpected error while reading {}'.format(filename))
-
-    return data
-
-
-def _read_json(filename):
-    return _retry_read(filename, is_json=True)
+def print_failed(fileid, print_temp_dir=PRINT_TEMP_DIR):
+    ''' Publishes a job as failed and removes its PDF. The info file is
+        left to the janitor, for the clients polling the job. '''
+    JobProgress(get_progress_store(print_temp_dir), fileid, status='failed')
+    pdffile = create_pdf_path(print_temp_dir, fileid)
+    if os.path.isfile(pdffile):
+        os.remove(pdffile)
 
 
 @app.route('/printprogress')
 def print_progress():
+    ''' Progress of a job. With since=<etag>, waits until the progress
+        differs from this etag (long-poll), 304 if it did not change
+        within PROGRESS_LONGPOLL_TIMEOUT. Long-polls beyond
+        MAX_LONG_REQUESTS are answered at once, with a Retry-After. '''
 
     fileid = request.args.get('id')
-    filename = create_info_file(PRINT_TEMP_DIR, fileid)
-    pdffile = create_pdf_path(PRINT_TEMP_DIR, fileid)
+    store = get_progress_store(PRINT_TEMP_DIR)
 
-    if not os.path.isfile(filename):
-        abort(400, '%s does not exists' % filename)
-
-    data = _read_json(filename)
+    headers = {'Cache-Control': 'no-cache'}
+    since = request.args.get('since')
+    if since and _long_requests.acquire():
+        try:
+            data, etag = wait_for_change(store, fileid, since,
+                                         PROGRESS_LONGPOLL_TIMEOUT)
+        finally:
+            _long_requests.release()
+    else:
+        if since:
+            headers['Retry-After'] = str(LONG_REQUEST_RETRY_AFTER)
+        else:
+            since = request.headers.get('If-None-Match', '').strip('"')
+        data = store.read(fileid)
+        etag = progress_etag(data)
     if data is None:
-        logger.error(
-            'Error while reading/decoding printprogress file {}'.format(filename))
-        abort(500, 'Cannot read/decode {}'.format(filename))
+        abort(400, 'Job %s does not exists' % fileid)
 
-    # When file is written, get current size
-    if os.path.isfile(pdffile):
-        data['written'] = os.path.getsize(pdffile)
+    headers['ETag'] = '"%s"' % etag
+    if etag == since:
+        return Response(status=304, headers=headers)
+    return Response(json.dumps(data), mimetype='application/json',
+                    headers=headers)
+
+
+@app.route('/printprogress/stream')
+def print_progress_stream():
+    ''' Progress of a job as server-sent events, one event per change,
+        until the job is done or failed, or for PROGRESS_STREAM_MAX_TIME.
+        Beyond MAX_LONG_REQUESTS, the stream ends after the current
+        progress and the client connects again after
+        LONG_REQUEST_RETRY_AFTER. '''
 
-    return Response(json.dumps(data), mimetype='application/json')
+    fileid = request.args.get('id')
+    store = get_progress_store(PRINT_TEMP_DIR)
+    data = store.read(fileid)
+    if data is None:
+        abort(400, 'Job %s does not exists' % fileid)
+    last_event_id = request.headers.get('Last-Event-ID')
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+    if not _long_requests.acquire():
+        etag = progress_etag(data)
+        body = 'retry: {}\n\n'.format(LONG_REQUEST_RETRY_AFTER * 1000)
+        if etag != last_event_id:
+            body += 'id: {}\ndata: {}\n\n'.format(etag, json.dumps(data))
+        return Response(body, mimetype='text/event-stream', headers=headers)
+
+    def events():
+        etag = last_event_id
+        deadline = time.time() + PROGRESS_STREAM_MAX_TIME
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            data, current = wait_for_change(store, fileid, etag,
+                                            min(remaining, PROGRESS_HEARTBEAT))
+            if data is None:
+                yield 'event: error\ndata: {}\n\n'
+                return
+            if current == etag:
+                yield ': heartbeat\n\n'
+                continue
+            etag = current
+            yield 'id: {}\ndata: {}\n\n'.format(etag, json.dumps(data))
+            if data.get('status') in FINAL_STATUSES:
+                return
+
+    response = Response(events(), mimetype='text/event-stream',
+                        headers=headers)
+    # Closed by the server once sent, or once the client went away
+    response.call_on_close(_long_requests.release)
+    return response
+
+
+@app.route('/printdownload/<fileid>')
+def print_download(fileid):
+    ''' Merged PDF of a job, with byte ranges, ETag and Last-Modified, from
+        its local copy if staging is enabled. The PDF of a running job is
+        sent as it is written, until the job is done, if there are less
+        than MAX_LONG_REQUESTS (503 otherwise). '''
+
+    if not fileid.isdigit():
+        abort(404)
+    store = get_progress_store(PRINT_TEMP_DIR)
+    data = store.read(fileid)
+    path = create_pdf_path(PRINT_TEMP_DIR, fileid)
+    download_name = 'map.geo.admin.ch_{}.pdf'.format(fileid)
+    if data is not None and data.get('status') not in FINAL_STATUSES:
+        if not _long_requests.acquire():
+            return Response(
+                'Too many downloads of running jobs, try again later',
+                status=503, mimetype='text/plain',
+                headers={'Retry-After': str(LONG_REQUEST_RETRY_AFTER)})
+        response = Response(
+            _stream_pdf(store, fileid, path), mimetype='application/pdf',
+            headers={'Content-Disposition':
+                     'attachment; filename={}'.format(download_name),
+                     'Cache-Control': 'no-cache',
+                     'X-Accel-Buffering': 'no'})
+        response.call_on_close(_long_requests.release)
+        return response
+    if not os.path.isfile(path):
+        abort(404)
+
+    stage = get_download_stage()
+    if stage is not None:
+        path = stage.stage(path)
+        if DOWNLOAD_ACCEL_PREFIX:
+            # Sent by nginx, with sendfile, from the local copy
+            return Response(headers={
+                'X-Accel-Redirect':
+                    DOWNLOAD_ACCEL_PREFIX + os.path.basename(path),
+                'Content-Type': 'application/pdf',
+                'Content-Disposition':
+                    'attachment; filename={}'.format(download_name)})
+    return send_file(path, mimetype='application/pdf', as_attachment=True,
+                     download_name=download_name, conditional=True,
+                     max_age=3600)
+
+
+def _stream_pdf(store, fileid, path):
+    ''' Yields the merged PDF of a running job as it is written
+
+        The merger only appends to its output, the bytes written are final.
+        The rest of the file is read every time the progress of the job
+        changes (a page was merged), until it is done and the size it
+        published was sent. The response is aborted if the job failed or
+        was cancelled, or if its file was replaced (the job was run again
+        after its lease was lost). '''
+    etag = None
+    infile = None
+    inode = None
+    try:
+        while True:
+            data, etag = wait_for_change(store, fileid, etag,
+                                         PROGRESS_HEARTBEAT)
+            status = data.get('status') if data is not None else None
+            if infile is None and os.path.isfile(path):
+                infile = open(path, 'rb')
+                inode = os.fstat(infile.fileno()).st_ino
+            elif infile is not None and os.stat(path).st_ino != inode:
+                raise IOError('Job {} was run again'.format(fileid))
+            if infile is not None:
+                for chunk in _read_chunks(infile):
+                    yield chunk
+            # The output is closed before the job is published done
+            if status == 'done':
+                break
+            if status != 'ongoing':
+                raise IOError('Job {} is {}'.format(fileid, status or 'gone'))
+        written = data.get('written')
+        offset = infile.tell() if infile is not None else 0
+        for attempt in range(STREAM_REOPEN_RETRIES):
+            if offset == written:
+                return
+            # Attributes of the file may be stale on other hosts (NFS), they
+            # are refreshed when it is opened again
+            time.sleep(PROGRESS_POLL_INTERVAL * attempt)
+            if infile is not None:
+                infile.close()
+            infile = open(path, 'rb')
+            if inode is not None and \
+                    os.fstat(infile.fileno()).st_ino != inode:
+                raise IOError('Job {} was run again'.format(fileid))
+            inode = os.fstat(infile.fileno()).st_ino
+            infile.seek(offset)
+            for chunk in _read_chunks(infile):
+                yield chunk
+            offset = infile.tell()
+        if offset != written:
+            raise IOError('Job {}: sent {} of {} bytes'.format(
+                fileid, offset, written))
+    finally:
+        if infile is not None:
+            infile.close()
+
+
+def _read_chunks(infile):
+    while True:
+        chunk = infile.read(STREAM_CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+@app.route('/printqueue')
+def print_queue():
+    stats = get_runner().stats()
+    stats.update(get_admission(PRINT_TEMP_DIR).stats())
+    stats['long_requests'] = _long_requests.stats()
+    return Response(json.dumps(stats), mimetype='application/json')
 
 
 @app.route('/printmulti/create.json', methods=['OPTIONS'])
@@ -169,21 +377,28 @@ def print_create_option():
     return Response('OK', status=200, mimetype='text/plain')
 
 
-@app.route('/printmulti/create.json', methods=['GET', 'POST'])
-def print_create_post():
+def _read_spec():
+    ''' Returns the spec posted, and the SpooledSpec holding it if large '''
     # jsonstring = urllib.unquote_plus(request.content)
     # spec = json.loads(jsonstring, encoding=self.request.charset)
 
-    # delete all child processes that have already terminated
-    # but are <defunct>. This is a side_effect of the below function
-    multiprocessing.active_children()
-
-    try:
-        spec = request.get_json()
-    except Exception as e:
-        logger.error('JSON content could not be parsed')
-        logger.error(e, exc_info=True)
-        abort(400, 'JSON content could not be parsed')
+    spooled = None
+    if (request.content_length or 0) > SPEC_SPOOL_SIZE:
+        # Large specs are not held in memory
+        spooled = SpooledSpec(request.stream)
+        try:
+            spec = spooled.load()
+        except ValueError as e:
+            spooled.close()
+            logger.error('JSON content could not be parsed: {}'.format(e))
+            abort(400, 'JSON content could not be parsed')
+    else:
+        try:
+            spec = request.get_json()
+        except Exception as e:
+            logger.error('JSON content could not be parsed')
+            logger.error(e, exc_info=True)
+            abort(400, 'JSON content could not be parsed')
 
     if spec is None:
         data = request.stream.read()
@@ -194,11 +409,122 @@ def print_create_post():
             abort(400, 'JSON content could not be parsed: {}'.format(data))
 
     if LOG_SPEC_FILES:
-        logger.debug(json.dumps(spec, indent=2))
+        logger.debug(json.dumps(spec, indent=2, default=repr))
+
+    return (spec, spooled)
+
+
+def _client(headers, remote_addr, quota_by=QUOTA_BY):
+    ''' Client of a request, for the quotas
+
+        Proxies append the address of their peer to X-Forwarded-For, the
+        addresses before are set by the client. The client is the last
+        address not of a trusted proxy. '''
+    if quota_by == 'referer':
+        return _referer_host(headers)
+    hops = [hop.strip() for hop in
+            headers.get('X-Forwarded-For', '').split(',') if hop.strip()]
+    hops.append(remote_addr)
+    for hop in reversed(hops):
+        if not _trusted_proxy(hop):
+            return hop
+    return hops[0]
+
+
+def _trusted_proxy(address):
+    try:
+        address = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(address in network for network in _TRUSTED_NETWORKS)
+
+
+def _referer_host(headers):
+    ''' Pages may depend on the domain of the referer, not on its path '''
+    return urlsplit(headers.get('Referer') or '').netloc
+
+
+def _tomcat_url(scheme, print_url):
+    create_pdf_url = scheme + ':' + print_url + '/print/create.json'
+    return create_pdf_url + '?url=' + urllib.parse.quote(create_pdf_url)
+
+
+def _tomcat_headers(headers):
+    return {
+        'Referer': headers.get('Referer'),
+        'Content-Type': 'application/json',
+        'Host': PRINT_SERVER_HOST
+    }
+
+
+def _cached_page(print_temp_dir, jobid, idx):
+    ''' Name of the link to the cached page idx of a job '''
+    return os.path.join(print_temp_dir, '{}{}.{}.cached.pdf'.format(
+        MAPFISH_FILE_PREFIX, jobid, idx))
 
-    # Remove older files on the system
-    logger.debug('Removing older files on system')
-    delete_old_files(PRINT_TEMP_DIR)
+
+def _printed_file(print_temp_dir, pdf_url):
+    # GetURL '141028163227.pdf.printout', pointing to
+    # file 'mapfish-print141028163227.pdf.printout'
+    # We only get the pdf name and rely on the fact that they are stored on
+    # EFS!
+    filename = os.path.basename(urlsplit(pdf_url).path)
+    return os.path.join(print_temp_dir, MAPFISH_FILE_PREFIX + filename)
+
+
+@app.route('/printsingle/create.json', methods=['OPTIONS'])
+def print_single_option():
+    return Response('OK', status=200, mimetype='text/plain')
+
+
+@app.route('/printsingle/create.json', methods=['POST'])
+def print_single_post():
+    ''' Single page print, passed through to tomcat unless the same page
+        is in the PDF cache '''
+
+    with SPEC_PARSE_SECONDS.time():
+        spec, spooled = _read_spec()
+    try:
+        scheme = request.headers.get('X-Forwarded-Proto', request.scheme)
+        builder = PageSpecBuilder(spec)
+        page_spec = builder.build()
+        cache = get_pdf_cache(PRINT_TEMP_DIR)
+        if cache is not None:
+            key = builder.key(page_spec, _referer_host(request.headers))
+            fileid = datetime.datetime.now().strftime(
+                "%y%m%d%H%M%S") + str(random.randint(100000, 999999))
+            localname = os.path.join(
+                PRINT_TEMP_DIR, MAPFISH_FILE_PREFIX + fileid + '.pdf.printout')
+            if cache.link(key, localname):
+                get_janitor(PRINT_TEMP_DIR).register((localname,))
+                return Response(json.dumps({
+                    'getURL': scheme + '://' + PRINT_SERVER_HOST +
+                    '/print/' + fileid + '.pdf.printout'}),
+                    mimetype='application/json')
+
+        r = get_runner().session.post(
+            _tomcat_url(scheme, TOMCAT_SERVER_URL),
+            data=builder.body(page_spec),
+            headers=_tomcat_headers(request.headers),
+            verify=VERIFY_SSL,
+            timeout=BACKEND_TIMEOUT)
+        if r.status_code == requests.codes.ok and cache is not None:
+            try:
+                cache.add(key, _printed_file(PRINT_TEMP_DIR,
+                                             r.json()['getURL']))
+            except (ValueError, KeyError):
+                pass
+        return Response(r.content, status=r.status_code,
+                        mimetype=r.headers.get('Content-Type'))
+    finally:
+        if spooled is not None:
+            spooled.close()
+
+
+@app.route('/printmulti/create.json', methods=['GET', 'POST'])
+def print_create_post():
+    with SPEC_PARSE_SECONDS.time():
+        spec, spooled = _read_spec()
 
     scheme = request.headers.get('X-Forwarded-Proto',
                                  request.scheme)
@@ -207,9 +533,26 @@ def print_create_post():
     unique_filename = datetime.datetime.now().strftime(
         "%y%m%d%H%M%S") + str(random.randint(1000, 9999))
 
-    info_filename = create_info_file(PRINT_TEMP_DIR, unique_filename)
-    with open(info_filename, 'w+') as outfile:
-        json.dump({'status': 'ongoing'}, outfile)
+    store = get_progress_store(PRINT_TEMP_DIR)
+    store.write(unique_filename, {'status': 'ongoing'})
+    runner = get_runner()
+    if not get_admission(PRINT_TEMP_DIR).admit(
+            unique_filename, _client(request.headers, request.remote_addr),
+            runner.stats()['pending_pages']):
+        store.remove(unique_filename)
+        if spooled is not None:
+            spooled.close()
+        JOBS_REJECTED.inc()
+        return Response(
+            json.dumps({'error': 'Too many print jobs, try again later'}),
+            status=429, mimetype='application/json',
+            headers={'Retry-After': str(ADMISSION_RETRY_AFTER)})
+
+    # The files of the job are removed in the background once expired
+    get_janitor(PRINT_TEMP_DIR).register((
+        create_info_file(PRINT_TEMP_DIR, unique_filename),
+        create_pdf_path(PRINT_TEMP_DIR, unique_filename),
+        create_cancel_file(PRINT_TEMP_DIR, unique_filename)))
 
     info = (
         spec,
@@ -219,23 +562,80 @@ def print_create_post():
         TOMCAT_SERVER_URL,
         headers,
         unique_filename)
-    logger.debug('Start the creation of the multiprint')
-    p = multiprocessing.Process(target=create_and_merge, args=(info,))
-    p.start()
+    logger.debug(
+        'Queue the creation of the multiprint {} ({})'.format(
+            unique_filename, runner.stats()))
+    queue = get_job_queue(PRINT_TEMP_DIR)
+    if queue is not None:
+        # Run by the first runner with a free job thread, maybe this one
+        try:
+            queue.put(unique_filename, {
+                'info': (None,) + info[1:] if spooled else info,
+                'spooled': spooled is not None}, spooled)
+        finally:
+            if spooled is not None:
+                spooled.close()
+        runner.wakeup()
+    elif spooled is None:
+        runner.submit(create_and_merge, info, key=unique_filename)
+    else:
+        runner.submit(create_and_merge_spooled, info, spooled,
+                      key=unique_filename)
 
     response = {'idToCheck': unique_filename}
 
     return Response(json.dumps(response), mimetype='application/json')
 
 
+def _post_page(url, body, tmp_spec, h, control, jobid):
+    ''' Sends a page to tomcat, within the adaptive limit of the runner
+
+        Returns the response, None if there is none or the job was
+        cancelled. Failed pages are retried by _print_pages.'''
+    runner = get_runner()
+    r = None
+    runner.limiter.acquire()
+    BACKEND_CALLS.inc()
+    start = time.time()
+    ok = False
+    try:
+        # The request is aborted if the job is cancelled
+        with control.attached(), PAGE_SECONDS.time():
+            r = runner.session.post(
+                url,
+                data=body(tmp_spec),
+                headers=h,
+                verify=VERIFY_SSL,
+                timeout=BACKEND_TIMEOUT)
+        ok = r.status_code < 500
+    except (Timeout, ConnectionError) as e:
+        if control.cancelled:
+            multi_logger.debug(
+                '[worker {}] Request for {} aborted'.format(jobid, url))
+        else:
+            multi_logger.warning(
+                '[worker {}] Request for {} failed: {}'.format(jobid, url, e))
+    except Exception:
+        multi_logger.error(
+            '[worker {}]. Request for {} did fail for unknown reason'.format(
+                jobid, url))
+    finally:
+        BACKEND_CALLS.dec()
+        runner.limiter.release(
+            None if control.cancelled else time.time() - start, ok)
+        if not ok and not control.cancelled:
+            PAGES_FAILED.inc()
+    return r
+
+
 def worker(job):
     ''' Print and dowload the indivialized PDFs'''
 
     timestamp = None
 
     try:
-        (idx, url, headers, timestamp, layers, tmp_spec,
-         print_temp_dir, infofile, cancelfile, lock, jobid) = job
+        (idx, url, headers, timestamp, layers, tmp_spec, builder,
+         print_temp_dir, progress, control, jobid) = job
     except ValueError:
         multi_logger.error('[Worker] Cannot get job specification')
         return (timestamp, None)
@@ -243,54 +643,29 @@ def worker(job):
     try:
         multi_logger.debug(
             '[worker {}]. Starting to print individual pdf (timestamp={})'.format(
-                jobid, timestamp, infofile))
-
-        for layer in layers:
-            try:
-                tmp_spec['layers'][layer]['params']['TIME'] = str(timestamp)
-            except:
-                continue
+                jobid, timestamp))
 
         # Before launching print request, check if process is canceled
-        if os.path.isfile(cancelfile):
+        if control.cancelled:
             multi_logger.debug(
-                '[worker {}] Canceling request with file {}'.format(
-                    jobid, cancelfile))
+                '[worker {}] Canceling request'.format(jobid))
             return (timestamp, None)
 
-        h = {
-            'Referer': headers.get('Referer'),
-            'Content-Type': 'application/json',
-            'Host': PRINT_SERVER_HOST
-        }
+        h = _tomcat_headers(headers)
         multi_logger.debug(
             '[worker {}] Sending create.json request to {}'.format(
                 jobid, url))
-        try:
-            r = requests.post(
-                url,
-                data=json.dumps(tmp_spec),
-                headers=h,
-                verify=VERIFY_SSL)
-        except Exception:
-            multi_logger.error(
-                '[worker {}]. Request for {} did fail for unknown reason'.format(
-                    jobid, url))
+        r = _post_page(url, builder.body, tmp_spec, h, control, jobid)
+        if r is None:
             return (timestamp, None)
 
         if r.status_code == requests.codes.ok:
 
-            # GetURL '141028163227.pdf.printout', pointing to
-            # file 'mapfish-print141028163227.pdf.printout'
-            # We only get the pdf name and rely on the fact that they are stored on
-            # EFS!
             try:
                 pdf_url = r.json()['getURL']
                 multi_logger.debug(
                     '[Worker] Response from tomcat has pdf_url: %s', pdf_url)
-                filename = os.path.basename(urlsplit(pdf_url).path)
-                localname = os.path.join(
-                    print_temp_dir, MAPFISH_FILE_PREFIX + filename)
+                localname = _printed_file(print_temp_dir, pdf_url)
                 multi_logger.info(
                     "[worker {}] Partial PDF for Timestamp={} succesfully written to file {}".format(
                         jobid, timestamp, localname))
@@ -315,7 +690,12 @@ def worker(job):
                         file=sys.stdout))
 
                 return (timestamp, None)
-            _increment_info(lock, infofile)
+            cache = get_pdf_cache(print_temp_dir)
+            if cache is not None:
+                cache.add(builder.key(tmp_spec, _referer_host(headers)),
+                          localname)
+            PAGES.inc()
+            progress.increment('done')
             return (timestamp, localname)
         else:
             multi_logger.error(
@@ -327,21 +707,185 @@ def worker(job):
             multi_logger.error('[Worker] url: %s', url)
             multi_logger.error('[Worker] print dir: %s', print_temp_dir)
     except Exception as e:
+        # The page is retried, the outcome of the job is left to
+        # _print_pages
         multi_logger.error(
             '[Worker {}] Unknown exception: {}'.format(
                 jobid, str(e)))
-        with open(infofile, 'w+') as outfile:
-            json.dump({'status': 'failed', 'done': 0,
-                       'total': 0}, outfile)
 
     return (timestamp, None)
 
 
-# Function to be used on process to create all
+def _print_pages(pages, control):
+    ''' Prints pages on the page executor as soon as they are ready, and
+        yields (idx, pdf) as they are done
+
+        pages are (job, shortlink, cached): a page is submitted once its
+        short link (a future, or None) is known, cached pages (the name of
+        their copy of the cached page, or None) are done already. Pages are
+        yielded while the next ones are still being built.
+
+        A failed page is submitted again after a jittered backoff, up to
+        PAGE_RETRIES times, while the other pages go on. The backoff is a
+        timer, it holds no page thread. Pending retries are futures of the
+        job, dropped if it is cancelled.'''
+    runner = get_runner()
+    done = queue.Queue()
+    attempts = {}
+
+    def _submit(job):
+        future = control.add_future(
+            runner.submit_page(worker, job, key=control.jobid))
+        future.add_done_callback(functools.partial(_page_done, job))
+
+    def _shortened(job, future):
+        if future.cancelled():
+            done.put((job[0], (None, None)))
+            return
+        if future.exception() is None:
+            job[5]['pages'][0]['shortLink'] = future.result()
+            logger.debug('[print_create] shortLink: %s', future.result())
+        _submit(job)
+
+    def _page_done(job, future):
+        i = job[0]
+        if future.cancelled() or future.exception() is not None:
+            pdf = (None, None)
+        else:
+            pdf = future.result()
+        attempt = attempts.get(i, 0) + 1
+        if pdf[1] is not None or control.cancelled or attempt > PAGE_RETRIES:
+            done.put((i, pdf))
+            return
+        attempts[i] = attempt
+        PAGE_RETRIES_TOTAL.inc()
+        logger.warning('[Job {}] Retrying failed page {} (attempt {})'.format(
+            control.jobid, i, attempt + 1))
+        retry = control.add_future(Future())
+        retry.add_done_callback(functools.partial(_retry_done, i))
+        timer = threading.Timer(backoff(attempt), _retry, (job, retry))
+        timer.daemon = True
+        timer.start()
+
+    def _retry(job, retry):
+        if retry.set_running_or_notify_cancel():
+            retry.set_result(None)
+            _submit(job)
+
+    def _retry_done(i, retry):
+        if retry.cancelled():
+            done.put((i, (None, None)))
+
+    pending = 0
+    for job, shortlink, cached in pages:
+        pending += 1
+        if cached is not None:
+            done.put((job[0], (job[3], cached)))
+        elif shortlink is None:
+            _submit(job)
+        else:
+            shortlink.add_done_callback(functools.partial(_shortened, job))
+        while True:
+            try:
+                result = done.get_nowait()
+            except queue.Empty:
+                break
+            pending -= 1
+            yield result
+    for _ in range(pending):
+        yield done.get()
+
+
+def _timed_shorten(url):
+    with SHORTEN_SECONDS.time():
+        return _shorten(url)
+
+
+def create_and_merge_spooled(info, spooled, lease=None):
+    ''' create_and_merge of a spec loaded from a spooled body '''
+    try:
+        return create_and_merge(info, lease)
+    finally:
+        spooled.close()
+
+
+def run_queued_job(lease):
+    ''' Runs a job claimed from the shared job queue '''
+    info = list(lease.payload['info'])
+    print_temp_dir, unique_filename = info[1], info[6]
+    try:
+        if lease.attempt > JOB_MAX_ATTEMPTS:
+            logger.error('[Job {}] Given up after {} attempts'.format(
+                unique_filename, JOB_MAX_ATTEMPTS))
+            JOBS_FAILED.inc()
+            print_failed(unique_filename, print_temp_dir)
+            return
+        if lease.attempt > 1:
+            # The runner which lost the job may still write to its file
+            pdffile = create_pdf_path(print_temp_dir, unique_filename)
+            if os.path.isfile(pdffile):
+                os.remove(pdffile)
+        if lease.payload['spooled']:
+            with open(lease.spec_file, 'rb') as infile:
+                spooled = SpooledSpec(infile)
+            try:
+                info[0] = spooled.load()
+            except ValueError:
+                spooled.close()
+                raise
+            create_and_merge_spooled(tuple(info), spooled, lease)
+        else:
+            create_and_merge(tuple(info), lease)
+    except Exception:
+        if not lease.lost:
+            _publish_failed(print_temp_dir, unique_filename)
+        raise
+    finally:
+        lease.release()
+
+
+# Function to be used by the job runner to create all
 # pdfs and merge them
-def create_and_merge(info):
+def create_and_merge(info, lease=None):
+    print_temp_dir, unique_filename = info[1], info[6]
+    get_exporter(print_temp_dir)
+    runner = get_runner()
+    control = runner.register(
+        unique_filename, create_cancel_file(print_temp_dir, unique_filename),
+        lease)
+    result = None
+    try:
+        result = _create_and_merge(info, control)
+        return result
+    finally:
+        runner.unregister(unique_filename)
+        if result == 0:
+            (JOBS_CANCELLED if control.cancelled else JOBS).inc()
+        else:
+            JOBS_FAILED.inc()
+            if not control.lost:
+                _publish_failed(print_temp_dir, unique_filename)
+
+
+def drain_jobs(timeout=JOB_DRAIN_TIMEOUT):
+    ''' Waits for the jobs of an exiting worker. The jobs which could not
+        run to their end are published failed, the ones of the job queue
+        are run again by another worker. '''
+    for jobid in get_runner().drain(timeout):
+        _publish_failed(PRINT_TEMP_DIR, jobid)
+
+
+def _publish_failed(print_temp_dir, unique_filename):
+    ''' Publishes a job as failed, unless it is over already. Jobs not over
+        count in the admission of their worker. '''
+    store = get_progress_store(print_temp_dir)
+    data = store.read(unique_filename)
+    if data is not None and data.get('status') not in FINAL_STATUSES:
+        JobProgress(store, unique_filename, status='failed')
+
+
+def _create_and_merge(info, control):
 
-    lock = multiprocessing.Manager().Lock()
     (spec, print_temp_dir, scheme, api_url,
      print_url, headers, unique_filename) = info
 
@@ -354,91 +898,23 @@ def create_and_merge(info):
     # TODO failed info_filename = create_info_file(PRINT_TEMP_DIR,
     # unique_filename)
 
-    def _merge_pdfs(pdfs, infofile, ignore_missing=True):
-        '''Merge individual pdfs into a big one'''
-        '''We assume this happens in one process'''
-
-        merged_pdf_filename = create_pdf_path(print_temp_dir, unique_filename)
-        jobid = unique_filename
-
-        info_json = _read_json(infofile)
-        if info_json is None:
-            logger.error('Cannot read/decode json file {}'.format(info_json))
-            abort(500, 'Cannot read/decode {}'.format(info_json))
-
-        info_json['merged'] = 0
-
-        def write_info():
-            with open(infofile, 'w+') as outfile:
-                json.dump(info_json, outfile)
-
-        logger.info(
-            '[_merge_pdfs {}] Starting merge {} PDFs'.format(
-                jobid, len(pdfs)))
-        expected_file_size = 0
-        pdf_to_merge = []
-        for pdf in sorted(pdfs, key=lambda x: x[0]):
-            ts, localname = pdf
-            if localname is not None:
-                try:
-                    single_file_size = os.path.getsize(localname)
-                    expected_file_size += single_file_size
-                    pdf_to_merge.append(localname)
-                    info_json['merged'] += 1
-                    write_info()
-                except Exception as e:
-                    logger.error(
-                        '[_merge_pdfs {}] Failed to append file {} [ {} kB] to merger PDF'.format(
-                            jobid, localname, single_file_size / 1024.))
-                    logger.error(e, exc_info=True)
-                    # Try to merge pdf even if some file are missing
-                    if ignore_missing is False:
-                        return False
-
-        try:
-            info_json['filesize'] = expected_file_size
-            info_json['written'] = 0
-            write_info()
-            logger.debug(
-                '[_merge_pdfs {}] Starting writing merged PDF [ {} kB ] file {}'.format(
-                    jobid, single_file_size / 1024., merged_pdf_filename))
-            start_time = time.time()
-            command = ["/usr/bin/pdfunite"] + pdf_to_merge + [merged_pdf_filename, ]
-            subprocess.check_call(command)
-
-            stop_time = time.time()
-            time_used = (stop_time - start_time) * 1000.0
-            logger.info(
-                '[_merge_pdfs {}] Merged PDF written to: {} in {} ms'.format(
-                    jobid, merged_pdf_filename, time_used))
-        except subprocess.CalledProcessError as e:
-            logger.error(
-                '[_merge_pdfs {}] Error while merging PDF file {} ({})\n{}e'.format(
-                    jobid, merged_pdf_filename, expected_file_size, e))
-            logger.error(e, exc_info=True)
-            return False
-
-        except Exception as e:
-            logger.error(
-                '[_merge_pdfs {}] Unknown error while merging PDF file {} ({})\n{}e'.format(
-                    jobid, merged_pdf_filename, expected_file_size, e))
-            logger.error(e, exc_info=True)
-            return False
-
-        return True
+    def _merge_progress(merged, written):
+        progress.update(merged=merged, written=written)
 
     jobs = []
     jobid = unique_filename
     all_timestamps = []
+    runner = get_runner()
+    # Pages taken from the cache
+    cached = []
 
-    create_pdf_url = scheme + ':' + print_url + '/print/create.json'
-
-    url = create_pdf_url + '?url=' + urllib.parse.quote(create_pdf_url)
-    infofile = create_info_file(print_temp_dir, unique_filename)
-    cancelfile = create_cancel_file(print_temp_dir, unique_filename)
+    url = _tomcat_url(scheme, print_url)
+    progress = JobProgress(
+        get_progress_store(print_temp_dir), unique_filename, status='ongoing')
 
     if _isMultiPage(spec):
-        all_timestamps = _get_timestamps(spec, api_url)
+        with TIMESTAMPS_SECONDS.time():
+            all_timestamps = _get_timestamps(spec, api_url)
         all_timestamps_keys = list(map(int, all_timestamps.keys()))
 
         logger.debug(
@@ -459,21 +935,25 @@ def create_and_merge(info):
                 'baseURL'].replace('{', '%7B').replace('}', '%7D')
             spec['layers'][i]['baseURL'] = cleanup_baseurl
 
-    if len(all_timestamps) < 1:
-        job = (0, url, headers, None, [], spec, print_temp_dir, jobid)
-        jobs.append(job)
-    else:
+    builder = PageSpecBuilder(spec)
+    total = max(len(all_timestamps), 1)
+
+    def _build_jobs():
+        '''Yields the jobs of the pages, and the url to shorten for their
+           short link (or None), one by one'''
+        if len(all_timestamps) < 1:
+            yield ((0, url, headers, None, [], builder.build(), builder,
+                    print_temp_dir, progress, control, jobid), None)
+            return
+
         last_timestamp = list(all_timestamps.keys())[-1]
 
         for idx, ts in enumerate(all_timestamps):
             lyrs = all_timestamps[ts]
+            long_url = None
 
-            tmp_spec = copy.deepcopy(spec)
-            for lyr in lyrs:
-                try:
-                    tmp_spec['layers'][lyr]['params']['TIME'] = str(ts)
-                except KeyError:
-                    pass
+            # Only the legends of the last page are printed
+            tmp_spec = builder.build(ts, lyrs, legends=ts == last_timestamp)
 
             if ts is not None:
                 qrcodeurl = spec['qrcodeurl']
@@ -492,18 +972,12 @@ def create_and_merge(info):
 
                     time_updated_qrcodeurl = _qrcodeurlunparse(
                         (qrcode_service_url, map_url, map_params))
-                    shortlink = _shorten(map_url + "?" + urlencode(map_params))
+                    long_url = map_url + "?" + urlencode(map_params)
 
                     tmp_spec['qrcodeurl'] = time_updated_qrcodeurl
-                    tmp_spec['pages'][0]['shortLink'] = shortlink
                     logger.debug(
                         '[print_create] QRcodeURL: %s',
                         time_updated_qrcodeurl)
-                    logger.debug('[print_create] shortLink: %s', shortlink)
-
-            if 'legends' in tmp_spec.keys() and ts != last_timestamp:
-                del tmp_spec['legends']
-                tmp_spec['enableLegends'] = False
 
             logger.debug(
                 '[print_create] Succesfully processed spec for timestamp: %s', ts)
@@ -515,87 +989,138 @@ def create_and_merge(info):
                 ts,
                 lyrs,
                 tmp_spec,
+                builder,
                 print_temp_dir,
-                infofile,
-                cancelfile,
-                lock,
+                progress,
+                control,
                 jobid)
 
+            yield (job, long_url)
+
+    cache = get_pdf_cache(print_temp_dir)
+    referer = _referer_host(headers)
+
+    def _pages():
+        '''Yields (job, short link, cached page) of the pages, as soon as
+           each one is built. Pages printed before are taken from the cache,
+           and need no short link. Others are shortened concurrently.'''
+        for job, long_url in _build_jobs():
             jobs.append(job)
+            idx = job[0]
+            if cache is not None:
+                localname = _cached_page(print_temp_dir, jobid, idx)
+                if cache.link(builder.key(job[5], referer), localname):
+                    cached.append(idx)
+                    progress.increment('done')
+                    yield (job, None, localname)
+                    continue
+            shortlink = None
+            if long_url is not None:
+                shortlink = control.add_future(runner.submit_lookup(
+                    _timed_shorten, long_url))
+            yield (job, shortlink, None)
 
-    with open(infofile, 'w+') as outfile:
-        json.dump({'status': 'ongoing', 'done': 0,
-                   'total': len(jobs)}, outfile)
+    # Use the real filename to avoid rewrite on the http server
+    pdf_download_url = scheme + '://' + PRINT_SERVER_HOST + '/' + \
+        MAPFISH_MULTI_FILE_PREFIX + unique_filename + '.pdf.printout'
+    # The merged PDF may be downloaded while it is written
+    progress.reset(status='ongoing', done=0, total=total,
+                   streamURL=pdf_download_url)
+
+    merged_pdf_filename = create_pdf_path(print_temp_dir, unique_filename)
+    merger = StreamingPdfMerger(merged_pdf_filename, progress=_merge_progress)
+    logger.info(
+        '[Job {}] Merging {} PDFs into {} as they are printed'.format(
+            jobid, total, merged_pdf_filename))
 
     if USE_MULTIPROCESS:
-        logger.info('Going multiprocess')
-        pool = multiprocessing.Pool(NUMBER_POOL_PROCESSES)
-        pdfs = pool.map(worker, jobs)
-        pool.close()
-        try:
-            pool.join()
-            pool.terminate()
-        except Exception as e:
-            for i in reversed(range(len(pool._pool))):
-                p = pool._pool[i]
-                if p.exitcode is None:
-                    p.terminate()
-                del pool._pool[i]
-            logger.error(
-                '[Job {}] Error while generating the partial PDF: {}'.format(
-                    jobid, e))
-            logger.error(e, exec_info=True)
-            return 1
+        logger.info('Going multithreaded')
+        pdfs = _print_pages(_pages(), control)
     else:
         logger.info('Going single process')
-        pdfs = []
-        for j in jobs:
-            pdfs.append(worker(j))
-            _increment_info(lock, infofile)
-
-    # Check if canceled, then we don't merge pdf's
-    # We don't/can't cancel the merge process itself
-    if os.path.isfile(cancelfile):
-        return 0
-
-    logger.debug('pdfs %s', pdfs)
-    # Retry logic (only once)
-    for i, v in enumerate(pdfs):
-        if v[1] is None:
-            job = jobs[i]
-            retry_timestamp = job[3] if len(job) > 3 else 'unknown'
-            logger.warn(
-                "Job {}. Retrying a failed PDF. Timestamp={}".format(
-                    jobid, retry_timestamp))
-            pdf = worker(job)
-            if pdf[1] is not None:
-                pdfs[i] = pdf
-                logger.info(
-                    "Job {}. Retryied failed PDF with timestamp={} is OK".format(
-                        jobid, retry_timestamp))
-            else:
+
+        def _serial_pages():
+            for job, shortlink, localname in _pages():
+                if localname is not None:
+                    yield (job[0], (job[3], localname))
+                    continue
+                if shortlink is not None and not shortlink.cancelled():
+                    job[5]['pages'][0]['shortLink'] = shortlink.result()
+                pdf = worker(job)
+                for attempt in range(1, PAGE_RETRIES + 1):
+                    if pdf[1] is not None or control.cancelled:
+                        break
+                    time.sleep(backoff(attempt))
+                    PAGE_RETRIES_TOTAL.inc()
+                    pdf = worker(job)
+                yield (job[0], pdf)
+        pdfs = _serial_pages()
+
+    start_time = time.time()
+    # Time spent merging, not waiting for the pages
+    merge_time = 0
+    # Partial pages, deleted as soon as the job is over
+    partials = []
+    try:
+        for i, pdf in pdfs:
+            # Check if canceled, then we don't merge pdf's
+            if control.cancelled:
+                if control.lost:
+                    # Run again by another runner, which owns the output
+                    merger.abort(remove=False)
+                    return 0
+                merger.abort()
+                if control.abandoned:
+                    # Its worker is exiting
+                    progress.reset(status='failed')
+                    return 5
+                progress.reset(status='cancelled')
+                return 0
+
+            # Failed pages were already retried, see _print_pages
+            if pdf[1] is None:
                 logger.fatal(
-                    'Job [. ]Retry of partial PDF timestamp {} also failed'.format(
-                        jobid, retry_timestamp))
-                logger.fatal('====== spec =====\n{}\n======='.format(job))
+                    'Job [{}] Partial PDF timestamp {} failed {} times'.format(
+                        jobid, jobs[i][3], PAGE_RETRIES + 1))
+                logger.fatal('====== spec =====\n{}\n======='.format(jobs[i]))
+                control.cancel()
+                merger.abort()
+                progress.reset(status='failed')
                 return 2
 
-    # Check if any missing PDFs
-    missing_pdfs = list(filter(lambda x: x is None, list(zip(*pdfs))[1]))
-    if len(missing_pdfs) > 0:
-        logger.error("Number of missing PDF: {}".format(missing_pdfs))
+            partials.append(pdf[1])
+            merge_start = time.time()
+            merger.add(i, pdf[1])
+            merge_time += time.time() - merge_start
 
-    if _merge_pdfs(pdfs, infofile) is False:
+        merge_start = time.time()
+        written = merger.close()
+        MERGE_SECONDS.observe(merge_time + time.time() - merge_start)
+        progress.update(filesize=merger.partial_size, written=written)
+    except Exception as e:
         logger.fatal(
             'Job {}. Something went wrong while merging PDFs'.format(jobid))
-        print_failed(jobid)
+        logger.error(e, exc_info=True)
+        merger.abort()
+        progress.reset(status='failed')
         return 3
-
-    # Use the real filename to avoid rewrite on the http server
-    pdf_download_url = scheme + '://' + PRINT_SERVER_HOST + '/' + \
-        MAPFISH_MULTI_FILE_PREFIX + unique_filename + '.pdf.printout'
-    with open(infofile, 'w+') as outfile:
-        json.dump({'status': 'done', 'getURL': pdf_download_url}, outfile)
+    finally:
+        get_janitor(print_temp_dir).register(partials, ttl=0)
+
+    logger.info(
+        '[Job {}] Merged PDF written to: {} in {} ms'.format(
+            jobid, merged_pdf_filename, (time.time() - start_time) * 1000.0))
+
+    cache_info = {
+        'cached': len(cached),
+        'cache_hit_ratio': round(float(len(cached)) / total, 3)
+    }
+    PAGES_CACHED.inc(len(cached))
+    logger.info('[Job {}] {} of {} pages found in cache'.format(
+        jobid, len(cached), total))
+
+    progress.reset(status='done', getURL=pdf_download_url, written=written,
+                   **cache_info)
 
     logger.info('[create_pdf] PDF ready to download: %s', pdf_download_url)
 
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+
+''' In-process merge of the partial PDFs into the multipages document
+
+    Pages are appended in order as soon as they are available, and the
+    objects of every appended page are written to the output file right
+    away. Only the page tree, the catalog, the document info and the cross
+    reference table are left for the end, so closing the document is
+    nearly instantaneous, whatever its size.
+
+    Every page of a time series embeds the same fonts, logos and often the
+    same legend images. Before being written, the objects of a page are
+    hashed, and the ones identical to an object already written are
+    replaced by a reference to it.'''
+
+import os
+import hashlib
+
+from pypdf import PdfReader, PdfWriter
+from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject, \
+    NameObject, NumberObject, NullObject, StreamObject
+
+from print3.config import DEDUPLICATE_PDF_RESOURCES
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class StreamingPdfMerger(object):
+
+    def __init__(self, filename, progress=None,
+                 deduplicate=DEDUPLICATE_PDF_RESOURCES):
+        ''' progress is called with (merged, written) after each page '''
+        self.filename = filename
+        self.merged = 0
+        self.partial_size = 0
+        self.deduplicated = 0
+        self.deduplicated_size = 0
+        self._progress = progress
+        self._deduplicate = deduplicate
+        self._digests = {}
+        self._writer = PdfWriter()
+        self._pending = {}
+        self._next = 0
+        self._positions = {}
+        self._scanned = 0
+        # Objects modified by every page added, written when closing
+        self._deferred = set(
+            obj.indirect_reference.idnum for obj in (
+                self._writer._info,
+                self._writer.root_object,
+                self._writer._pages.get_object()))
+        self._out = open(filename, 'wb')
+        self._out.write(b'%PDF-1.7\n%\xe2\xe3\xcf\xd3\n')
+
+    @property
+    def written(self):
+        return self._out.tell()
+
+    def add(self, idx, localname):
+        ''' Add the partial pdf of page idx, None if the page is missing
+
+            Pages may be added in any order, they are merged as soon as all
+            the previous ones were added.'''
+        self._pending[idx] = localname
+        while self._next in self._pending:
+            localname = self._pending.pop(self._next)
+            if localname is not None:
+                self._append(localname)
+            self._next += 1
+
+    def _append(self, localname):
+        reader = PdfReader(localname)
+        for page in reader.pages:
+            self._writer.add_page(page)
+        # ids of readers are reused once garbage collected, so the
+        # translation table must not outlive the reader
+        self._writer._id_translated.pop(id(reader), None)
+        if self._deduplicate:
+            self._remove_duplicates()
+        self._flush()
+        self.merged += 1
+        self.partial_size += os.path.getsize(localname)
+        if self._progress is not None:
+            self._progress(self.merged, self.written)
+
+    def _digest(self, idnum, digests):
+        ''' Returns a hash of the object and everything it references,
+            None if the object must be kept as is '''
+        if idnum <= self._scanned or idnum in self._deferred:
+            return None
+        if idnum in digests:
+            # Already computed, or part of a cycle (None)
+            return digests[idnum]
+        digests[idnum] = None
+        obj = self._writer._objects[idnum - 1]
+        if obj is None or (isinstance(obj, DictionaryObject) and
+                           obj.get('/Type') in ('/Page', '/Pages')):
+            return None
+
+        def canonical(value):
+            if isinstance(value, IndirectObject):
+                digest = self._digest(value.idnum, digests)
+                return ('R', value.idnum) if digest is None else digest
+            if isinstance(value, DictionaryObject):
+                return ('D', tuple(sorted(
+                    (k, canonical(v)) for k, v in value.items()
+                    if not (k == '/Length' and isinstance(value, StreamObject)))))
+            if isinstance(value, ArrayObject):
+                return ('A', tuple(canonical(v) for v in value))
+            return (type(value).__name__, repr(value))
+
+        h = hashlib.sha1(repr(canonical(obj)).encode())
+        if isinstance(obj, StreamObject):
+            h.update(obj._data)
+        digests[idnum] = h.hexdigest()
+        return digests[idnum]
+
+    def _remove_duplicates(self):
+        objects = self._writer._objects
+        first = self._scanned + 1
+        digests = {}
+        duplicates = {}
+        for idnum in range(first, len(objects) + 1):
+            digest = self._digest(idnum, digests)
+            if digest is None:
+                continue
+            if digest in self._digests:
+                duplicates[idnum] = self._digests[digest]
+            else:
+                self._digests[digest] = idnum
+        if not duplicates:
+            return
+
+        def replace(value):
+            if isinstance(value, DictionaryObject):
+                items = value.items()
+            elif isinstance(value, ArrayObject):
+                items = enumerate(value)
+            else:
+                return
+            for k, v in list(items):
+                if isinstance(v, IndirectObject):
+                    if v.idnum in duplicates:
+                        value[k] = IndirectObject(
+                            duplicates[v.idnum], 0, self._writer)
+                else:
+                    replace(v)
+
+        for idnum in duplicates:
+            obj = objects[idnum - 1]
+            if isinstance(obj, StreamObject):
+                self.deduplicated_size += len(obj._data)
+            objects[idnum - 1] = None
+            self.deduplicated += 1
+        for idnum in range(first, len(objects) + 1):
+            if objects[idnum - 1] is not None:
+                replace(objects[idnum - 1])
+
+    def _write_object(self, idnum, obj):
+        self._positions[idnum] = self._out.tell()
+        self._out.write(('%d 0 obj\n' % idnum).encode())
+        obj.write_to_stream(self._out)
+        self._out.write(b'\nendobj\n')
+
+    def _flush(self):
+        objects = self._writer._objects
+        for idnum in range(self._scanned + 1, len(objects) + 1):
+            if idnum in self._deferred:
+                continue
+            obj = objects[idnum - 1]
+            if obj is None:
+                continue
+            self._write_object(idnum, obj)
+            # The content is on disk, only keep the (small) dictionaries
+            if isinstance(obj, StreamObject):
+                objects[idnum - 1] = NullObject()
+        self._scanned = len(objects)
+        self._out.flush()
+
+    def close(self):
+        ''' Write the remaining objects and the cross reference table '''
+        writer = self._writer
+        for idnum in sorted(self._deferred):
+            self._write_object(idnum, writer._objects[idnum - 1])
+        self._flush()
+
+        size = len(writer._objects) + 1
+        xref = self._out.tell()
+        self._out.write(('xref\n0 %d\n' % size).encode())
+        self._out.write(b'0000000000 65535 f \n')
+        for idnum in range(1, size):
+            if idnum in self._positions:
+                self._out.write(
+                    ('%010d 00000 n \n' % self._positions[idnum]).encode())
+            else:
+                self._out.write(b'0000000000 00001 f \n')
+        trailer = DictionaryObject({
+            NameObject('/Size'): NumberObject(size),
+            NameObject('/Root'): writer.root_object.indirect_reference,
+            NameObject('/Info'): writer._info.indirect_reference
+        })
+        self._out.write(b'trailer\n')
+        trailer.write_to_stream(self._out)
+        self._out.write(('\nstartxref\n%d\n%%%%EOF\n' % xref).encode())
+        written = self.written
+        self._out.close()
+        log.debug('[StreamingPdfMerger] {} pages written to {} ({} bytes)'.format(
+            self.merged, self.filename, written))
+        if self.deduplicated:
+            log.info(
+                '[StreamingPdfMerger] {} duplicated objects ({} bytes) removed from {}'.format(
+                    self.deduplicated, self.deduplicated_size, self.filename))
+        return written
+
+    def abort(self, remove=True):
+        ''' Stop merging and remove the incomplete output file '''
+        if not self._out.closed:
+            self._out.close()
+        if remove and os.path.isfile(self.filename):
+            os.remove(self.filename)
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+
+''' Metrics of the print service, in the Prometheus text format
+
+    Every process counts in memory. Its exporter writes a snapshot of its
+    metrics to the metrics sub directory of the print temp dir, one file
+    per process, every METRICS_INTERVAL. /metrics adds up the snapshots of
+    the processes (gunicorn workers) of its host only: every container is
+    scraped, the print temp dir is shared by all of them.
+
+    Gauges of processes whose snapshot is older than METRICS_STALE are
+    left out, they are dead. Their counters and histograms are kept, until
+    the snapshot is older than METRICS_TTL.'''
+
+import os
+import json
+import time
+import socket
+import threading
+
+from print3.config import METRICS_DIR, METRICS_INTERVAL, METRICS_STALE, \
+    METRICS_TTL
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# Upper bounds (seconds) of the buckets of the histograms
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+           120, 300)
+
+
+class _Timer(object):
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.time() - self.start)
+
+
+class Counter(object):
+
+    type = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self._lock:
+            self._value += n
+
+    def snapshot(self):
+        with self._lock:
+            return {'value': self._value}
+
+
+class Gauge(Counter):
+
+    type = 'gauge'
+
+    def dec(self, n=1):
+        self.inc(-n)
+
+    def set(self, value):
+        with self._lock:
+            self._value = value
+
+
+class Histogram(object):
+
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._counts = [0] * len(buckets)
+        self._count = 0
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self._count += 1
+            self._sum += value
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self._counts[i] += 1
+                    break
+
+    def time(self):
+        ''' Context manager observing the time spent in its block '''
+        return _Timer(self)
+
+    def snapshot(self):
+        with self._lock:
+            return {'buckets': list(self.buckets),
+                    'counts': list(self._counts),
+                    'count': self._count,
+                    'sum': self._sum}
+
+
+class Registry(object):
+
+    def __init__(self):
+        self._metrics = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help):
+        return self._add(Counter(name, help))
+
+    def gauge(self, name, help):
+        return self._add(Gauge(name, help))
+
+    def histogram(self, name, help, buckets=BUCKETS):
+        return self._add(Histogram(name, help, buckets))
+
+    def snapshot(self):
+        return dict(
+            (m.name, dict(m.snapshot(), type=m.type, help=m.help))
+            for m in self._metrics)
+
+
+REGISTRY = Registry()
+
+# Stages of the print jobs
+SPEC_PARSE_SECONDS = REGISTRY.histogram(
+    'print_spec_parse_seconds', 'Parsing of the posted specs')
+TIMESTAMPS_SECONDS = REGISTRY.histogram(
+    'print_timestamps_seconds', 'Lookup of the timestamps to print')
+SHORTEN_SECONDS = REGISTRY.histogram(
+    'print_shorten_seconds', 'Shortening of the links of the pages')
+PAGE_SECONDS = REGISTRY.histogram(
+    'print_page_seconds', 'Page requests to tomcat (create.json)')
+MERGE_SECONDS = REGISTRY.histogram(
+    'print_merge_seconds', 'Time spent merging the pages of a job')
+INFO_WRITE_SECONDS = REGISTRY.histogram(
+    'print_info_write_seconds', 'Writes of the info files of the jobs')
+
+JOBS = REGISTRY.counter('print_jobs_total', 'Multipages jobs done')
+JOBS_FAILED = REGISTRY.counter(
+    'print_jobs_failed_total', 'Multipages jobs failed')
+JOBS_CANCELLED = REGISTRY.counter(
+    'print_jobs_cancelled_total', 'Multipages jobs cancelled')
+JOBS_REJECTED = REGISTRY.counter(
+    'print_jobs_rejected_total', 'Multipages jobs refused, service busy')
+PAGES = REGISTRY.counter('print_pages_total', 'Pages printed by tomcat')
+PAGES_CACHED = REGISTRY.counter(
+    'print_pages_cached_total', 'Pages taken from the PDF cache')
+PAGES_FAILED = REGISTRY.counter(
+    'print_pages_failed_total', 'Page requests failed')
+PAGE_RETRIES = REGISTRY.counter(
+    'print_page_retries_total', 'Failed pages submitted again')
+RELEASES_CACHE_HITS = REGISTRY.counter(
+    'print_releases_cache_hits_total', 'Releases taken from the cache')
+RELEASES_CACHE_MISSES = REGISTRY.counter(
+    'print_releases_cache_misses_total', 'Releases not in the cache')
+SHORTEN_CACHE_HITS = REGISTRY.counter(
+    'print_shorten_cache_hits_total', 'Short links taken from the cache')
+SHORTEN_CACHE_MISSES = REGISTRY.counter(
+    'print_shorten_cache_misses_total', 'Short links not in the cache')
+
+QUEUED_JOBS = REGISTRY.gauge(
+    'print_queued_jobs', 'Multipages jobs waiting for a job thread')
+ACTIVE_JOBS = REGISTRY.gauge(
+    'print_active_jobs', 'Multipages jobs running')
+BACKEND_CALLS = REGISTRY.gauge(
+    'print_backend_calls', 'Page requests to tomcat in flight')
+
+
+class MetricsExporter(object):
+    ''' Writes the snapshots of a process, reads the ones of all '''
+
+    def __init__(self, print_temp_dir, registry=REGISTRY,
+                 interval=METRICS_INTERVAL):
+        self.directory = os.path.join(print_temp_dir, METRICS_DIR)
+        self.registry = registry
+        self.interval = interval
+        self.host = socket.gethostname()
+        self.name = '{}-{}'.format(self.host, os.getpid())
+        self._thread = None
+        os.makedirs(self.directory, exist_ok=True)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name='print-metrics')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.write()
+            except Exception as e:
+                log.error('[MetricsExporter] Cannot write snapshot: {}'.format(e))
+            time.sleep(self.interval)
+
+    def write(self):
+        filename = os.path.join(self.directory, self.name + '.json')
+        tmpname = '{}.{}.tmp'.format(filename, threading.get_ident())
+        with open(tmpname, 'w') as outfile:
+            json.dump(self.registry.snapshot(), outfile)
+        os.replace(tmpname, filename)
+
+    def _snapshots(self):
+        ''' Yields (snapshot, alive) of the other processes of the host '''
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.json') or \
+                    entry.name == self.name + '.json':
+                continue
+            try:
+                age = now - entry.stat().st_mtime
+                if age > METRICS_TTL:
+                    os.remove(entry.path)
+                    continue
+                if entry.name[:-5].rsplit('-', 1)[0] != self.host:
+                    continue
+                with open(entry.path) as infile:
+                    yield (json.load(infile), age <= METRICS_STALE)
+            except (OSError, ValueError):
+                continue
+
+    def collect(self):
+        ''' Returns the metrics of the processes of the host, added up '''
+        metrics = self.registry.snapshot()
+        for snapshot, alive in self._snapshots():
+            for name, other in snapshot.items():
+                metric = metrics.get(name)
+                if metric is None or metric['type'] != other['type']:
+                    continue
+                if metric['type'] == 'histogram':
+                    if metric['buckets'] != other['buckets']:
+                        continue
+                    metric['counts'] = [
+                        a + b for a, b in zip(metric['counts'], other['counts'])]
+                    metric['count'] += other['count']
+                    metric['sum'] += other['sum']
+                elif metric['type'] == 'counter' or alive:
+                    metric['value'] += other['value']
+        return metrics
+
+    def render(self):
+        ''' Returns the metrics of the processes of the host, as text '''
+        lines = []
+        for name, metric in sorted(self.collect().items()):
+            lines.append('# HELP {} {}'.format(name, metric['help']))
+            lines.append('# TYPE {} {}'.format(name, metric['type']))
+            if metric['type'] == 'histogram':
+                cumulative = 0
+                for bound, count in zip(metric['buckets'], metric['counts']):
+                    cumulative += count
+                    lines.append('{}_bucket{{le="{}"}} {}'.format(
+                        name, bound, cumulative))
+                lines.append('{}_bucket{{le="+Inf"}} {}'.format(
+                    name, metric['count']))
+                lines.append('{}_sum {}'.format(name, metric['sum']))
+                lines.append('{}_count {}'.format(name, metric['count']))
+            else:
+                lines.append('{} {}'.format(name, metric['value']))
+        return '\n'.join(lines) + '\n'
+
+
+_exporters = {}
+_exporters_pid = None
+_exporters_lock = threading.Lock()
+
+
+def get_exporter(print_temp_dir):
+    ''' Returns the started exporter of the current process
+
+        Like the runner, it is created lazily, so that every forked
+        gunicorn worker writes its own snapshots.'''
+    global _exporters, _exporters_pid
+    with _exporters_lock:
+        if _exporters_pid != os.getpid():
+            _exporters = {}
+            _exporters_pid = os.getpid()
+        if print_temp_dir not in _exporters:
+            exporter = MetricsExporter(print_temp_dir)
+            exporter.start()
+            _exporters[print_temp_dir] = exporter
+        return _exporters[print_temp_dir]
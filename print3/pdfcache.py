@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+''' Content-addressed cache of the pages printed by tomcat
+
+    Entries are hard links to the printed PDFs, in a sub directory of the
+    print temp dir, named after the key of the spec of their page (see
+    PageSpecBuilder.key). Cached pages are handed out as new hard links,
+    so that evicting an entry never removes a page still in use.
+
+    The modification time of an entry is the time it was added, entries
+    older than max_age are misses: pages show their print date and the
+    data of their layers. The access time of an entry is set when it is
+    used. Once the entries added by a process exceed max_size, it removes
+    the expired and the least recently used ones, until they take 90% of
+    max_size.'''
+
+import os
+import time
+import threading
+
+from print3.config import PDF_CACHE_DIR, PDF_CACHE_SIZE, PDF_CACHE_MAX_AGE
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class PdfCache(object):
+
+    def __init__(self, directory, max_size=PDF_CACHE_SIZE,
+                 max_age=PDF_CACHE_MAX_AGE):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.pdf')
+
+    def link(self, key, filename):
+        ''' Links the page cached for key to filename. Returns False if
+            there is none. '''
+        path = self._path(key)
+        try:
+            stat = os.stat(path)
+            if time.time() - stat.st_mtime > self.max_age:
+                os.remove(path)
+                raise OSError('Expired entry {}'.format(path))
+            os.link(path, filename)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return False
+        try:
+            # Access time of the entry is its last use, see evict
+            os.utime(path, (time.time(), stat.st_mtime))
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+        return True
+
+    def add(self, key, filename):
+        ''' Caches the page printed in filename '''
+        path = self._path(key)
+        tmpname = '{}.{}.{}.tmp'.format(
+            path, os.getpid(), threading.get_ident())
+        try:
+            os.link(filename, tmpname)
+            os.replace(tmpname, path)
+            os.utime(path, None)
+            size = os.path.getsize(path)
+        except OSError as e:
+            log.warning('[PdfCache] Cannot cache {}: {}'.format(filename, e))
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+            return
+        with self._lock:
+            if self._size is not None:
+                self._size += size
+            full = self._size is None or self._size > self.max_size
+        if full:
+            self.evict()
+
+    def evict(self):
+        ''' Removes the expired entries, and the least recently used ones
+            if over max_size '''
+        entries = []
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.pdf'):
+                try:
+                    stat = entry.stat()
+                    if now - stat.st_mtime > self.max_age:
+                        os.remove(entry.path)
+                        continue
+                except OSError:
+                    continue
+                entries.append((stat.st_atime, stat.st_size, entry.path))
+        size = sum(e[1] for e in entries)
+        if size > self.max_size:
+            entries.sort()
+            for atime, entry_size, path in entries:
+                if size <= self.max_size * 0.9:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                size -= entry_size
+        with self._lock:
+            self._size = size
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_pdf_cache(print_temp_dir):
+    ''' Returns the page cache of print_temp_dir, None if disabled '''
+    if not PDF_CACHE_SIZE:
+        return None
+    with _caches_lock:
+        if print_temp_dir not in _caches:
+            _caches[print_temp_dir] = PdfCache(
+                os.path.join(print_temp_dir, PDF_CACHE_DIR))
+        return _caches[print_temp_dir]
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+
+''' Progress of the multipages print jobs
+
+    The state of a running job lives in memory, in the process running it,
+    and is published to a store every time it changes. Updates neither read
+    back the published state nor take a lock shared by all the jobs.
+
+    Clients waiting for a change of a job running in the same process are
+    woken up as soon as it is published. For jobs running elsewhere, the
+    store is read again every PROGRESS_POLL_INTERVAL, by a single poller per
+    job shared by all the clients of the process waiting for it.'''
+
+import os
+import json
+import time
+import hashlib
+import threading
+
+from print3.config import PROGRESS_BACKEND, PROGRESS_POLL_INTERVAL
+from print3.metrics import INFO_WRITE_SECONDS
+from print3.utils import create_info_file
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class FileProgressStore(object):
+    ''' One JSON file per job in the print temp dir (the info file)
+
+        Files are written aside and renamed, so that readers always get a
+        complete document, the previous or the new one.'''
+
+    def __init__(self, print_temp_dir):
+        self.print_temp_dir = print_temp_dir
+
+    def write(self, jobid, data):
+        filename = create_info_file(self.print_temp_dir, jobid)
+        tmpname = '{}.{}.{}.tmp'.format(
+            filename, os.getpid(), threading.get_ident())
+        with INFO_WRITE_SECONDS.time():
+            with open(tmpname, 'w') as outfile:
+                json.dump(data, outfile)
+            os.replace(tmpname, filename)
+
+    def read(self, jobid):
+        ''' Returns the published state of job, None if unknown '''
+        filename = create_info_file(self.print_temp_dir, jobid)
+        try:
+            with open(filename, 'r') as infile:
+                return json.load(infile)
+        except (IOError, ValueError):
+            return None
+
+    def remove(self, jobid):
+        filename = create_info_file(self.print_temp_dir, jobid)
+        if os.path.isfile(filename):
+            os.remove(filename)
+
+
+class MemoryProgressStore(object):
+    ''' Keeps the state of the jobs in the process memory
+
+        Only usable when the jobs and the progress requests are served by
+        the same process, e.g. with the Flask development server.'''
+
+    def __init__(self, print_temp_dir):
+        self.print_temp_dir = print_temp_dir
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def write(self, jobid, data):
+        with self._lock:
+            self._data[jobid] = json.dumps(data)
+
+    def read(self, jobid):
+        with self._lock:
+            data = self._data.get(jobid)
+        return json.loads(data) if data is not None else None
+
+    def remove(self, jobid):
+        with self._lock:
+            self._data.pop(jobid, None)
+
+
+PROGRESS_STORES = {
+    'file': FileProgressStore,
+    'memory': MemoryProgressStore
+}
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_progress_store(print_temp_dir, backend=PROGRESS_BACKEND):
+    with _stores_lock:
+        key = (backend, print_temp_dir)
+        if key not in _stores:
+            _stores[key] = PROGRESS_STORES[backend](print_temp_dir)
+        return _stores[key]
+
+
+# Version of the state of the jobs running in this process
+_versions = {}
+_changes = threading.Condition()
+
+FINAL_STATUSES = ('done', 'failed', 'cancelled')
+
+
+def _notify(jobid, data):
+    with _changes:
+        if data.get('status') in FINAL_STATUSES:
+            _versions.pop(jobid, None)
+        else:
+            _versions[jobid] = _versions.get(jobid, 0) + 1
+        _changes.notify_all()
+
+
+def progress_etag(data):
+    if data is None:
+        return None
+    return hashlib.md5(
+        json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+class _ProgressPoller(object):
+    ''' Reads the progress of a job running in another process, for all
+        the clients of this process waiting for it to change '''
+
+    def __init__(self, store, jobid, interval):
+        self.store = store
+        self.jobid = jobid
+        self.interval = interval
+        self.waiters = 0
+        self.reads = 0
+        self.data = None
+        self.etag = None
+        thread = threading.Thread(target=self._run, name='print-progress')
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            data = self.store.read(self.jobid)
+            with _polled:
+                self.data = data
+                self.etag = progress_etag(data)
+                self.reads += 1
+                _polled.notify_all()
+                if not self.waiters:
+                    # Stopped once the last client is gone
+                    del _pollers[(self.store, self.jobid)]
+                    return
+
+
+# Pollers of the jobs running elsewhere, by (store, jobid)
+_pollers = {}
+_polled = threading.Condition()
+
+
+def _wait_for_poll(store, jobid, data, etag, timeout, interval):
+    with _polled:
+        poller = _pollers.get((store, jobid))
+        if poller is None:
+            poller = _ProgressPoller(store, jobid, interval)
+            _pollers[(store, jobid)] = poller
+        poller.waiters += 1
+        reads = poller.reads
+        try:
+            _polled.wait_for(
+                lambda: poller.reads > reads and
+                (poller.data is None or poller.etag != etag), timeout)
+        finally:
+            poller.waiters -= 1
+        if poller.reads > reads:
+            return (poller.data, poller.etag)
+    return (data, etag)
+
+
+def wait_for_change(store, jobid, etag, timeout,
+                    interval=PROGRESS_POLL_INTERVAL):
+    ''' Returns (data, etag) of the job once its etag differs from the
+        given one, or the current ones after timeout seconds '''
+    deadline = time.time() + timeout
+    while True:
+        with _changes:
+            version = _versions.get(jobid)
+        data = store.read(jobid)
+        current = progress_etag(data)
+        remaining = deadline - time.time()
+        if data is None or current != etag or remaining <= 0:
+            return (data, current)
+        if version is None:
+            return _wait_for_poll(store, jobid, data, current, remaining,
+                                  interval)
+        with _changes:
+            _changes.wait_for(
+                lambda: _versions.get(jobid) != version, remaining)
+
+
+class JobProgress(object):
+    ''' State of a running job, published to the store on every change
+
+        Once final, the state is only changed by reset, late updates of
+        the pages still running are ignored.'''
+
+    def __init__(self, store, jobid, **data):
+        self.store = store
+        self.jobid = jobid
+        self._lock = threading.Lock()
+        self._data = {}
+        self.reset(**data)
+
+    def _publish(self):
+        try:
+            self.store.write(self.jobid, self._data)
+        except Exception as e:
+            log.error('[JobProgress {}] Cannot publish progress: {}'.format(
+                self.jobid, e))
+        _notify(self.jobid, self._data)
+
+    def reset(self, **data):
+        with self._lock:
+            self._data = data
+            self._publish()
+
+    def _final(self):
+        return self._data.get('status') in FINAL_STATUSES
+
+    def update(self, **values):
+        with self._lock:
+            if self._final():
+                return
+            self._data.update(values)
+            self._publish()
+
+    def increment(self, key, n=1):
+        with self._lock:
+            if self._final():
+                return
+            self._data[key] = self._data.get(key, 0) + n
+            self._publish()
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._data.get(key, default)
@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+
+''' Long-lived runner for the multipages print jobs
+
+    Every (gunicorn) worker process owns a single runner. Jobs are put in
+    a queue and processed by a fixed number of job threads, while the pages
+    of all the jobs share one bounded executor. The load put on the tomcat
+    backend is therefore capped, whatever the number of users printing,
+    and the page requests in flight are further adapted to the latency and
+    errors of tomcat (see AdaptiveLimiter). The executor runs the pages of
+    the jobs in turn, so that a short job is not queued behind all the
+    pages of a long one.
+
+    Pages are waiting on tomcat most of the time, so they are run on threads
+    sharing a keep-alive session, with one pooled connection per thread.
+    Running jobs are registered with the runner, to be cancelled.
+
+    With a shared job queue (see FileJobQueue), the runner claims queued
+    jobs whenever a job thread is free, and renews the leases of its running
+    jobs. Jobs whose lease was lost are stopped. Runners finding no job to
+    claim look for them less and less often.
+
+    Job threads are daemons, so the runner of an exiting worker is drained
+    first: it waits for the running jobs, then stops the ones left.'''
+
+import os
+import time
+import queue
+import threading
+import collections
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from print3.cancel import JobControl, cancellable
+from print3.limiter import AdaptiveLimiter
+from print3.metrics import QUEUED_JOBS, ACTIVE_JOBS
+from print3.config import MAX_CONCURRENT_JOBS, MAX_BACKEND_CALLS, \
+    MAX_LOOKUP_CALLS, CANCEL_POLL_INTERVAL, CANCEL_MAX_POLL_INTERVAL, \
+    JOB_QUEUE_POLL_INTERVAL, JOB_QUEUE_MAX_POLL_INTERVAL, JOB_LEASE_HEARTBEAT, \
+    JOB_DRAIN_GRACE
+from print3.utils import create_session
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class FairExecutor(object):
+    ''' Thread pool running the calls submitted with different keys (jobs)
+        in turn, and the calls of a same key in order '''
+
+    def __init__(self, max_workers, thread_name_prefix='fair'):
+        self._queues = collections.OrderedDict()
+        self._cond = threading.Condition()
+        for i in range(max_workers):
+            t = threading.Thread(
+                target=self._work, name='{}_{}'.format(thread_name_prefix, i))
+            t.daemon = True
+            t.start()
+
+    def submit(self, key, func, *args):
+        future = Future()
+        with self._cond:
+            self._queues.setdefault(key, collections.deque()).append(
+                (future, func, args))
+            self._cond.notify()
+        return future
+
+    def _next(self):
+        key, calls = next(iter(self._queues.items()))
+        call = calls.popleft()
+        if calls:
+            self._queues.move_to_end(key)
+        else:
+            del self._queues[key]
+        return call
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._queues:
+                    self._cond.wait()
+                future, func, args = self._next()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = func(*args)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+
+class JobRunner(object):
+
+    def __init__(self, max_jobs=MAX_CONCURRENT_JOBS,
+                 max_pages=MAX_BACKEND_CALLS, max_lookups=MAX_LOOKUP_CALLS):
+        self.max_jobs = max_jobs
+        self.max_pages = max_pages
+        self._jobs = queue.Queue()
+        self._pages = FairExecutor(
+            max_workers=max_pages, thread_name_prefix='print-page')
+        self.session = cancellable(create_session(pool_size=max_pages))
+        self.limiter = AdaptiveLimiter(maximum=max_pages)
+        # Calls to the api, kept apart so that they never wait behind pages
+        self._lookups = ThreadPoolExecutor(
+            max_workers=max_lookups, thread_name_prefix='print-lookup')
+        self._lock = threading.Lock()
+        self._active_jobs = 0
+        self._pending_pages = 0
+        self._controls = {}
+        # Next look for the cancel file of the jobs, and its interval
+        self._cancel_checks = {}
+        self._queue = None
+        self._draining = False
+        self._wakeup = threading.Event()
+        self._threads = []
+        for i in range(max_jobs):
+            t = threading.Thread(
+                target=self._run, name='print-job-%d' % i)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+        t = threading.Thread(target=self._watch, name='print-cancel')
+        t.daemon = True
+        t.start()
+        self._threads.append(t)
+
+    def _run(self):
+        while True:
+            func, args, key = self._jobs.get()
+            QUEUED_JOBS.dec()
+            ACTIVE_JOBS.inc()
+            with self._lock:
+                self._active_jobs += 1
+            try:
+                func(*args)
+            except Exception as e:
+                log.error('[JobRunner] Job failed: {}'.format(e))
+                log.error(e, exc_info=True)
+            finally:
+                with self._lock:
+                    self._active_jobs -= 1
+                ACTIVE_JOBS.dec()
+                self._jobs.task_done()
+                if self._queue is not None:
+                    # A job thread is free, claim the next job
+                    self._wakeup.set()
+
+    def _watch(self):
+        ''' Cancels the running jobs whose cancel file was written by
+            another process, or whose lease was lost '''
+        while True:
+            time.sleep(CANCEL_POLL_INTERVAL)
+            try:
+                self._watch_once()
+            except Exception as e:
+                log.error('[JobRunner] Error while watching jobs: {}'.format(e))
+
+    def _cancel_due(self, control, now):
+        ''' Returns True if the cancel file of a job is to be looked for.
+            Jobs with no page pending are looked at less and less often. '''
+        next_check, interval = self._cancel_checks.get(
+            control.jobid, (0, CANCEL_POLL_INTERVAL))
+        if now < next_check:
+            return False
+        if control.idle:
+            interval = min(interval * 2, CANCEL_MAX_POLL_INTERVAL)
+        else:
+            interval = CANCEL_POLL_INTERVAL
+        self._cancel_checks[control.jobid] = (now + interval, interval)
+        return True
+
+    def _watch_once(self):
+        with self._lock:
+            controls = list(self._controls.values())
+        now = time.time()
+        # Jobs of the job queue are marked cancelled in its directory,
+        # listed once for all of them
+        cancelled = {}
+        for control in controls:
+            lease = control.lease
+            if lease is not None and not control.cancelled and \
+                    id(lease.queue) not in cancelled:
+                cancelled[id(lease.queue)] = lease.queue.cancelled()
+        for control in controls:
+            if control.cancelled:
+                continue
+            lease = control.lease
+            if lease is None:
+                if control.cancelfile and self._cancel_due(control, now) \
+                        and os.path.exists(control.cancelfile):
+                    control.cancel()
+            elif control.jobid in cancelled[id(lease.queue)]:
+                control.cancel()
+            elif now - lease.renewed > JOB_LEASE_HEARTBEAT and \
+                    not lease.renew():
+                log.warning('[JobRunner] Lease of job {} lost'.format(
+                    control.jobid))
+                control.cancel()
+
+    def _free_threads(self):
+        with self._lock:
+            return self.max_jobs - self._active_jobs - self._jobs.qsize()
+
+    def _serve(self, func):
+        interval = JOB_QUEUE_POLL_INTERVAL
+        while True:
+            if self._wakeup.wait(interval):
+                interval = JOB_QUEUE_POLL_INTERVAL
+            self._wakeup.clear()
+            claimed = False
+            while self._free_threads() > 0 and not self._draining:
+                try:
+                    lease = self._queue.claim()
+                except Exception as e:
+                    log.error('[JobRunner] Cannot claim jobs: {}'.format(e))
+                    break
+                if lease is None:
+                    break
+                claimed = True
+                self.submit(func, lease)
+            if claimed:
+                interval = JOB_QUEUE_POLL_INTERVAL
+            else:
+                interval = min(interval * 2, JOB_QUEUE_MAX_POLL_INTERVAL)
+
+    def serve(self, queue, func):
+        ''' Runs func(lease) for the jobs claimed from queue '''
+        with self._lock:
+            if self._queue is not None:
+                return
+            self._queue = queue
+        t = threading.Thread(
+            target=self._serve, args=(func,), name='print-claim')
+        t.daemon = True
+        t.start()
+        self._threads.append(t)
+
+    def wakeup(self):
+        ''' Looks for queued jobs right away '''
+        self._wakeup.set()
+
+    def register(self, jobid, cancelfile=None, lease=None):
+        ''' Returns the JobControl of a starting job '''
+        control = JobControl(jobid, cancelfile, lease)
+        with self._lock:
+            self._controls[jobid] = control
+        if cancelfile and os.path.exists(cancelfile):
+            control.cancel()
+        return control
+
+    def unregister(self, jobid):
+        with self._lock:
+            self._controls.pop(jobid, None)
+        self._cancel_checks.pop(jobid, None)
+
+    def cancel(self, jobid):
+        ''' Cancels a job running in this process, returns False if there
+            is none '''
+        with self._lock:
+            control = self._controls.get(jobid)
+        return control is not None and control.cancel()
+
+    def submit(self, func, *args, key=None):
+        ''' Queue a job, to be run as soon as a job thread is available.
+            key is the id of the job, returned by drain if it did not run. '''
+        QUEUED_JOBS.inc()
+        self._jobs.put((func, args, key))
+
+    def _wait_idle(self, timeout):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with self._lock:
+                if not self._active_jobs:
+                    return True
+            time.sleep(0.05)
+        return False
+
+    def drain(self, timeout, grace=JOB_DRAIN_GRACE):
+        ''' Stops claiming jobs, drops the jobs not started and waits at
+            most timeout for the running ones. Jobs still running are then
+            stopped: the ones of the job queue are left to another runner,
+            the others are abandoned.
+
+            Returns the ids of the jobs which were not run to their end,
+            other than the ones of the job queue. '''
+        self._draining = True
+        stopped = []
+        while True:
+            try:
+                func, args, key = self._jobs.get_nowait()
+            except queue.Empty:
+                break
+            QUEUED_JOBS.dec()
+            self._jobs.task_done()
+            if key is not None:
+                stopped.append(key)
+        if self._wait_idle(timeout):
+            return stopped
+        with self._lock:
+            controls = list(self._controls.values())
+        for control in controls:
+            if control.lease is not None:
+                # Claimed again by another runner once the lease expired
+                control.lease.lost = True
+                control.cancel()
+            else:
+                log.warning('[JobRunner] Job {} abandoned'.format(
+                    control.jobid))
+                control.abandon()
+                stopped.append(control.jobid)
+        self._wait_idle(grace)
+        return stopped
+
+    def _page_done(self, future):
+        with self._lock:
+            self._pending_pages -= 1
+
+    def submit_page(self, func, *args, key=None):
+        ''' Run a single page on the shared, bounded page executor, in turn
+            with the pages of the other keys (jobs) '''
+        with self._lock:
+            self._pending_pages += 1
+        future = self._pages.submit(key, func, *args)
+        future.add_done_callback(self._page_done)
+        return future
+
+    def submit_lookup(self, func, *args):
+        ''' Run a short call to the api (e.g. url shortening) '''
+        return self._lookups.submit(func, *args)
+
+    def stats(self):
+        limiter = self.limiter.stats()
+        with self._lock:
+            return {
+                'queued_jobs': self._jobs.qsize(),
+                'active_jobs': self._active_jobs,
+                'max_jobs': self.max_jobs,
+                'pending_pages': self._pending_pages,
+                'max_pages': self.max_pages,
+                'page_limit': limiter['limit'],
+                'inflight_pages': limiter['inflight']
+            }
+
+
+_runner = None
+_runner_pid = None
+_runner_lock = threading.Lock()
+
+
+def get_runner():
+    ''' Returns the runner of the current process, creating it on first use
+
+        The runner is created lazily, so that every forked gunicorn worker
+        gets its own threads.'''
+    global _runner, _runner_pid
+    with _runner_lock:
+        if _runner is None or _runner_pid != os.getpid():
+            _runner = JobRunner()
+            _runner_pid = os.getpid()
+    return _runner
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+
+''' Spec of the single pages of a multipages print
+
+    Vector layers may weigh megabytes, and are identical on every page.
+    Page specs are therefore shallow copies of the original spec, where
+    only the modified parts are copied, and the layers left untouched are
+    serialized once for all the pages.
+
+    The body of the page requests is built from a template, the spec of
+    the job encoded once, and the few values proper to every page (TIME,
+    timestamp, QR code and short link) encoded separately. Bodies are sent
+    as the list of their chunks, never joined into a single buffer. Values
+    of spooled specs (RawJSON) are read from their file while being sent.
+
+    The key of a page spec is the hash of its canonical encoding (sorted
+    keys, no whitespace), without the values not changing the printed page.
+    The layers shared by the pages are hashed once.'''
+
+import re
+import json
+import hashlib
+import threading
+
+from print3.ingest import RawJSON
+
+
+# Placeholders of a page value and of a RawJSON value in a template,
+# escaped by the JSON encoder
+_SLOT = '\x00page-value-{}\x00'
+_RAW = '\x00raw-value-{}\x00'
+_RAW_TOKEN = re.compile(br'"\\u0000raw-value-(\d+)\\u0000"')
+# Values left out of the key: the short link, and the timestamps of the
+# whole print (only TIME is printed on a page)
+VOLATILE_PAGE_VALUES = ('shortLink',)
+VOLATILE_LAYER_VALUES = ('timestamps',)
+
+
+def _without(value, keys):
+    if not isinstance(value, dict):
+        return value
+    return dict((k, v) for k, v in value.items() if k not in keys)
+
+
+def _raw_digest(value):
+    if isinstance(value, RawJSON):
+        digest = hashlib.sha256()
+        for block in value:
+            digest.update(block)
+        return 'raw:' + digest.hexdigest()
+    raise TypeError('{!r} is not JSON serializable'.format(value))
+
+
+def _digest(value):
+    return hashlib.sha256(json.dumps(
+        value, sort_keys=True, separators=(',', ':'),
+        default=_raw_digest).encode('utf-8')).hexdigest()
+
+
+class SpecBody(object):
+    ''' Request body sent chunk by chunk. Its length is known, so it is
+        not sent with the chunked transfer encoding '''
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._length = sum(len(c) for c in chunks)
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            if isinstance(chunk, RawJSON):
+                yield from chunk
+            else:
+                yield chunk
+
+    def __bytes__(self):
+        return b''.join(self)
+
+
+class PageSpecBuilder(object):
+
+    def __init__(self, spec):
+        self.spec = spec
+        # Serialized layers, by index. Only the layers shared with the
+        # original spec are kept.
+        self._layers = {}
+        self._digests = {}
+        self._templates = {}
+        self._raw = {}
+        self._lock = threading.Lock()
+
+    def build(self, timestamp=None, layers=(), legends=True):
+        ''' Returns the spec of the page for timestamp
+
+            TIME is set on the given layers (indices), the legends are only
+            printed if legends is True.'''
+        spec = self.spec
+        page_spec = dict(spec)
+        if 'layers' in spec:
+            page_spec['layers'] = list(spec['layers'])
+        if timestamp is not None and 'layers' in spec:
+            for idx in layers:
+                try:
+                    layer = dict(page_spec['layers'][idx])
+                    layer['params'] = dict(layer['params'])
+                    layer['params']['TIME'] = str(timestamp)
+                    page_spec['layers'][idx] = layer
+                except (KeyError, IndexError, TypeError):
+                    pass
+        if spec.get('pages'):
+            page_spec['pages'] = [dict(spec['pages'][0])] + spec['pages'][1:]
+        if 'legends' in page_spec and not legends:
+            del page_spec['legends']
+            page_spec['enableLegends'] = False
+        return page_spec
+
+    def _default(self, value):
+        if isinstance(value, RawJSON):
+            self._raw[id(value)] = value
+            return _RAW.format(id(value))
+        raise TypeError('{!r} is not JSON serializable'.format(value))
+
+    def _dumps_layer(self, idx, layer):
+        if idx >= len(self.spec['layers']) or \
+                layer is not self.spec['layers'][idx]:
+            return json.dumps(layer, default=self._default)
+        if idx not in self._layers:
+            self._layers[idx] = json.dumps(layer, default=self._default)
+        return self._layers[idx]
+
+    def dumps(self, page_spec):
+        ''' Serializes a page spec returned by build, RawJSON values are
+            replaced by placeholders '''
+        if 'layers' not in page_spec:
+            return json.dumps(page_spec, default=self._default)
+        head = json.dumps(dict(
+            (k, v) for k, v in page_spec.items() if k != 'layers'),
+            default=self._default)
+        layers = '"layers": [' + ', '.join(
+            self._dumps_layer(idx, layer)
+            for idx, layer in enumerate(page_spec['layers'])) + ']'
+        if head == '{}':
+            return '{' + layers + '}'
+        return head[:-1] + ', ' + layers + '}'
+
+    def _layer_digest(self, idx, layer):
+        if idx >= len(self.spec['layers']) or \
+                layer is not self.spec['layers'][idx]:
+            return _digest(_without(layer, VOLATILE_LAYER_VALUES))
+        if idx not in self._digests:
+            self._digests[idx] = _digest(
+                _without(layer, VOLATILE_LAYER_VALUES))
+        return self._digests[idx]
+
+    def key(self, page_spec, *extra):
+        ''' Returns the key of a page spec returned by build, and of the
+            extra values the page depends on '''
+        spec = dict(page_spec)
+        if 'layers' in spec:
+            spec['layers'] = [self._layer_digest(idx, layer)
+                              for idx, layer in enumerate(spec['layers'])]
+        if spec.get('pages'):
+            spec['pages'] = [_without(page, VOLATILE_PAGE_VALUES)
+                             for page in spec['pages']]
+        return _digest([spec, extra])
+
+    def _page_values(self, page_spec):
+        ''' Returns the paths and values proper to page_spec '''
+        values = []
+        shared = self.spec.get('layers', [])
+        for idx, layer in enumerate(page_spec.get('layers', [])):
+            if idx < len(shared) and layer is shared[idx]:
+                continue
+            params = layer.get('params') if isinstance(layer, dict) else None
+            if isinstance(params, dict) and 'TIME' in params:
+                values.append((('layers', idx, 'params', 'TIME'),
+                               params['TIME']))
+        if page_spec.get('pages'):
+            for key in ('timestamp', 'shortLink'):
+                if key in page_spec['pages'][0]:
+                    values.append((('pages', 0, key),
+                                   page_spec['pages'][0][key]))
+        if 'qrcodeurl' in page_spec:
+            values.append((('qrcodeurl',), page_spec['qrcodeurl']))
+        return values
+
+    def _split(self, buf, slots=0):
+        ''' Splits the encoded buf where the slots and the RawJSON values
+            are. Returns the list of chunks, RawJSON values and slot indices,
+            or None if a slot is not found exactly once. '''
+        positions = []
+        for slot in range(slots):
+            token = json.dumps(_SLOT.format(slot)).encode('utf-8')
+            pos = buf.find(token)
+            if pos < 0 or buf.find(token, pos + 1) >= 0:
+                return None
+            positions.append((pos, pos + len(token), slot))
+        for m in _RAW_TOKEN.finditer(buf):
+            raw = self._raw.get(int(m.group(1)))
+            if raw is not None:
+                positions.append((m.start(), m.end(), raw))
+        positions.sort(key=lambda p: p[0])
+
+        view = memoryview(buf)
+        parts = []
+        start = 0
+        for pos, end, part in positions:
+            parts.append(view[start:pos])
+            parts.append(part)
+            start = end
+        parts.append(view[start:])
+        return parts
+
+    def _template(self, page_spec, paths):
+        ''' Returns the parts of the encoded page_spec, the values of the
+            given paths being replaced by their index '''
+        tpl_spec = dict(page_spec)
+        if 'layers' in tpl_spec:
+            tpl_spec['layers'] = list(tpl_spec['layers'])
+        if tpl_spec.get('pages'):
+            tpl_spec['pages'] = list(tpl_spec['pages'])
+        for slot, path in enumerate(paths):
+            parent = tpl_spec
+            for key in path[:-1]:
+                child = parent[key]
+                if isinstance(child, dict):
+                    child = dict(child)
+                    parent[key] = child
+                parent = child
+            parent[path[-1]] = _SLOT.format(slot)
+
+        return self._split(self.dumps(tpl_spec).encode('utf-8'), len(paths))
+
+    def body(self, page_spec):
+        ''' Returns the request body of a page spec returned by build '''
+        values = self._page_values(page_spec)
+        paths = tuple(path for path, value in values)
+        signature = (paths, 'legends' in page_spec,
+                     page_spec.get('enableLegends'))
+        with self._lock:
+            if signature not in self._templates:
+                self._templates[signature] = self._template(page_spec, paths)
+            template = self._templates[signature]
+        if template is None:
+            return SpecBody(self._split(self.dumps(page_spec).encode('utf-8')))
+
+        patches = [json.dumps(value).encode('utf-8') for path, value in values]
+        return SpecBody([patches[part] if isinstance(part, int) else part
+                         for part in template])
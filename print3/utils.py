@@ -1,5 +1,4 @@
 import os
-import time
 import re
 import urllib
 import requests
@@ -7,22 +6,49 @@ from collections import OrderedDict
 from urllib.parse import urlparse, parse_qs, urlunparse
 from urllib.parse import urlencode, quote, unquote
 
-import json
-
 from print3.config import (
     MAPFISH_MULTI_FILE_PREFIX,
+    MAX_LOOKUP_CALLS,
     VERIFY_SSL,
     USE_LV95_SERVICES,
-    REFERER_URL)
+    REFERER_URL,
+    RELEASES_CACHE_TTL,
+    RELEASES_CACHE_SIZE,
+    RELEASES_CACHE_DIR,
+    SHORTEN_CACHE_TTL,
+    SHORTEN_CACHE_SIZE,
+    SHORTEN_TIMEOUT,
+    SHORTEN_API_URL)
+from print3.cache import TTLCache
+from print3.metrics import RELEASES_CACHE_HITS, RELEASES_CACHE_MISSES, \
+    SHORTEN_CACHE_HITS, SHORTEN_CACHE_MISSES
 
 
 import logging
 log = logging.getLogger(__name__)
 
 
-req_session = requests.Session()
-req_session.mount('http://', requests.adapters.HTTPAdapter(max_retries=0))
-req_session.mount('https://', requests.adapters.HTTPAdapter(max_retries=0))
+def create_session(pool_size=requests.adapters.DEFAULT_POOLSIZE):
+    ''' Returns a session keeping up to pool_size connections alive per
+        host, so that concurrent threads can share it '''
+    session = requests.Session()
+    for prefix in ('http://', 'https://'):
+        session.mount(prefix, requests.adapters.HTTPAdapter(
+            pool_maxsize=pool_size, max_retries=0))
+    return session
+
+
+req_session = create_session(pool_size=MAX_LOOKUP_CALLS)
+
+releases_cache = TTLCache(maxsize=RELEASES_CACHE_SIZE,
+                          ttl=RELEASES_CACHE_TTL,
+                          directory=RELEASES_CACHE_DIR,
+                          hits_metric=RELEASES_CACHE_HITS,
+                          misses_metric=RELEASES_CACHE_MISSES)
+
+shorten_cache = TTLCache(maxsize=SHORTEN_CACHE_SIZE, ttl=SHORTEN_CACHE_TTL,
+                         hits_metric=SHORTEN_CACHE_HITS,
+                         misses_metric=SHORTEN_CACHE_MISSES)
 
 
 def create_pdf_path(print_temp_dir, unique_filename):
@@ -49,39 +75,6 @@ def create_cancel_file(print_temp_dir, unique_filename):
         '.cancel')
 
 
-def delete_old_files(path):
-    now = time.time()
-    # older than 1 hour
-    cutoff = now - 3600
-    files = os.listdir(path)
-    for xfile in files:
-        if MAPFISH_MULTI_FILE_PREFIX not in xfile:
-            continue
-        fn = path + '/' + xfile
-        if os.path.isfile(fn):
-            t = os.stat(fn)
-            c = t.st_ctime
-            if c < cutoff:
-                os.remove(fn)
-
-
-def _increment_info(l, filename):
-    l.acquire()
-    try:
-        with open(filename, 'r') as infile:
-            data = json.load(infile)
-
-        data['done'] = data['done'] + 1
-
-        with open(filename, 'w+') as outfile:
-            json.dump(data, outfile)
-    except:
-        pass
-
-    finally:
-        l.release()
-
-
 def _normalize_projection(coords, use_lv95=USE_LV95_SERVICES):
     '''Converts point and bbox to LV95, if needed, i.e. if source coords is
        LV03 and backend service supports LV95
@@ -120,6 +113,18 @@ def _get_releases_info(url):
         return []
 
 
+def _releases_cache_key(d, api_url):
+    '''The releases only depend on the extent (rounded to the meter), the
+       size of the map and the spatial reference'''
+    try:
+        extent = ','.join(
+            str(int(round(float(c)))) for c in d['mapExtent'].split(','))
+    except (KeyError, ValueError, AttributeError):
+        extent = d.get('mapExtent')
+    return '{}|{}|{}|{}'.format(
+        api_url, extent, d.get('imageDisplay'), d.get('sr'))
+
+
 def _zeitreihen(d, api_url):
     '''Returns the timestamps for a given scale and location for
        layer ch.swisstopo.zeitreihen
@@ -129,12 +134,23 @@ def _zeitreihen(d, api_url):
 
     sr = 2056 if USE_LV95_SERVICES else 21781
     d['sr'] = sr
+
+    key = _releases_cache_key(d, api_url)
+    timestamps = releases_cache.get(key)
+    if timestamps is not None:
+        log.debug('[_zeitreihen] Releases from cache %s (%s)',
+                  key, releases_cache.stats())
+        return timestamps
+
     params = urlencode(d)
     path_tpl = '/rest/services/ech/MapServer/' + \
         'ch.swisstopo.zeitreihen/releases?%s'
     url = 'http:' + api_url + path_tpl % params
 
     timestamps = _get_releases_info(url)
+    # Failures also return an empty list, do not cache them
+    if timestamps:
+        releases_cache.set(key, timestamps)
 
     return timestamps
 
@@ -238,15 +254,22 @@ def _qrcodeurlunparse(url_tuple):
     return qrcode_service_url + "?url=" + quoted_map_url
 
 
-def _shorten(url, api_url='http://api3.geo.admin.ch'):
-    ''' Shorten a possibly long url '''
+def _shorten(url, api_url=SHORTEN_API_URL):
+    ''' Shorten a possibly long url, returns it unchanged on failure '''
 
     shorten_url = api_url + '/shorten.json?url=%s' % quote(url)
 
+    shorturl = shorten_cache.get(shorten_url)
+    if shorturl is not None:
+        return shorturl
+
     try:
-        r = requests.get(shorten_url, verify=VERIFY_SSL)
+        r = req_session.get(shorten_url, verify=VERIFY_SSL,
+                            timeout=SHORTEN_TIMEOUT)
         if r.status_code == requests.codes.ok:
             shorturl = r.json()['shorturl']
+            shorten_cache.set(shorten_url, shorturl)
             return shorturl
     except:
-        return url
+        pass
+    return url
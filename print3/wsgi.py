@@ -2,15 +2,46 @@
 
 import os
 import multiprocessing
-from gunicorn.app.base import BaseApplication
-from gunicorn.six import iteritems
-from print3.main import app as application
+
+from print3.config import WORKER_CLASS, WORKER_CONNECTIONS, WORKER_THREADS
+
+# Sockets, locks and sleeps of the app (requests to tomcat, progress
+# long-polls, body reads) must be cooperative, patch before loading it
+if WORKER_CLASS == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
+from gunicorn.app.base import BaseApplication  # noqa: E402
+from gunicorn.six import iteritems  # noqa: E402
+from print3.main import (  # noqa: E402
+    app as application, serve_job_queue, drain_jobs)
 
 
 def number_of_workers():
     return (multiprocessing.cpu_count() * 2) + 1
 
 
+def worker_options(worker_class=WORKER_CLASS):
+    options = {'worker_class': worker_class}
+    if worker_class == 'gevent':
+        options['worker_connections'] = WORKER_CONNECTIONS
+    elif worker_class == 'gthread':
+        options['threads'] = WORKER_THREADS
+    return options
+
+
+def post_worker_init(worker):
+    ''' Workers claim queued jobs from their start, not their first
+        request '''
+    serve_job_queue()
+
+
+def worker_exit(server, worker):
+    ''' Jobs run in threads of the workers, which are not waited for:
+        exiting workers (restarts, max_requests) drain their jobs first '''
+    drain_jobs()
+
+
 class StandaloneApplication(BaseApplication):
 
     def __init__(self, app, options=None):
@@ -33,5 +64,8 @@ if __name__ == '__main__':
     options = {
         'bind': '%s:%s' % ('0.0.0.0', WSGI_PORT),
         'workers': number_of_workers(),
+        'post_worker_init': post_worker_init,
+        'worker_exit': worker_exit,
     }
+    options.update(worker_options())
     StandaloneApplication(application, options).run()
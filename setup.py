@@ -11,7 +11,7 @@ setup(name='print3',
       author_email='',
       license='MIT',
       url='https://github.com/geoadmin/service-print',
-      packages=find_packages(exclude=['tests']),
+      packages=find_packages(exclude=['tests', 'benchmarks']),
       package_dir={'print3': 'print3'},
       include_package_data=True,
       zip_safe=False,
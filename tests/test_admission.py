@@ -0,0 +1,38 @@
+import unittest
+
+from print3.admission import Admission
+from print3.progress import MemoryProgressStore
+
+
+class TestAdmission(unittest.TestCase):
+
+    def setUp(self):
+        self.store = MemoryProgressStore(None)
+        self.admission = Admission(self.store, max_jobs=3, max_client_jobs=2,
+                                   max_pages=10)
+
+    def admit(self, jobid, client, pending_pages=0):
+        self.store.write(jobid, {'status': 'ongoing'})
+        return self.admission.admit(jobid, client, pending_pages)
+
+    def test_client_quota(self):
+        self.assertTrue(self.admit('1', 'a'))
+        self.assertTrue(self.admit('2', 'a'))
+        self.assertFalse(self.admit('3', 'a'))
+        self.assertTrue(self.admit('4', 'b'))
+        # Too many jobs
+        self.assertFalse(self.admit('5', 'c'))
+        self.assertEqual(self.admission.stats(),
+                         {'admitted_jobs': 3, 'rejected_jobs': 2})
+
+    def test_jobs_over_are_forgotten(self):
+        self.assertTrue(self.admit('1', 'a'))
+        self.assertTrue(self.admit('2', 'a'))
+        self.store.write('1', {'status': 'done'})
+        self.assertTrue(self.admit('3', 'a'))
+        self.store.remove('2')
+        self.assertTrue(self.admit('4', 'a'))
+
+    def test_pending_pages(self):
+        self.assertFalse(self.admit('1', 'a', pending_pages=11))
+        self.assertTrue(self.admit('2', 'a', pending_pages=10))
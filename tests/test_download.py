@@ -0,0 +1,52 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from print3.download import DownloadStage
+
+
+class TestDownloadStage(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.stage = DownloadStage(os.path.join(self.tmpdir, 'staged'),
+                                   max_size=25)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def merged(self, name, size=10, mtime=1000000000):
+        filename = os.path.join(self.tmpdir, name)
+        with open(filename, 'wb') as f:
+            f.write(b'x' * size)
+        os.utime(filename, (mtime, mtime))
+        return filename
+
+    def test_stage(self):
+        source = self.merged('a.pdf')
+        path = self.stage.stage(source)
+        self.assertEqual(os.path.dirname(path), self.stage.directory)
+        self.assertEqual(os.path.getmtime(path), 1000000000)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'x' * 10)
+
+        # Copied again only if the source changed
+        with open(path, 'wb') as f:
+            f.write(b'y' * 10)
+        os.utime(path, (1000000000, 1000000000))
+        self.assertEqual(self.stage.stage(source), path)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'y' * 10)
+        self.merged('a.pdf', size=12, mtime=1000000001)
+        self.stage.stage(source)
+        self.assertEqual(os.path.getsize(path), 12)
+
+    def test_least_recently_served_are_evicted(self):
+        for name in ('a.pdf', 'b.pdf', 'c.pdf'):
+            self.stage.stage(self.merged(name))
+            os.utime(os.path.join(self.stage.directory, name),
+                     ({'a.pdf': 3, 'b.pdf': 1, 'c.pdf': 2}[name], 1000000000))
+        self.stage.stage(self.merged('d.pdf'))
+        self.assertEqual(sorted(os.listdir(self.stage.directory)),
+                         ['a.pdf', 'd.pdf'])
@@ -1,11 +1,14 @@
 import os
+import shutil
+import tempfile
+import time
 import unittest
-import json
-import multiprocessing
 import mock
 
 
-from print3.utils import _normalize_projection, _normalize_imageDisplay, _qrcodeurlparse, _qrcodeurlunparse, _increment_info, _zeitreihen
+from print3.utils import _normalize_projection, _normalize_imageDisplay, _qrcodeurlparse, _qrcodeurlunparse, _zeitreihen, _shorten
+from print3.cache import TTLCache
+from print3.metrics import Registry
 
 
 url_tuple = ("https://mf-chsdi3.dev.bgdi.ch/qrcodegenerator",
@@ -22,20 +25,13 @@ url_tuple = ("https://mf-chsdi3.dev.bgdi.ch/qrcodegenerator",
 
 qrcodeurl = "https://mf-chsdi3.dev.bgdi.ch/qrcodegenerator?url=https%3A%2F%2Fmf-geoadmin3.dev.bgdi.ch%2F%3Flang%3Dfr%26topic%3Dech%26bgLayer%3DvoidLayer%26layers%3Dch.swisstopo.zeitreihen%2Cch.bfs.gebaeude_wohnungs_register%2Cch.bav.haltestellen-oev%2Cch.swisstopo.swisstlm3d-wanderwege%26layers_visibility%3Dtrue%2Cfalse%2Cfalse%2Cfalse%26layers_timestamp%3D18641231%2C%2C%2C%26E%3D2499845.99%26N%3D1117341.56%26zoom%3D5"
 
-lockfile = "tests/data/lock.json"
-
 
 class TestServicePrintFunctional(unittest.TestCase):
 
     def setUp(self):
-        data = {"done": 0}
-        with open(lockfile, "w") as f:
-            f.write(json.dumps(data))
         self.patch = None
 
     def tearDown(self):
-        if os.path.exists(lockfile):
-            os.remove(lockfile)
         if self.patch:
             self.patch.stop()
 
@@ -78,17 +74,6 @@ class TestServicePrintFunctional(unittest.TestCase):
 
         self.assertEqual(result_url, 'https://mf-chsdi3.dev.bgdi.ch/qrcodegenerator?url=https%3A//mf-geoadmin3.dev.bgdi.ch/%3Furl%3Dlang%3Dfr%26layers_visibility%3Dtrue%2Cfalse%2Cfalse%2Cfalse%26bgLayer%3DvoidLayer%26E%3D2499845.99%26layers%3Dch.swisstopo.zeitreihen%2Cch.bfs.gebaeude_wohnungs_register%2Cch.bav.haltestellen-oev%2Cch.swisstopo.swisstlm3d-wanderwege%26zoom%3D5%26N%3D1117341.56%26topic%3Dech%26layers_timestamp%3D18641231%2C%2C%2C')
 
-    def test_increment_info(self):
-
-        lock = multiprocessing.Manager().Lock()
-
-        _increment_info(lock, lockfile)
-
-        with open(lockfile, 'r') as l:
-            data = json.loads(l.read())
-
-        self.assertEqual(data['done'], 1)
-
     def test_zeitreihen_release(self):
         timestamps_expected = ['2005', '2010']
         import print3
@@ -98,3 +83,72 @@ class TestServicePrintFunctional(unittest.TestCase):
         timestamps = _zeitreihen({}, 'http://foo')
 
         self.assertEqual(timestamps_expected, timestamps)
+
+    def test_zeitreihen_release_cached(self):
+        import print3
+        releases = mock.Mock(return_value=['1990', '2000'])
+        self.patch = mock.patch.object(print3.utils, '_get_releases_info', releases)
+        self.patch.start()
+        params = {'mapExtent': '2600000.2,1200000.4,2610000.1,1210000.3',
+                  'imageDisplay': '3555,1777,256.0'}
+
+        first = _zeitreihen(dict(params), '//api.cache.test')
+        params['mapExtent'] = '2600000.3,1200000.1,2610000.0,1210000.4'
+        second = _zeitreihen(dict(params), '//api.cache.test')
+
+        self.assertEqual(first, ['1990', '2000'])
+        self.assertEqual(second, ['1990', '2000'])
+        self.assertEqual(releases.call_count, 1)
+
+    def test_ttl_cache(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        # b is the least recently used
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats(), {'size': 2, 'hits': 2, 'misses': 1})
+
+        cache = TTLCache(ttl=0.01)
+        cache.set('a', 1)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('a'))
+
+    def test_ttl_cache_shared_directory(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            TTLCache(directory=tmpdir).set('a', ['2000'])
+            hits = Registry().counter('hits_total', 'Hits')
+            cache = TTLCache(directory=tmpdir, hits_metric=hits)
+            self.assertEqual(cache.get('a'), ['2000'])
+            self.assertEqual(cache.stats()['hits'], 1)
+            self.assertEqual(hits.snapshot(), {'value': 1})
+
+            # Expired entries are removed when read
+            cache = TTLCache(ttl=0.01, directory=tmpdir)
+            cache.set('b', ['1990'])
+            time.sleep(0.02)
+            self.assertIsNone(cache.get('b'))
+            self.assertEqual(len(os.listdir(tmpdir)), 1)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_shorten_cached(self):
+        import print3
+        response = mock.Mock(status_code=200)
+        response.json.return_value = {'shorturl': 'https://s.geo.admin.ch/1'}
+        get = mock.Mock(return_value=response)
+        self.patch = mock.patch.object(print3.utils.req_session, 'get', get)
+        self.patch.start()
+
+        url = 'https://map.geo.admin.ch/?layers_timestamp=18641231'
+        self.assertEqual(_shorten(url), 'https://s.geo.admin.ch/1')
+        self.assertEqual(_shorten(url), 'https://s.geo.admin.ch/1')
+        self.assertEqual(get.call_count, 1)
+        self.assertIn('timeout', get.call_args[1])
+
+        get.side_effect = Exception('timeout')
+        other = 'https://map.geo.admin.ch/?layers_timestamp=19001231'
+        self.assertEqual(_shorten(other), other)
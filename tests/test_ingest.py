@@ -0,0 +1,119 @@
+import io
+import copy
+import json
+import time
+import unittest
+import mock
+
+from print3.ingest import SpooledSpec, RawJSON
+from print3.spec import PageSpecBuilder
+
+
+SPEC = {
+    'movie': True,
+    'layout': 'A4 landscape',
+    'qrcodeurl': 'https://qr.local/qrcodegenerator?url=foo',
+    'layers': [
+        {'layer': 'ch.swisstopo.zeitreihen', 'params': {'TIME': '99991231'},
+         'timestamps': ['19991231', '20001231']},
+        {'type': 'Vector', 'name': 'drawing "1"',
+         'geoJson': {'type': 'FeatureCollection', 'features': [
+             {'type': 'Feature', 'properties': {'name': 'a\\"[{'},
+              'geometry': {'type': 'LineString',
+                           'coordinates': [[2600000.5, 1200000] for i in range(500)]}},
+             {'type': 'Feature', 'properties': {},
+              'geometry': {'type': 'Polygon', 'coordinates': [
+                  [[1, 2], [3, 4.5e-3], [5, -6]] * 100]}}]}}],
+    'pages': [{'center': [600000, 200000], 'scale': 25000}]
+}
+
+
+def spooled(spec):
+    return SpooledSpec(io.BytesIO(json.dumps(spec, indent=1).encode('utf-8')))
+
+
+def vector_spec(features, points):
+    return {'layers': [{'type': 'Vector', 'geoJson': {
+        'type': 'FeatureCollection', 'features': [
+            {'type': 'Feature', 'properties': {'name': 'f{}'.format(i)},
+             'geometry': {'type': 'LineString', 'coordinates': [
+                 [2600000.25 + j, 1200000.5 - i] for j in range(points)]}}
+            for i in range(features)]}}]}
+
+
+def best_time(func, *args):
+    times = []
+    for i in range(3):
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+class TestSpooledSpec(unittest.TestCase):
+
+    def test_load(self):
+        source = spooled(SPEC)
+        try:
+            spec = source.load(inline_size=1024)
+            self.assertEqual(spec['layers'][0], SPEC['layers'][0])
+            self.assertEqual(spec['layers'][1]['name'], 'drawing "1"')
+            raw = spec['layers'][1]['geoJson']
+            self.assertIsInstance(raw, RawJSON)
+            self.assertEqual(raw.load(), SPEC['layers'][1]['geoJson'])
+            self.assertEqual(json.loads(b''.join(raw)),
+                             SPEC['layers'][1]['geoJson'])
+
+            # Everything is parsed if small enough
+            self.assertEqual(source.load(inline_size=1024 * 1024), SPEC)
+
+            # Values larger than the window of the scanner
+            with mock.patch('print3.ingest.WINDOW_SIZE', 64):
+                raw = source.load(inline_size=1024)['layers'][1]['geoJson']
+                self.assertEqual(raw.load(), SPEC['layers'][1]['geoJson'])
+        finally:
+            source.close()
+
+    def test_invalid(self):
+        for body in (b'', b'[]', b'{"layers": [{"a": 1}}', b'{"a": 1} 2',
+                     b'{"a": [[1, 2], {"b": 2]]}', b'{"a" 1}', b'{"a": nope}',
+                     # Large values are validated too
+                     b'{"a": [foo bar]}', b'{"a": [1, 2,]}', b'{"a": [01]}',
+                     b'{"a": {"b": [1], [2]}}', b'{"a": {"b" "c"}}',
+                     b'{"a": {"b": 1,}}', b'{"a": ["\\q"]}',
+                     b'{"a": [{"b": truex}]}', b'{"a": [1 2]}',
+                     b'{"a": [[1, 2], [3, 4],]}', b'{"a": [[1, 2], [3 4]]}',
+                     b'{"a": "\xff"}', b'{"a": ' + b'[' * 100000 + b'}'):
+            for window_size in (4, 1024):
+                source = SpooledSpec(io.BytesIO(body))
+                with mock.patch('print3.ingest.WINDOW_SIZE', window_size):
+                    self.assertRaises(ValueError, source.load, 4)
+                source.close()
+
+    def test_scan_time(self):
+        # The scan must not be much slower than parsing the whole body
+        for spec in (vector_spec(20000, 2), vector_spec(2, 100000)):
+            body = json.dumps(spec).encode('utf-8')
+            source = SpooledSpec(io.BytesIO(body))
+            try:
+                scan = best_time(source.load)
+                parse = best_time(json.loads, body)
+                self.assertLess(scan, 1.5 * parse)
+            finally:
+                source.close()
+
+    def test_page_body(self):
+        source = spooled(SPEC)
+        try:
+            builder = PageSpecBuilder(source.load(inline_size=1024))
+            page = builder.build('19991231', [0])
+            page['pages'][0]['shortLink'] = 'https://s.geo.admin.ch/1'
+            body = builder.body(page)
+
+            expected = copy.deepcopy(SPEC)
+            expected['layers'][0]['params']['TIME'] = '19991231'
+            expected['pages'][0]['shortLink'] = 'https://s.geo.admin.ch/1'
+            self.assertEqual(json.loads(bytes(body)), expected)
+            self.assertEqual(len(body), len(bytes(body)))
+        finally:
+            source.close()
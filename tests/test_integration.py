@@ -1,4 +1,9 @@
+import os
 import mock
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 from requests import ConnectionError
 from print3.main import app
@@ -10,10 +15,17 @@ class TestServicePrintIntegration(unittest.TestCase):
         self.app = app.test_client()
         self.app.testing = True
         self.patch = None
+        # Every request exports the metrics of the worker to the print dir
+        self.tmpdir = tempfile.mkdtemp()
+        self.tmpdir_patch = mock.patch('print3.main.PRINT_TEMP_DIR',
+                                       self.tmpdir)
+        self.tmpdir_patch.start()
 
     def tearDown(self):
         if self.patch:
             self.patch.stop()
+        self.tmpdir_patch.stop()
+        shutil.rmtree(self.tmpdir)
 
     def test_checker(self):
         resp = self.app.get('/checker')
@@ -44,3 +56,312 @@ class TestServicePrintIntegration(unittest.TestCase):
 
         resp = self.app.get('/backend_checker')
         self.assertEqual(resp.status_code, 502)
+
+    def test_print_queue(self):
+        resp = self.app.get('/printqueue')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('queued_jobs', resp.get_json())
+        self.assertIn('pending_pages', resp.get_json())
+
+    def test_metrics(self):
+        resp = self.app.get('/metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b'# TYPE print_page_seconds histogram', resp.data)
+        self.assertIn(b'print_jobs_total ', resp.data)
+
+    def test_metrics_exported_by_every_worker(self):
+        self.app.get('/checker')
+        directory = os.path.join(self.tmpdir, 'metrics')
+        for i in range(50):
+            if os.listdir(directory):
+                break
+            time.sleep(0.1)
+        self.assertTrue(os.listdir(directory))
+
+    def test_print_create_busy(self):
+        from print3.admission import Admission
+        from print3.progress import get_progress_store
+        admission = Admission(get_progress_store(self.tmpdir), max_jobs=0)
+        with mock.patch('print3.main.get_admission',
+                        lambda print_temp_dir: admission), \
+                mock.patch('print3.main.get_runner') as get_runner:
+            get_runner().stats.return_value = {'pending_pages': 0}
+            resp = self.app.post(
+                '/printmulti/create.json',
+                data='{"layers": [], "pages": []}',
+                content_type='application/json')
+            self.assertEqual(resp.status_code, 429)
+            self.assertEqual(resp.headers['Retry-After'], '10')
+            self.assertFalse(get_runner().submit.called)
+        # Nothing left of the job, only the metrics of the worker
+        self.assertEqual(os.listdir(self.tmpdir), ['metrics'])
+
+    def test_client_of_quotas(self):
+        from print3.main import _client
+        # Address set by the client, then by the load balancer and nginx
+        headers = {'X-Forwarded-For': '1.2.3.4, 5.6.7.8, 10.220.0.5'}
+        self.assertEqual(_client(headers, '127.0.0.1'), '5.6.7.8')
+        headers = {'X-Forwarded-For': 'spoofed, 5.6.7.8'}
+        self.assertEqual(_client(headers, '127.0.0.1'), '5.6.7.8')
+        self.assertEqual(_client({}, '5.6.7.8'), '5.6.7.8')
+        self.assertEqual(_client({}, '127.0.0.1'), '127.0.0.1')
+        self.assertEqual(
+            _client({'Referer': 'https://map.geo.admin.ch/?lang=de'},
+                    '5.6.7.8', quota_by='referer'),
+            'map.geo.admin.ch')
+
+    def test_print_download(self):
+        from print3.download import DownloadStage
+        from print3.progress import get_progress_store
+        from print3.utils import create_pdf_path
+        store = get_progress_store(self.tmpdir)
+        store.write('1234', {'status': 'done'})
+        with open(create_pdf_path(self.tmpdir, '1234'), 'wb') as f:
+            f.write(b'%PDF-1.7 0123456789')
+        resp = self.app.get('/printdownload/1234')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'application/pdf')
+        self.assertIn('map.geo.admin.ch_1234.pdf',
+                      resp.headers['Content-Disposition'])
+        self.assertIn('Last-Modified', resp.headers)
+        etag = resp.headers['ETag']
+        resp.close()
+
+        resp = self.app.get('/printdownload/1234',
+                            headers={'Range': 'bytes=9-'})
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp.data, b'0123456789')
+        resp.close()
+        resp = self.app.get('/printdownload/1234',
+                            headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+        resp.close()
+
+        stage = DownloadStage(self.tmpdir + '/staged')
+        with mock.patch('print3.main.get_download_stage',
+                        lambda: stage), \
+                mock.patch('print3.main.DOWNLOAD_ACCEL_PREFIX',
+                           '/staged/'):
+            resp = self.app.get('/printdownload/1234')
+        self.assertEqual(resp.headers['X-Accel-Redirect'],
+                         '/staged/mapfish-print-multi1234.pdf.printout')
+        self.assertTrue(os.path.isfile(
+            self.tmpdir + '/staged/mapfish-print-multi1234.pdf.printout'))
+
+    def test_print_download_running(self):
+        from print3.progress import get_progress_store, JobProgress
+        from print3.utils import create_pdf_path
+        path = create_pdf_path(self.tmpdir, '1235')
+        progress = JobProgress(get_progress_store(self.tmpdir), '1235',
+                               status='ongoing')
+
+        def merge():
+            for part in (b'%PDF-1.7\n', b'1 0 obj\n', b'%%EOF\n'):
+                time.sleep(0.05)
+                with open(path, 'ab') as f:
+                    f.write(part)
+                progress.update(merged=progress.get('merged', 0) + 1)
+            progress.reset(status='done', written=os.path.getsize(path))
+
+        t = threading.Thread(target=merge)
+        t.start()
+        resp = self.app.get('/printdownload/1235')
+        t.join()
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Cache-Control'], 'no-cache')
+        self.assertEqual(resp.data, b'%PDF-1.7\n1 0 obj\n%%EOF\n')
+        resp.close()
+
+    def test_print_download_running_checks_size(self):
+        from print3.progress import get_progress_store, JobProgress
+        from print3.utils import create_pdf_path
+        path = create_pdf_path(self.tmpdir, '1236')
+        progress = JobProgress(get_progress_store(self.tmpdir), '1236',
+                               status='ongoing')
+        with open(path, 'wb') as f:
+            f.write(b'%PDF-1.7\n')
+
+        def append():
+            time.sleep(0.1)
+            with open(path, 'ab') as f:
+                f.write(b'%%EOF\n')
+
+        with mock.patch('print3.main.PROGRESS_POLL_INTERVAL', 0.05):
+            resp = self.app.get('/printdownload/1236')
+            chunks = resp.response
+            self.assertEqual(next(chunks), b'%PDF-1.7\n')
+            # Published done before the end of the file can be read
+            t = threading.Thread(target=append)
+            t.start()
+            progress.reset(status='done', written=15)
+            self.assertEqual(b''.join(chunks), b'%%EOF\n')
+            t.join()
+            resp.close()
+
+            progress.reset(status='ongoing')
+            resp = self.app.get('/printdownload/1236')
+            chunks = resp.response
+            self.assertEqual(next(chunks), b'%PDF-1.7\n%%EOF\n')
+            progress.reset(status='done', written=20)
+            with self.assertRaises(IOError):
+                next(chunks)
+            resp.close()
+
+    def test_print_download_running_run_again(self):
+        from print3.progress import get_progress_store, JobProgress
+        from print3.utils import create_pdf_path
+        path = create_pdf_path(self.tmpdir, '1237')
+        progress = JobProgress(get_progress_store(self.tmpdir), '1237',
+                               status='ongoing')
+        with open(path, 'wb') as f:
+            f.write(b'%PDF-1.7\n')
+        resp = self.app.get('/printdownload/1237')
+        chunks = resp.response
+        self.assertEqual(next(chunks), b'%PDF-1.7\n')
+        # The lease of the job was lost, it is run again
+        os.remove(path)
+        with open(path, 'wb') as f:
+            f.write(b'%PDF-1.7\n1 0 obj\n')
+        progress.update(merged=1)
+        with self.assertRaises(IOError):
+            next(chunks)
+        resp.close()
+
+    def test_print_progress(self):
+        from print3.progress import get_progress_store
+        resp = self.app.get('/printprogress?id=1234')
+        self.assertEqual(resp.status_code, 400)
+
+        get_progress_store(self.tmpdir).write('1234', {'status': 'ongoing', 'done': 2})
+        resp = self.app.get('/printprogress?id=1234')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.get_json(), {'status': 'ongoing', 'done': 2})
+
+        etag = resp.headers['ETag']
+        resp = self.app.get('/printprogress?id=1234',
+                            headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+        with mock.patch('print3.main.PROGRESS_LONGPOLL_TIMEOUT', 0.1):
+            resp = self.app.get('/printprogress?id=1234&since=' +
+                                etag.strip('"'))
+        self.assertEqual(resp.status_code, 304)
+        resp = self.app.get('/printprogress?id=1234&since=other')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['ETag'], etag)
+
+    def test_print_progress_stream(self):
+        from print3.progress import get_progress_store
+        resp = self.app.get('/printprogress/stream?id=1234')
+        self.assertEqual(resp.status_code, 400)
+
+        get_progress_store(self.tmpdir).write('1234', {'status': 'done'})
+        resp = self.app.get('/printprogress/stream?id=1234')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'text/event-stream')
+        events = resp.get_data(as_text=True).split('\n\n')
+        resp.close()
+        self.assertEqual(len(events), 2)
+        self.assertTrue(events[0].startswith('id: '))
+        self.assertIn('data: {"status": "done"}', events[0])
+
+        # Streams end after PROGRESS_STREAM_MAX_TIME
+        get_progress_store(self.tmpdir).write('1234', {'status': 'ongoing'})
+        with mock.patch('print3.main.PROGRESS_STREAM_MAX_TIME', 0.1):
+            resp = self.app.get('/printprogress/stream?id=1234')
+            events = resp.get_data(as_text=True).split('\n\n')
+            resp.close()
+        self.assertIn('data: {"status": "ongoing"}', events[0])
+
+    def test_long_requests_bounded(self):
+        from print3.limiter import RequestSlots
+        from print3.progress import get_progress_store
+        from print3.utils import create_pdf_path
+        get_progress_store(self.tmpdir).write('1234', {'status': 'ongoing'})
+        with open(create_pdf_path(self.tmpdir, '1234'), 'wb') as f:
+            f.write(b'%PDF-1.7\n')
+        slots = RequestSlots(1)
+        with mock.patch('print3.main._long_requests', slots):
+            stream = self.app.get('/printprogress/stream?id=1234')
+            self.assertEqual(slots.stats()['used'], 1)
+
+            # Long-polls are answered at once
+            resp = self.app.get('/printprogress?id=1234')
+            etag = resp.headers['ETag']
+            start = time.time()
+            resp = self.app.get('/printprogress?id=1234&since=' +
+                                etag.strip('"'))
+            self.assertLess(time.time() - start, 1)
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.headers['Retry-After'], '5')
+
+            # Streams send the current progress, if the client does not
+            # have it yet, then end
+            resp = self.app.get('/printprogress/stream?id=1234')
+            events = resp.get_data(as_text=True).split('\n\n')
+            self.assertEqual(events[0], 'retry: 5000')
+            self.assertIn('data: {"status": "ongoing"}', events[1])
+            resp = self.app.get('/printprogress/stream?id=1234',
+                                headers={'Last-Event-ID': etag.strip('"')})
+            self.assertEqual(resp.get_data(as_text=True), 'retry: 5000\n\n')
+
+            resp = self.app.get('/printdownload/1234')
+            self.assertEqual(resp.status_code, 503)
+            self.assertEqual(resp.headers['Retry-After'], '5')
+
+            # The slot is free again once the stream is closed
+            stream.close()
+            self.assertEqual(slots.stats()['used'], 0)
+            resp = self.app.get('/printdownload/1234')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(slots.stats()['used'], 1)
+            resp.close()
+            self.assertEqual(slots.stats()['used'], 0)
+
+    def test_print_create_spooled(self):
+        with mock.patch('print3.main.SPEC_SPOOL_SIZE', 10):
+            resp = self.app.post('/printmulti/create.json',
+                                 data='{"layers": [}',
+                                 content_type='application/json')
+            self.assertEqual(resp.status_code, 400)
+
+            with mock.patch('print3.main.get_runner') as get_runner:
+                get_runner().stats.return_value = {'pending_pages': 0}
+                resp = self.app.post(
+                    '/printmulti/create.json',
+                    data='{"layers": [{"layer": "foo"}], "pages": []}',
+                    content_type='application/json')
+                self.assertEqual(resp.status_code, 200)
+                func, info, spooled = get_runner().submit.call_args[0]
+                self.assertEqual(func.__name__, 'create_and_merge_spooled')
+                self.assertEqual(info[0], {'layers': [{'layer': 'foo'}],
+                                           'pages': []})
+                spooled.close()
+
+    def test_print_single_cached(self):
+        posted = []
+
+        def fake_post(url, data=None, **kwargs):
+            posted.append(url)
+            with open(self.tmpdir + '/mapfish-print123.pdf.printout', 'wb') as f:
+                f.write(b'%PDF-1.4')
+            resp = mock.Mock(status_code=200, content=b'{"getURL": '
+                             b'"http://print.local/print/123.pdf.printout"}',
+                             headers={'Content-Type': 'application/json'})
+            resp.json.return_value = {
+                'getURL': 'http://print.local/print/123.pdf.printout'}
+            return resp
+
+        with mock.patch('print3.main.get_runner') as get_runner, \
+                mock.patch('print3.main.PRINT_SERVER_HOST', 'print.local'):
+            get_runner().session.post = fake_post
+            for i in range(2):
+                resp = self.app.post(
+                    '/printsingle/create.json',
+                    data='{"layers": [], "pages": [{"scale": 1000}]}',
+                    content_type='application/json')
+                self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(posted), 1)
+        url = resp.get_json()['getURL']
+        self.assertTrue(url.startswith('http://print.local/print/'))
+        with open(self.tmpdir + '/mapfish-print' + url.split('/')[-1], 'rb') as f:
+            self.assertEqual(f.read(), b'%PDF-1.4')
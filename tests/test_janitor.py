@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from print3.janitor import Janitor
+
+
+class TestJanitor(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def touch(self, name, age=0):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w'):
+            pass
+        if age:
+            os.utime(path, (time.time() - age, time.time() - age))
+        return path
+
+    def test_delete_expired_by_batch(self):
+        janitor = Janitor(self.tmpdir, batch=2)
+        paths = [self.touch('mapfish-print%d.pdf.printout' % i)
+                 for i in range(3)]
+        kept = self.touch('mapfish-print-multi1.json')
+        janitor.register(paths, ttl=0)
+        janitor.register([kept])
+
+        self.assertEqual(janitor.delete_expired(), 2)
+        self.assertEqual(janitor.delete_expired(), 1)
+        self.assertEqual(janitor.delete_expired(), 0)
+        self.assertEqual(os.listdir(self.tmpdir), ['mapfish-print-multi1.json'])
+        self.assertEqual(janitor.pending(), 1)
+
+    def test_sweep(self):
+        janitor = Janitor(self.tmpdir, ttl=3600, batch=2)
+        self.touch('mapfish-print-multi1.json', age=7200)
+        self.touch('mapfish-print-multi1.pdf.printout', age=7200)
+        self.touch('mapfish-print12.pdf.printout', age=7200)
+        self.touch('mapfish-print13.0.cached.pdf', age=7200)
+        self.touch('mapfish-print-multi2.json')
+        self.touch('other.pdf', age=7200)
+
+        while janitor.sweep():
+            pass
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         ['mapfish-print-janitor.lock',
+                          'mapfish-print-multi2.json',
+                          'mapfish-print12.pdf.printout', 'other.pdf'])
+
+        # Only one sweep per interval, whatever the process
+        self.touch('mapfish-print-multi3.json', age=7200)
+        self.assertFalse(Janitor(self.tmpdir).sweep())
+        self.assertTrue(os.path.exists(
+            os.path.join(self.tmpdir, 'mapfish-print-multi3.json')))
+
+    def test_sweep_shared_caches(self):
+        cachedir = os.path.join(self.tmpdir, 'releases')
+        os.mkdir(cachedir)
+        self.touch('releases/expired.json', age=7200)
+        self.touch('releases/fresh.json', age=60)
+        janitor = Janitor(self.tmpdir, caches=((cachedir, 3600),
+                                               (None, 3600)))
+        while janitor.sweep():
+            pass
+        self.assertEqual(os.listdir(cachedir), ['fresh.json'])
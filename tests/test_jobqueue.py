@@ -0,0 +1,88 @@
+import io
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from print3.ingest import SpooledSpec
+from print3.jobqueue import FileJobQueue
+
+
+class TestFileJobQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.queue = FileJobQueue(self.tmpdir, lease_ttl=60)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def age(self, lease, seconds):
+        mtime = time.time() - seconds
+        os.utime(lease.path, (mtime, mtime))
+
+    def test_claim_in_order(self):
+        self.queue.put('2', {'n': 2})
+        self.queue.put('1', {'n': 1})
+        other = FileJobQueue(self.tmpdir, lease_ttl=60)
+
+        lease = self.queue.claim()
+        self.assertEqual((lease.jobid, lease.attempt, lease.payload),
+                         ('1', 1, {'n': 1}))
+        self.assertEqual(other.claim().jobid, '2')
+        self.assertIsNone(other.claim())
+
+        lease.release()
+        self.assertEqual(self.queue.pending(), ['2'])
+        self.assertEqual(os.listdir(self.queue.directory),
+                         ['2.job', '2.lease.1'])
+
+    def test_cancel(self):
+        self.queue.put('1', {})
+        self.queue.put('2', {})
+        lease = self.queue.claim()
+        self.assertTrue(self.queue.cancel('1'))
+        self.assertFalse(self.queue.cancel('3'))
+        self.assertEqual(self.queue.cancelled(), {'1'})
+        lease.release()
+        self.assertEqual(self.queue.cancelled(), set())
+        self.assertEqual(self.queue.pending(), ['2'])
+
+    def test_orphaned_jobs_are_claimed_again(self):
+        self.queue.put('1', {})
+        lease = self.queue.claim()
+        self.age(lease, 30)
+        self.assertIsNone(self.queue.claim())
+        self.assertTrue(lease.renew())
+
+        self.age(lease, 120)
+        again = FileJobQueue(self.tmpdir, lease_ttl=60).claim()
+        self.assertEqual((again.jobid, again.attempt), ('1', 2))
+        # The first runner finds out that it lost the job
+        self.assertFalse(lease.renew())
+        lease.release()
+        self.assertEqual(self.queue.pending(), ['1'])
+        again.release()
+        self.assertEqual(os.listdir(self.queue.directory), [])
+
+    def test_leases_checked_every_interval(self):
+        self.queue.put('1', {})
+        lease = self.queue.claim()
+        self.age(lease, 120)
+        other = FileJobQueue(self.tmpdir, lease_ttl=60,
+                             lease_check_interval=60)
+        other._leases_checked = time.time()
+        # Orphaned jobs are not looked for on every claim
+        self.assertIsNone(other.claim())
+        other._leases_checked -= 60
+        self.assertEqual(other.claim().attempt, 2)
+
+    def test_spooled_spec(self):
+        spooled = SpooledSpec(io.BytesIO(b'{"layers": []}'))
+        self.queue.put('1', {'spooled': True}, spooled)
+        lease = self.queue.claim()
+        with open(lease.spec_file, 'rb') as f:
+            self.assertEqual(f.read(), b'{"layers": []}')
+        lease.release()
+        self.assertFalse(os.path.exists(lease.spec_file))
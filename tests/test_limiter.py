@@ -0,0 +1,65 @@
+import threading
+import time
+import unittest
+
+from print3.limiter import AdaptiveLimiter, RequestSlots, backoff
+
+
+class TestAdaptiveLimiter(unittest.TestCase):
+
+    def test_aimd(self):
+        limiter = AdaptiveLimiter(maximum=8, latency_target=10)
+        self.assertEqual(limiter.stats()['limit'], 8)
+
+        limiter.acquire()
+        limiter.release(latency=1, ok=False)
+        self.assertEqual(limiter.stats()['limit'], 4)
+        # One decrease per latency target
+        limiter.acquire()
+        limiter.release(latency=20, ok=True)
+        self.assertEqual(limiter.stats()['limit'], 4)
+
+        for i in range(5):
+            limiter.acquire()
+            limiter.release(latency=1, ok=True)
+        self.assertEqual(limiter.stats()['limit'], 5)
+
+        # No signal
+        limiter.acquire()
+        limiter.release()
+        self.assertEqual(limiter.stats(), {'limit': 5, 'inflight': 0})
+
+    def test_acquire_waits(self):
+        limiter = AdaptiveLimiter(maximum=1)
+        limiter.acquire()
+        acquired = threading.Event()
+
+        def acquire():
+            limiter.acquire()
+            acquired.set()
+
+        threading.Thread(target=acquire).start()
+        time.sleep(0.05)
+        self.assertFalse(acquired.is_set())
+        limiter.release(latency=1)
+        self.assertTrue(acquired.wait(5))
+
+    def test_backoff(self):
+        for attempt in range(1, 10):
+            delay = backoff(attempt, base=1, cap=30)
+            self.assertTrue(0 <= delay <= min(30, 2 ** attempt))
+
+
+class TestRequestSlots(unittest.TestCase):
+
+    def test_slots(self):
+        slots = RequestSlots(2)
+        self.assertTrue(slots.acquire())
+        self.assertTrue(slots.acquire())
+        self.assertFalse(slots.acquire())
+        slots.release()
+        self.assertTrue(slots.acquire())
+        self.assertEqual(slots.stats(), {'used': 2, 'maximum': 2})
+
+        # Nothing is waited for with no slot at all (sync workers)
+        self.assertFalse(RequestSlots(0).acquire())
@@ -0,0 +1,87 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+import unittest
+
+from print3.metrics import Registry, MetricsExporter
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.registry = Registry()
+        self.pages = self.registry.counter('pages_total', 'Pages')
+        self.active = self.registry.gauge('active', 'Active jobs')
+        self.page_seconds = self.registry.histogram(
+            'page_seconds', 'Pages', buckets=(1, 10))
+        self.exporter = MetricsExporter(self.tmpdir, registry=self.registry)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def other_process(self, name, age=0, **values):
+        snapshot = dict(
+            (name, dict(m.snapshot(), type=m.type, help=m.help))
+            for name, m in (('pages_total', self.pages),
+                            ('active', self.active),
+                            ('page_seconds', self.page_seconds)))
+        for key, value in values.items():
+            snapshot[key].update(value)
+        filename = os.path.join(self.exporter.directory,
+                                '{}-{}.json'.format(self.exporter.host, name))
+        with open(filename, 'w') as f:
+            json.dump(snapshot, f)
+        mtime = time.time() - age
+        os.utime(filename, (mtime, mtime))
+
+    def test_render(self):
+        self.pages.inc(3)
+        self.active.inc()
+        for value in (0.5, 2, 100):
+            self.page_seconds.observe(value)
+        text = self.exporter.render()
+        self.assertIn('# TYPE pages_total counter\npages_total 3\n', text)
+        self.assertIn('active 1\n', text)
+        self.assertIn('page_seconds_bucket{le="1"} 1\n'
+                      'page_seconds_bucket{le="10"} 2\n'
+                      'page_seconds_bucket{le="+Inf"} 3\n'
+                      'page_seconds_sum 102.5\n'
+                      'page_seconds_count 3\n', text)
+
+    def test_processes_are_added_up(self):
+        self.pages.inc(3)
+        self.active.inc()
+        self.page_seconds.observe(2)
+        self.other_process('alive', pages_total={'value': 4},
+                           active={'value': 2})
+        # The gauges of dead processes are ignored, not their counters
+        self.other_process('dead', age=3600, pages_total={'value': 5},
+                           active={'value': 7})
+        self.other_process('expired', age=2 * 24 * 3600,
+                           pages_total={'value': 100})
+        metrics = self.exporter.collect()
+        self.assertEqual(metrics['pages_total']['value'], 12)
+        self.assertEqual(metrics['active']['value'], 3)
+        self.assertEqual(metrics['page_seconds']['count'], 3)
+        self.assertEqual(metrics['page_seconds']['counts'], [0, 3])
+        self.assertFalse(os.path.exists(os.path.join(
+            self.exporter.directory, self.exporter.host + '-expired.json')))
+
+    def test_other_hosts_are_left_out(self):
+        self.pages.inc(3)
+        self.other_process('1', pages_total={'value': 4})
+        self.exporter.host = 'other-host'
+        self.exporter.name = 'other-host-1'
+        # Every container is scraped, its metrics are only its own
+        self.assertEqual(self.exporter.collect()['pages_total']['value'], 3)
+
+    def test_write(self):
+        self.pages.inc()
+        self.exporter.write()
+        other = MetricsExporter(self.tmpdir, registry=Registry())
+        other.name = 'other'
+        other.registry.counter('pages_total', 'Pages')
+        self.assertEqual(other.collect()['pages_total']['value'], 1)
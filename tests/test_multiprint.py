@@ -0,0 +1,392 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import mock
+import requests
+
+from pypdf import PdfReader, PdfWriter
+from pypdf.generic import DecodedStreamObject, DictionaryObject, NameObject
+
+import print3.main
+from print3.admission import Admission
+from print3.jobqueue import FileJobQueue
+from print3.main import create_and_merge, drain_jobs, run_queued_job
+from print3.merge import StreamingPdfMerger
+from print3.progress import get_progress_store
+from print3.runner import JobRunner
+from print3.utils import create_info_file, create_pdf_path
+
+
+LOGO = os.urandom(20000)
+
+
+def write_pdf(filename, text, logo=None):
+    writer = PdfWriter()
+    page = writer.add_blank_page(200, 200)
+    content = DecodedStreamObject()
+    content.set_data(('BT /F1 12 Tf 10 10 Td (%s) Tj ET' % text).encode())
+    page[NameObject('/Contents')] = writer._add_object(content)
+    if logo is not None:
+        image = DecodedStreamObject()
+        image.set_data(logo)
+        image.update({NameObject('/Type'): NameObject('/XObject'),
+                      NameObject('/Subtype'): NameObject('/Image')})
+        resources = DictionaryObject({NameObject('/Logo'): writer._add_object(image)})
+        page[NameObject('/Resources')] = DictionaryObject(
+            {NameObject('/XObject'): resources})
+    writer.write(filename)
+
+
+def page_texts(filename):
+    reader = PdfReader(filename, strict=True)
+    return [p.get_contents().get_data().decode() for p in reader.pages]
+
+
+class FakeResponse(object):
+
+    status_code = 200
+    text = ''
+
+    def __init__(self, url, status_code=200):
+        self.url = url
+        self.status_code = status_code
+
+    def json(self):
+        return {'getURL': self.url}
+
+
+class TestStreamingPdfMerger(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_pages_are_merged_in_order(self):
+        names = []
+        for i in range(3):
+            names.append(os.path.join(self.tmpdir, 'p%d.pdf' % i))
+            write_pdf(names[-1], 'page %d' % i)
+        progress = []
+        out = os.path.join(self.tmpdir, 'out.pdf')
+        merger = StreamingPdfMerger(
+            out, progress=lambda merged, written: progress.append(merged))
+
+        merger.add(2, names[2])
+        self.assertEqual(progress, [])
+        merger.add(0, names[0])
+        self.assertEqual(progress, [1])
+        merger.add(1, names[1])
+        self.assertEqual(progress, [1, 2, 3])
+        written = merger.close()
+
+        self.assertEqual(written, os.path.getsize(out))
+        self.assertEqual(page_texts(out), ['BT /F1 12 Tf 10 10 Td (page %d) Tj ET' % i
+                                           for i in range(3)])
+
+    def test_missing_pages_are_skipped(self):
+        name = os.path.join(self.tmpdir, 'p.pdf')
+        write_pdf(name, 'page')
+        out = os.path.join(self.tmpdir, 'out.pdf')
+        merger = StreamingPdfMerger(out)
+        merger.add(1, name)
+        merger.add(0, None)
+        merger.close()
+        self.assertEqual(len(page_texts(out)), 1)
+
+    def test_shared_resources_are_written_once(self):
+        names = []
+        for i in range(3):
+            names.append(os.path.join(self.tmpdir, 'p%d.pdf' % i))
+            write_pdf(names[-1], 'page %d' % i, logo=LOGO)
+
+        sizes = []
+        for deduplicate in (False, True):
+            out = os.path.join(self.tmpdir, 'out%s.pdf' % deduplicate)
+            merger = StreamingPdfMerger(out, deduplicate=deduplicate)
+            for i, name in enumerate(names):
+                merger.add(i, name)
+            sizes.append(merger.close())
+
+        self.assertEqual(merger.deduplicated, 2)
+        self.assertLess(sizes[1], sizes[0] - 2 * len(LOGO) + 1000)
+        reader = PdfReader(out, strict=True)
+        logos = [p['/Resources']['/XObject'].raw_get('/Logo').idnum
+                 for p in reader.pages]
+        self.assertEqual(len(set(logos)), 1)
+        self.assertEqual(reader.pages[2]['/Resources']['/XObject']['/Logo'].get_data(),
+                         LOGO)
+        self.assertEqual(len(page_texts(out)), 3)
+
+    def test_abort_removes_output(self):
+        out = os.path.join(self.tmpdir, 'out.pdf')
+        merger = StreamingPdfMerger(out)
+        merger.abort()
+        self.assertFalse(os.path.exists(out))
+
+
+class TestCreateAndMerge(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.counter = 0
+        self.posted = []
+        self.patches = [
+            mock.patch('print3.main.PRINT_SERVER_HOST', 'print.local'),
+            mock.patch('print3.main._shorten', lambda url: 'short:' + url),
+            mock.patch.object(print3.main.get_runner().session, 'post',
+                              self.fake_post)]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def fake_post(self, url, data=None, **kwargs):
+        spec = json.loads(bytes(data))
+        self.posted.append(spec)
+        self.counter += 1
+        name = '%d.pdf.printout' % self.counter
+        write_pdf(os.path.join(self.tmpdir, 'mapfish-print' + name),
+                  spec['layers'][0]['params']['TIME'])
+        return FakeResponse('http://print.local/print/' + name)
+
+    def spec(self, timestamps):
+        return {
+            'movie': True,
+            'qrcodeurl': 'https://qr.local/qrcodegenerator?url=' +
+                         'https%3A%2F%2Fmap.local%2F%3Flayers_timestamp%3D1',
+            'layers': [{'layer': 'ch.foo', 'timestamps': timestamps,
+                        'params': {}}],
+            'pages': [{}]}
+
+    def test_create_and_merge(self):
+        info = (self.spec(['20010101', '19990101', '20000101']), self.tmpdir,
+                'http', '//api.local', '//tomcat.local', {}, '42')
+        self.assertEqual(create_and_merge(info), 0)
+
+        with open(create_info_file(self.tmpdir, '42')) as f:
+            data = json.load(f)
+        self.assertEqual(data['status'], 'done')
+        self.assertEqual(
+            data['getURL'],
+            'http://print.local/mapfish-print-multi42.pdf.printout')
+        texts = page_texts(create_pdf_path(self.tmpdir, '42'))
+        self.assertEqual(
+            texts,
+            ['BT /F1 12 Tf 10 10 Td (%s) Tj ET' % ts
+             for ts in ('19990101', '20000101', '20010101')])
+        self.assertEqual(
+            sorted(s['pages'][0]['shortLink'] for s in self.posted),
+            ['short:https://map.local/?layers_timestamp=%s' % ts
+             for ts in ('19990101', '20000101', '20010101')])
+
+    def test_cancel(self):
+        def cancelling_post(url, data=None, **kwargs):
+            print3.main.get_runner().cancel('43')
+            return self.fake_post(url, data, **kwargs)
+
+        info = (self.spec(['%d0101' % y for y in range(1990, 2010)]),
+                self.tmpdir, 'http', '//api.local', '//tomcat.local', {}, '43')
+        with mock.patch.object(print3.main.get_runner().session, 'post',
+                               cancelling_post):
+            self.assertEqual(create_and_merge(info), 0)
+
+        with open(create_info_file(self.tmpdir, '43')) as f:
+            self.assertEqual(json.load(f), {'status': 'cancelled'})
+        self.assertFalse(os.path.exists(create_pdf_path(self.tmpdir, '43')))
+        self.assertFalse(print3.main.get_runner().cancel('43'))
+
+    def test_cached_pages(self):
+        shortened = []
+
+        def shorten(url):
+            shortened.append(url)
+            return 'short:' + url
+
+        with mock.patch('print3.main._shorten', shorten):
+            for jobid, timestamps in (('44', ['20010101', '19990101']),
+                                      ('45', ['20010101', '19990101',
+                                              '20000101'])):
+                info = (self.spec(timestamps), self.tmpdir, 'http',
+                        '//api.local', '//tomcat.local', {}, jobid)
+                self.assertEqual(create_and_merge(info), 0)
+
+        # Only the page of 2000 is printed and shortened for the second job
+        self.assertEqual(len(self.posted), 3)
+        self.assertEqual(len(shortened), 3)
+        self.assertEqual(self.posted[-1]['layers'][0]['params']['TIME'],
+                         '20000101')
+        self.assertEqual(
+            page_texts(create_pdf_path(self.tmpdir, '45')),
+            ['BT /F1 12 Tf 10 10 Td (%s) Tj ET' % ts
+             for ts in ('19990101', '20000101', '20010101')])
+        with open(create_info_file(self.tmpdir, '45')) as f:
+            data = json.load(f)
+        self.assertEqual(data['cached'], 2)
+        self.assertEqual(data['cache_hit_ratio'], 0.667)
+
+    def test_server_errors_are_retried(self):
+        def flaky_post(url, data=None, **kwargs):
+            if self.counter < 2:
+                self.counter += 1
+                return FakeResponse(None, status_code=503)
+            return self.fake_post(url, data, **kwargs)
+
+        info = (self.spec(['20010101', '19990101']), self.tmpdir, 'http',
+                '//api.local', '//tomcat.local', {}, '46')
+        with mock.patch.object(print3.main.get_runner().session, 'post',
+                               flaky_post), \
+                mock.patch('print3.main.backoff', lambda attempt: 0):
+            self.assertEqual(create_and_merge(info), 0)
+        self.assertEqual(len(self.posted), 2)
+
+    def test_page_exceptions_are_retried(self):
+        tomcat_headers = print3.main._tomcat_headers
+        store = get_progress_store(self.tmpdir)
+        raised = []
+        statuses = []
+
+        def failing_headers(headers):
+            if not raised:
+                raised.append(True)
+                raise RuntimeError('unexpected')
+            statuses.append(store.read('55')['status'])
+            return tomcat_headers(headers)
+
+        info = (self.spec(['20010101', '19990101']), self.tmpdir, 'http',
+                '//api.local', '//tomcat.local', {}, '55')
+        with mock.patch('print3.main._tomcat_headers', failing_headers), \
+                mock.patch('print3.main.backoff', lambda attempt: 0):
+            self.assertEqual(create_and_merge(info), 0)
+        self.assertEqual(raised, [True])
+        # Not published as failed while the page is retried
+        self.assertNotIn('failed', statuses)
+        with open(create_info_file(self.tmpdir, '55')) as f:
+            data = json.load(f)
+        self.assertEqual(data['status'], 'done')
+        self.assertEqual(len(page_texts(create_pdf_path(self.tmpdir, '55'))),
+                         2)
+
+    def test_failed_page_aborts_after_retries(self):
+        def failing_post(url, data=None, **kwargs):
+            spec = json.loads(bytes(data))
+            if spec['layers'][0]['params']['TIME'] == '19990101':
+                self.posted.append(spec)
+                return FakeResponse(None, status_code=503)
+            return self.fake_post(url, data, **kwargs)
+
+        info = (self.spec(['20010101', '19990101', '20000101']), self.tmpdir,
+                'http', '//api.local', '//tomcat.local', {}, '47')
+        with mock.patch.object(print3.main.get_runner().session, 'post',
+                               failing_post), \
+                mock.patch('print3.main.backoff', lambda attempt: 0):
+            self.assertEqual(create_and_merge(info), 2)
+        failed = [s for s in self.posted
+                  if s['layers'][0]['params']['TIME'] == '19990101']
+        self.assertEqual(len(failed), print3.main.PAGE_RETRIES + 1)
+        self.assertFalse(os.path.exists(create_pdf_path(self.tmpdir, '47')))
+        # Kept for the clients polling the job
+        with open(create_info_file(self.tmpdir, '47')) as f:
+            self.assertEqual(json.load(f), {'status': 'failed'})
+
+    def test_failed_jobs_are_published(self):
+        store = get_progress_store(self.tmpdir)
+        admission = Admission(store, max_client_jobs=1)
+        # A job raising, a job without timestamps
+        store.write('52', {'status': 'ongoing'})
+        self.assertTrue(admission.admit('52', '10.0.0.1'))
+        with self.assertRaises(KeyError):
+            create_and_merge(({'pages': [{}]}, self.tmpdir, 'http',
+                              '//api.local', '//tomcat.local', {}, '52'))
+        self.assertEqual(store.read('52'), {'status': 'failed'})
+
+        store.write('53', {'status': 'ongoing'})
+        self.assertTrue(admission.admit('53', '10.0.0.1'))
+        self.assertEqual(create_and_merge((
+            self.spec([]), self.tmpdir, 'http', '//api.local',
+            '//tomcat.local', {}, '53')), 4)
+        self.assertEqual(store.read('53'), {'status': 'failed'})
+        # The jobs of the client are over
+        self.assertTrue(admission.admit('54', '10.0.0.1'))
+
+    def test_abandoned_jobs_are_published_failed(self):
+        runner = JobRunner(max_jobs=1, max_pages=1)
+        started = threading.Event()
+        stop = threading.Event()
+
+        def blocking_post(url, data=None, **kwargs):
+            started.set()
+            stop.wait(5)
+            raise requests.ConnectionError('Connection reset')
+
+        info = (self.spec(['20010101']), self.tmpdir, 'http',
+                '//api.local', '//tomcat.local', {}, '56')
+        with mock.patch('print3.main.get_runner', lambda: runner), \
+                mock.patch('print3.main.PRINT_TEMP_DIR', self.tmpdir), \
+                mock.patch.object(runner.session, 'post', blocking_post):
+            get_progress_store(self.tmpdir).write('56', {'status': 'ongoing'})
+            runner.submit(create_and_merge, info, key='56')
+            started.wait(5)
+            threading.Timer(0.2, stop.set).start()
+            # The worker is exiting
+            drain_jobs(timeout=0.1)
+        with open(create_info_file(self.tmpdir, '56')) as f:
+            self.assertEqual(json.load(f), {'status': 'failed'})
+
+    def test_queued_job(self):
+        queue = FileJobQueue(self.tmpdir)
+        info = (self.spec(['20010101', '19990101']), self.tmpdir, 'http',
+                '//api.local', '//tomcat.local', {}, '48')
+        queue.put('48', {'info': info, 'spooled': False})
+        run_queued_job(queue.claim())
+
+        with open(create_info_file(self.tmpdir, '48')) as f:
+            self.assertEqual(json.load(f)['status'], 'done')
+        self.assertEqual(len(page_texts(create_pdf_path(self.tmpdir, '48'))),
+                         2)
+        self.assertEqual(queue.pending(), [])
+
+    def test_queued_job_given_up(self):
+        queue = FileJobQueue(self.tmpdir, lease_ttl=0, lease_check_interval=0)
+        info = (self.spec(['20010101']), self.tmpdir, 'http',
+                '//api.local', '//tomcat.local', {}, '49')
+        queue.put('49', {'info': info, 'spooled': False})
+        for i in range(print3.main.JOB_MAX_ATTEMPTS + 1):
+            lease = queue.claim()
+        run_queued_job(lease)
+        self.assertEqual(self.posted, [])
+        self.assertEqual(queue.pending(), [])
+        with open(create_info_file(self.tmpdir, '49')) as f:
+            self.assertEqual(json.load(f), {'status': 'failed'})
+
+    def test_pages_are_merged_before_all_links_are_shortened(self):
+        waited = []
+
+        def merged():
+            with open(create_info_file(self.tmpdir, '50')) as f:
+                return json.load(f).get('merged', 0)
+
+        def slow_shorten(url):
+            if url.endswith('20000101'):
+                # Only returns once the first page was merged
+                deadline = time.time() + 5
+                while merged() < 1 and time.time() < deadline:
+                    time.sleep(0.01)
+                waited.append(merged())
+            return 'short:' + url
+
+        info = (self.spec(['19990101', '20000101']), self.tmpdir, 'http',
+                '//api.local', '//tomcat.local', {}, '50')
+        with mock.patch('print3.main._shorten', slow_shorten):
+            self.assertEqual(create_and_merge(info), 0)
+        self.assertEqual(waited, [1])
+        self.assertEqual(len(page_texts(create_pdf_path(self.tmpdir, '50'))),
+                         2)
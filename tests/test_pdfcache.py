@@ -0,0 +1,92 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from print3.pdfcache import PdfCache
+from print3.spec import PageSpecBuilder
+
+
+class TestPdfCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = PdfCache(os.path.join(self.tmpdir, 'cache'), max_size=25)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def printed(self, name, size=10):
+        filename = os.path.join(self.tmpdir, name)
+        with open(filename, 'wb') as f:
+            f.write(b'x' * size)
+        return filename
+
+    def test_link(self):
+        target = os.path.join(self.tmpdir, 'page.pdf')
+        self.assertFalse(self.cache.link('a', target))
+        self.cache.add('a', self.printed('printed'))
+        self.assertTrue(self.cache.link('a', target))
+        # Pages handed out are not removed with the cache entries
+        self.cache.evict()
+        shutil.rmtree(self.cache.directory)
+        with open(target, 'rb') as f:
+            self.assertEqual(f.read(), b'x' * 10)
+        self.assertEqual(self.cache.stats(), {'hits': 1, 'misses': 1})
+
+    def test_evict_least_recently_used(self):
+        for i, key in enumerate(('a', 'b')):
+            self.cache.add(key, self.printed(key))
+            os.utime(self.cache._path(key),
+                     (time.time() - 100 + i, time.time()))
+        # a is used, then c is added: b is the least recently used
+        self.assertTrue(self.cache.link('a', os.path.join(self.tmpdir, 'x')))
+        self.cache.add('c', self.printed('c'))
+        self.assertEqual(sorted(os.listdir(self.cache.directory)),
+                         ['a.pdf', 'c.pdf'])
+
+    def test_expired_entry_is_a_miss(self):
+        target = os.path.join(self.tmpdir, 'page.pdf')
+        self.cache.add('a', self.printed('a'))
+        # Used recently, but added too long ago
+        added = time.time() - self.cache.max_age - 1
+        os.utime(self.cache._path('a'), (time.time(), added))
+        self.assertFalse(self.cache.link('a', target))
+        self.assertFalse(os.path.exists(target))
+        self.assertEqual(os.listdir(self.cache.directory), [])
+        self.assertEqual(self.cache.stats(), {'hits': 0, 'misses': 1})
+
+    def test_use_keeps_age(self):
+        self.cache.add('a', self.printed('a'))
+        added = time.time() - 100
+        os.utime(self.cache._path('a'), (added, added))
+        self.assertTrue(self.cache.link('a', os.path.join(self.tmpdir, 'x')))
+        stat = os.stat(self.cache._path('a'))
+        self.assertEqual(stat.st_mtime, added)
+        self.assertGreater(stat.st_atime, added)
+
+
+class TestPageKey(unittest.TestCase):
+
+    def test_key(self):
+        spec = {'layout': 'A4', 'layers': [{'params': {}}, {'b': 1, 'a': 2}],
+                'pages': [{'center': [1, 2], 'shortLink': 'https://s/1'}]}
+        builder = PageSpecBuilder(spec)
+        page = builder.build('2000', [0])
+        key = builder.key(page, 'map.geo.admin.ch')
+
+        other = PageSpecBuilder(
+            {'pages': [{'shortLink': 'https://s/2', 'center': [1, 2]}],
+             'layers': [{'params': {}}, {'a': 2, 'b': 1}], 'layout': 'A4'})
+        self.assertEqual(other.key(other.build('2000', [0]),
+                                   'map.geo.admin.ch'), key)
+        self.assertNotEqual(builder.key(builder.build('2001', [0]),
+                                        'map.geo.admin.ch'), key)
+        self.assertNotEqual(builder.key(page, 'other.ch'), key)
+
+        # The timestamps of the whole print do not change the page
+        spec['layers'][0]['timestamps'] = ['2000', '2001']
+        builder = PageSpecBuilder(spec)
+        self.assertEqual(builder.key(builder.build('2000', [0]),
+                                     'map.geo.admin.ch'), key)
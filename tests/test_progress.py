@@ -0,0 +1,107 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+from print3.progress import FileProgressStore, MemoryProgressStore, \
+    JobProgress, get_progress_store, progress_etag, wait_for_change
+
+
+class TestProgress(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_file_store(self):
+        store = FileProgressStore(self.tmpdir)
+        self.assertIsNone(store.read('1'))
+        store.write('1', {'status': 'ongoing'})
+        self.assertEqual(store.read('1'), {'status': 'ongoing'})
+        # No temporary file left behind
+        self.assertEqual(os.listdir(self.tmpdir), ['mapfish-print-multi1.json'])
+        store.remove('1')
+        self.assertIsNone(store.read('1'))
+
+    def test_get_progress_store(self):
+        store = get_progress_store(self.tmpdir, backend='memory')
+        self.assertIsInstance(store, MemoryProgressStore)
+        self.assertIs(store, get_progress_store(self.tmpdir, backend='memory'))
+
+    def test_job_progress(self):
+        store = FileProgressStore(self.tmpdir)
+        progress = JobProgress(store, '2', status='ongoing', done=0, total=50)
+
+        threads = [threading.Thread(target=progress.increment, args=('done',))
+                   for i in range(50)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        progress.update(merged=3)
+
+        self.assertEqual(store.read('2'), {'status': 'ongoing', 'done': 50,
+                                           'total': 50, 'merged': 3})
+        progress.reset(status='done')
+        self.assertEqual(store.read('2'), {'status': 'done'})
+
+    def test_wait_for_change(self):
+        store = MemoryProgressStore(self.tmpdir)
+        progress = JobProgress(store, '3', status='ongoing', done=0)
+        etag = progress_etag(store.read('3'))
+
+        # Timeout without change
+        data, current = wait_for_change(store, '3', etag, 0.1)
+        self.assertEqual(current, etag)
+
+        # Local jobs wake up the waiters, without polling the store
+        timer = threading.Timer(0.1, progress.increment, args=('done',))
+        timer.start()
+        start = time.time()
+        data, current = wait_for_change(store, '3', etag, 10, interval=10)
+        timer.join()
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(data, {'status': 'ongoing', 'done': 1})
+        self.assertNotEqual(current, etag)
+
+        # Other jobs are polled
+        store.write('4', {'status': 'ongoing'})
+        etag = progress_etag(store.read('4'))
+        timer = threading.Timer(0.1, store.write, args=('4', {'status': 'done'}))
+        timer.start()
+        data, current = wait_for_change(store, '4', etag, 10, interval=0.05)
+        timer.join()
+        self.assertEqual(data, {'status': 'done'})
+
+    def test_wait_for_change_shares_polls(self):
+        reads = []
+
+        class CountingStore(MemoryProgressStore):
+            def read(self, jobid):
+                reads.append(jobid)
+                return super(CountingStore, self).read(jobid)
+
+        store = CountingStore(self.tmpdir)
+        store.write('5', {'status': 'ongoing'})
+        etag = progress_etag(store.read('5'))
+        del reads[:]
+        results = []
+
+        def waiter():
+            results.append(wait_for_change(store, '5', etag, 10, interval=0.05))
+
+        waiters = [threading.Thread(target=waiter) for i in range(10)]
+        for t in waiters:
+            t.start()
+        time.sleep(0.3)
+        store.write('5', {'status': 'done'})
+        for t in waiters:
+            t.join()
+        self.assertEqual([data for data, current in results],
+                         [{'status': 'done'}] * 10)
+        # One read per waiter, then the reads of a single poller
+        self.assertLess(len(reads), 10 + 15)
@@ -0,0 +1,203 @@
+import os
+import mock
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import Future
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from print3.runner import FairExecutor, JobRunner, get_runner
+
+
+class TestJobRunner(unittest.TestCase):
+
+    def test_get_runner_is_shared(self):
+        self.assertIs(get_runner(), get_runner())
+
+    def test_pages_of_jobs_in_turn(self):
+        executor = FairExecutor(max_workers=1)
+        started = threading.Event()
+        release = threading.Event()
+        order = []
+
+        def block():
+            started.set()
+            release.wait()
+
+        executor.submit('first', block)
+        started.wait()
+        futures = [executor.submit('long', order.append, 'long%d' % i)
+                   for i in range(3)]
+        futures.append(executor.submit('short', order.append, 'short'))
+        release.set()
+        for f in futures:
+            f.result()
+        self.assertEqual(order, ['long0', 'short', 'long1', 'long2'])
+
+    def test_pages_are_bounded(self):
+        runner = JobRunner(max_jobs=1, max_pages=2)
+        lock = threading.Lock()
+        current = [0]
+        peak = [0]
+
+        def page(idx):
+            with lock:
+                current[0] += 1
+                peak[0] = max(peak[0], current[0])
+            time.sleep(0.02)
+            with lock:
+                current[0] -= 1
+
+        futures = [runner.submit_page(page, i) for i in range(8)]
+        for f in futures:
+            f.result()
+        self.assertEqual(peak[0], 2)
+
+    def test_jobs_are_queued(self):
+        runner = JobRunner(max_jobs=1, max_pages=1)
+        started = threading.Event()
+        release = threading.Event()
+        done = []
+
+        def job(name):
+            started.set()
+            release.wait(5)
+            done.append(name)
+
+        runner.submit(job, 'first')
+        started.wait(5)
+        runner.submit(job, 'second')
+        stats = runner.stats()
+        self.assertEqual(stats['active_jobs'], 1)
+        self.assertEqual(stats['queued_jobs'], 1)
+
+        release.set()
+        runner._jobs.join()
+        self.assertEqual(done, ['first', 'second'])
+
+    def test_session_pool_matches_page_threads(self):
+        runner = JobRunner(max_jobs=1, max_pages=24)
+        adapter = runner.session.get_adapter('http://localhost/print')
+        self.assertEqual(adapter._pool_maxsize, 24)
+
+    def test_cancel_aborts_requests(self):
+        class SlowHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                time.sleep(5)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), SlowHandler)
+        threading.Thread(target=server.handle_request, daemon=True).start()
+        runner = JobRunner(max_jobs=1, max_pages=1)
+        control = runner.register('44')
+        errors = []
+
+        def page(idx):
+            with control.attached():
+                try:
+                    runner.session.post(
+                        'http://127.0.0.1:%d/' % server.server_port,
+                        data=b'{}', timeout=10)
+                except Exception as e:
+                    errors.append(e)
+
+        start = time.time()
+        in_flight = control.add_future(runner.submit_page(page, 0))
+        queued = control.add_future(runner.submit_page(page, 1))
+        time.sleep(0.2)
+        self.assertTrue(runner.cancel('44'))
+        in_flight.result(5)
+        self.assertLess(time.time() - start, 2)
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(queued.cancelled())
+        runner.unregister('44')
+        self.assertFalse(runner.cancel('44'))
+        server.server_close()
+
+    def test_watch_survives_errors(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            runner = JobRunner(max_jobs=1, max_pages=1)
+            cancelfile = os.path.join(tmpdir, '45.cancel')
+            lease = mock.Mock(renewed=0, lost=False)
+            lease.queue.cancelled.return_value = set()
+            errors = [OSError('Stale file handle')]
+
+            def renew():
+                if errors:
+                    raise errors.pop()
+                return True
+
+            lease.renew.side_effect = renew
+            control = runner.register('45', cancelfile, lease)
+            for i in range(50):
+                if not errors:
+                    break
+                time.sleep(0.1)
+            self.assertFalse(errors)
+            self.assertFalse(control.cancelled)
+            # Still watching, cancelled through the job queue
+            lease.queue.cancelled.return_value = {'45'}
+            for i in range(50):
+                if control.cancelled:
+                    break
+                time.sleep(0.1)
+            self.assertTrue(control.cancelled)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_idle_jobs_looked_at_less_often(self):
+        runner = JobRunner(max_jobs=1, max_pages=1)
+        control = runner.register('46', '/nonexistent/46.cancel')
+        checks = [t for t in range(0, 40) if runner._cancel_due(control, t)]
+        self.assertEqual(checks, [0, 2, 6, 14, 22, 30, 38])
+        # Looked at every second while pages are pending
+        control.add_future(Future())
+        runner._cancel_checks.clear()
+        checks = [t for t in range(0, 5) if runner._cancel_due(control, t)]
+        self.assertEqual(checks, [0, 1, 2, 3, 4])
+        runner.unregister('46')
+
+    def test_drain(self):
+        runner = JobRunner(max_jobs=1, max_pages=1)
+        started = threading.Event()
+        finished = []
+
+        def job(jobid, lease=None):
+            control = runner.register(jobid, lease=lease)
+            started.set()
+            while not control.cancelled:
+                time.sleep(0.01)
+            finished.append((jobid, control.abandoned))
+            runner.unregister(jobid)
+
+        runner.submit(job, '47', key='47')
+        started.wait(5)
+        runner.submit(job, '48', key='48')
+        # The running job is abandoned, the queued one never starts
+        self.assertEqual(sorted(runner.drain(0.1)), ['47', '48'])
+        self.assertEqual(finished, [('47', True)])
+        self.assertEqual(runner.stats()['queued_jobs'], 0)
+
+    def test_drain_leaves_queued_jobs(self):
+        runner = JobRunner(max_jobs=1, max_pages=1)
+        started = threading.Event()
+        lease = mock.Mock(lost=False)
+        lease.queue.cancelled.return_value = set()
+
+        def job():
+            control = runner.register('49', lease=lease)
+            started.set()
+            while not control.cancelled:
+                time.sleep(0.01)
+            runner.unregister('49')
+
+        runner.submit(job)
+        started.wait(5)
+        # Claimed again by another runner once its lease expired
+        self.assertEqual(runner.drain(0.1), [])
+        self.assertTrue(lease.lost)
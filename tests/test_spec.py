@@ -0,0 +1,67 @@
+import copy
+import json
+import unittest
+
+from print3.spec import PageSpecBuilder, SpecBody
+
+
+SPEC = {
+    'layout': 'A4 landscape',
+    'legends': [{'name': 'zeitreihen'}],
+    'enableLegends': True,
+    'qrcodeurl': 'https://qr.local/qrcodegenerator?url=foo',
+    'layers': [
+        {'layer': 'ch.swisstopo.zeitreihen', 'params': {'TIME': '99991231'}},
+        {'type': 'Vector', 'geoJson': {'features': [[1, 2]] * 100}}],
+    'pages': [{'center': [600000, 200000], 'scale': 25000}]
+}
+
+
+class TestPageSpecBuilder(unittest.TestCase):
+
+    def test_build_copies_only_changed_parts(self):
+        spec = copy.deepcopy(SPEC)
+        builder = PageSpecBuilder(spec)
+
+        page = builder.build('19991231', [0], legends=False)
+        page['pages'][0]['shortLink'] = 'https://s.geo.admin.ch/1'
+
+        self.assertEqual(spec, SPEC)
+        self.assertEqual(page['layers'][0]['params']['TIME'], '19991231')
+        self.assertIs(page['layers'][1], spec['layers'][1])
+        self.assertNotIn('legends', page)
+        self.assertFalse(page['enableLegends'])
+
+        last = builder.build('20001231', [0])
+        self.assertEqual(last['legends'], SPEC['legends'])
+
+    def test_dumps(self):
+        builder = PageSpecBuilder(copy.deepcopy(SPEC))
+        for ts in ('19991231', '20001231'):
+            page = builder.build(ts, [0])
+            self.assertEqual(json.loads(builder.dumps(page)), page)
+        # The shared vector layer is serialized once
+        self.assertEqual(list(builder._layers.keys()), [1])
+        self.assertEqual(json.loads(builder.dumps({'layers': []})),
+                         {'layers': []})
+
+    def test_body(self):
+        spec = copy.deepcopy(SPEC)
+        builder = PageSpecBuilder(spec)
+        for ts in ('19991231', '20001231', '20011231'):
+            page = builder.build(ts, [0], legends=ts == '20011231')
+            page['pages'][0]['timestamp'] = ts[0:4] + '\n'
+            page['pages'][0]['shortLink'] = 'https://s.geo.admin.ch/%s"' % ts
+            page['qrcodeurl'] = 'https://qr.local/?url=%s' % ts
+            body = builder.body(page)
+            self.assertIsInstance(body, SpecBody)
+            self.assertEqual(len(body), len(bytes(body)))
+            self.assertEqual(json.loads(bytes(body)), page)
+        # One template with legends, one without
+        self.assertEqual(len(builder._templates), 2)
+        self.assertEqual(spec, SPEC)
+
+    def test_body_single_page(self):
+        builder = PageSpecBuilder(copy.deepcopy(SPEC))
+        page = builder.build()
+        self.assertEqual(json.loads(bytes(builder.body(page))), SPEC)
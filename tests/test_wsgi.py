@@ -0,0 +1,19 @@
+import importlib.util
+import unittest
+
+from print3.config import WORKER_CONNECTIONS, WORKER_THREADS
+
+
+@unittest.skipUnless(importlib.util.find_spec('gunicorn'),
+                     'gunicorn is not installed')
+class TestWsgi(unittest.TestCase):
+
+    def test_worker_options(self):
+        from print3.wsgi import worker_options
+        self.assertEqual(worker_options('gthread'),
+                         {'worker_class': 'gthread',
+                          'threads': WORKER_THREADS})
+        self.assertEqual(worker_options('gevent'),
+                         {'worker_class': 'gevent',
+                          'worker_connections': WORKER_CONNECTIONS})
+        self.assertEqual(worker_options('sync'), {'worker_class': 'sync'})